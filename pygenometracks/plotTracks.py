@@ -144,12 +144,15 @@ type = vlines
 import sys
 import os
 import argparse
+import math
 import warnings
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
 
 from importlib.metadata import version
 
 from pygenometracks.tracksClass import PlotTracks
-from .utilities import InputError, get_region
+from .utilities import InputError, get_region, group_nearby_regions
 import matplotlib.pyplot as plt
 
 DEFAULT_FIGURE_WIDTH = 40  # in centimeters
@@ -182,7 +185,9 @@ def parse_arguments(args=None):
                        help='Instead of a region, a file containing the regions to plot, in BED format, '
                        'can be given. If this is the case, multiple files will be created. '
                        'It will use the value of --outFileName as a template'
-                       ' and put the coordinates between the file name and the extension.',
+                       ' and put the coordinates between the file name and the extension.'
+                       ' A region which fails to be plotted does not stop the other ones:'
+                       ' the failures are reported at the end and the exit status is 1.',
                        type=argparse.FileType('r')
                        )
 
@@ -241,12 +246,113 @@ def parse_arguments(args=None):
                              ' with a decreasing x-axis.',
                         action='store_true')
 
+    parser.add_argument('--fetchThreads',
+                        help='Number of threads used to read the data of the '
+                             'different tracks of a region concurrently, '
+                             'before plotting them. This is useful '
+                             'when files are on a slow file system (default is 1).',
+                        type=int,
+                        default=1)
+
+    parser.add_argument('--prefetchDepth',
+                        help='When --BED is used, number of next regions '
+                             'whose data are read in the background while the '
+                             'current region is plotted and saved (default is 0).',
+                        type=int,
+                        default=0)
+
+    parser.add_argument('--numberOfProcessors', '-p',
+                        help='Number of processors to use to plot the regions '
+                             'given with --BED. Each processor loads the tracks '
+                             'once and then plots its share of the regions. '
+                             '--fetchThreads and --prefetchDepth apply to each '
+                             'processor (default is 1).',
+                        type=int,
+                        default=1)
+
+    parser.add_argument('--lazyLoading',
+                        help='Load the data of the tracks only for the '
+                             'regions being plotted (all the regions of the '
+                             'same chromosome or only the nearby ones, see '
+                             '--mergeDistance) and release them before '
+                             'loading the next ones. This reduces the memory '
+                             'used when the regions are on many chromosomes '
+                             'but the files are read several times. Use it '
+                             'with --regionOrder locality so each group of '
+                             'regions is loaded only once.',
+                        action='store_true')
+
+    parser.add_argument('--regionOrder',
+                        help='Order in which the regions given with --BED '
+                             'are plotted. "input" keeps the order of the BED '
+                             'file. "locality" sorts them by chromosome (in '
+                             'the order of their first appearance) and by '
+                             'position, so the regions sharing the same data '
+                             'are plotted one after the other (and by the same '
+                             'processor, unless they are split to use all '
+                             'the processors). The output file names do not depend '
+                             'on this order (default is input).',
+                        default='input',
+                        choices=['input', 'locality'])
+
+    parser.add_argument('--mergeDistance',
+                        help='With --lazyLoading, regions of the same '
+                             'chromosome which are separated by at most this '
+                             'distance (in bp) are loaded together. '
+                             'By default, all the regions of a chromosome are '
+                             'loaded together.',
+                        type=int,
+                        default=None)
+
+    parser.add_argument('--cacheDir',
+                        help='Directory where the parsed version of the '
+                             'bedgraph files (without tabix index), of the '
+                             'bed, gtf and links files and of the '
+                             'files used by vlines and vhighlight are stored. '
+                             'The next runs with the same unchanged files '
+                             'and regions will not need to parse them again. '
+                             'By default, nothing is stored.',
+                        default=None)
+
+    parser.add_argument('--cacheSize',
+                        help='Maximum size of the --cacheDir in MB. When it '
+                             'is exceeded, the least recently used files are '
+                             'removed (default is 1000).',
+                        type=float,
+                        default=1000)
+
     parser.add_argument('--version', action='version',
                         version=version('pyGenomeTracks'))
 
     return parser
 
 
+# Each worker of the pool has its own PlotTracks object
+# which is created once by init_worker
+worker_trp = None
+worker_init_error = None
+
+
+def init_worker(trp_args, trp_kwargs):
+    global worker_trp, worker_init_error
+    try:
+        worker_trp = PlotTracks(*trp_args, **trp_kwargs)
+    except Exception as e:
+        # If the initializer raises, the pool would restart the worker
+        # again and again. The error is raised by the first task instead.
+        worker_init_error = e
+
+
+def plot_regions_in_worker(batch, plot_kwargs, prefetch_depth=0):
+    """
+    Plots the regions of batch (list of tuples (file_name, chrom, start, end))
+    with the PlotTracks of the worker (see plot_bed_regions).
+    """
+    if worker_init_error is not None:
+        raise worker_init_error
+    return plot_bed_regions(worker_trp, batch, plot_kwargs, prefetch_depth)
+
+
 def main(args=None):
 
     args = parse_arguments().parse_args(args)
@@ -271,35 +377,185 @@ def main(args=None):
     if len(regions) == 0:
         raise InputError("There is no valid regions to plot.")
 
-    # Create all the tracks
-    trp = PlotTracks(args.tracks.name, args.width, fig_height=args.height,
-                     fontsize=args.fontSize, dpi=args.dpi,
-                     track_label_width=args.trackLabelFraction,
-                     plot_regions=regions, plot_width=args.plotWidth)
+    if args.numberOfProcessors < 1:
+        raise InputError("--numberOfProcessors should be at least 1.")
+    if args.fetchThreads < 1:
+        raise InputError("--fetchThreads should be at least 1.")
+    if args.prefetchDepth < 0:
+        raise InputError("--prefetchDepth should be positive.")
+    if args.cacheSize <= 0:
+        raise InputError("--cacheSize should be positive.")
+    if args.mergeDistance is not None and args.mergeDistance < 0:
+        raise InputError("--mergeDistance should be positive.")
+
+    trp_args = (args.tracks.name, args.width)
+    trp_kwargs = {'fig_height': args.height,
+                  'fontsize': args.fontSize, 'dpi': args.dpi,
+                  'track_label_width': args.trackLabelFraction,
+                  'plot_regions': regions, 'plot_width': args.plotWidth,
+                  'fetch_threads': args.fetchThreads,
+                  'cache_dir': args.cacheDir, 'cache_size': args.cacheSize,
+                  'lazy_loading': args.lazyLoading,
+                  'merge_distance': args.mergeDistance}
+    plot_kwargs = {'title': args.title,
+                   'h_align_titles': args.trackLabelHAlign,
+                   'decreasing_x_axis': args.decreasingXAxis}
 
     # Create dir if dir does not exists:
     # Modified from https://stackoverflow.com/questions/12517451/automatically-creating-directories-with-file-output
     os.makedirs(os.path.dirname(os.path.abspath(args.outFileName)), exist_ok=True)
 
-    # Plot them
     if args.BED:
-        name = args.outFileName.split(".")
-        file_suffix = name[-1]
-        file_prefix = ".".join(name[:-1])
-        for chrom, start, end in regions:
-            file_name = f"{file_prefix}_{chrom}-{start}-{end}.{file_suffix}"
-            if end - start < 200000:
-                warnings.warn("A region shorter than 200kb has been "
-                              "detected! This can be too small to return "
-                              "a proper TAD plot!\n")
-            sys.stderr.write(f"saving {file_name}\n")
-            current_fig = trp.plot(file_name, chrom, start, end, title=args.title,
-                                   h_align_titles=args.trackLabelHAlign,
-                                   decreasing_x_axis=args.decreasingXAxis)
-            plt.close(current_fig)
+        file_names = get_bed_file_names(args.outFileName, regions)
+        batches = schedule_regions(file_names, args.regionOrder,
+                                   args.mergeDistance, args.numberOfProcessors)
+
+    if args.BED and args.numberOfProcessors > 1 and len(batches) > 1:
+        # The tracks are created inside each worker
+        results = plot_bed_regions_in_parallel(args, batches, trp_args,
+                                               trp_kwargs, plot_kwargs)
     else:
-        current_fig = trp.plot(args.outFileName, *regions[0], title=args.title,
-                               h_align_titles=args.trackLabelHAlign,
-                               decreasing_x_axis=args.decreasingXAxis)
-        plt.close(current_fig)
-    trp.close_files()
+        # Create all the tracks
+        trp = PlotTracks(*trp_args, **trp_kwargs)
+
+        # Plot them
+        if args.BED:
+            results = plot_bed_regions(trp, [file_name for batch in batches
+                                             for file_name in batch],
+                                       plot_kwargs, args.prefetchDepth)
+        else:
+            current_fig = trp.plot(args.outFileName, *regions[0], **plot_kwargs)
+            plt.close(current_fig)
+        trp.close_files()
+
+    if args.BED:
+        failed_regions = [file_name for file_name, error in results
+                          if error is not None]
+        if len(failed_regions) > 0:
+            sys.stderr.write(f"{len(failed_regions)} out of {len(results)} regions "
+                             "could not be plotted:\n"
+                             + "\n".join(failed_regions) + "\n")
+            sys.exit(1)
+
+
+def get_bed_file_names(out_file_name, regions):
+    """
+    Uses out_file_name as a template to get one file name per region
+    (the coordinates are put between the file name and the extension).
+    Returns a list of tuples (file_name, chrom, start, end)
+    """
+    name = out_file_name.split(".")
+    file_suffix = name[-1]
+    file_prefix = ".".join(name[:-1])
+    file_names = []
+    for chrom, start, end in regions:
+        file_name = f"{file_prefix}_{chrom}-{start}-{end}.{file_suffix}"
+        if end - start < 200000:
+            warnings.warn("A region shorter than 200kb has been "
+                          "detected! This can be too small to return "
+                          "a proper TAD plot!\n")
+        file_names.append((file_name, chrom, start, end))
+    return file_names
+
+
+def schedule_regions(file_names, region_order='input', merge_distance=None,
+                     number_of_batches=1):
+    """
+    Splits file_names (list of tuples (file_name, chrom, start, end))
+    in batches of regions to plot one after the other.
+    With region_order 'input', each batch is a single region
+    and the order of file_names is kept.
+    With region_order 'locality', the regions are sorted by chromosome
+    (in the order of their first region) and position and each batch
+    contains the nearby regions which share the same data
+    (see group_nearby_regions). So the batches can be plotted by
+    number_of_batches processors, the groups with more than
+    1 / number_of_batches of the regions are split in contiguous batches.
+    Returns a list of lists of tuples (file_name, chrom, start, end)
+    """
+    if region_order == 'input':
+        return [[file_name] for file_name in file_names]
+    file_names_by_region = {}
+    for file_name in file_names:
+        file_names_by_region.setdefault(file_name[1:], []).append(file_name)
+    max_batch_size = math.ceil(len(file_names) / number_of_batches)
+    batches = []
+    for group in group_nearby_regions(list(file_names_by_region),
+                                      merge_distance):
+        group_file_names = [file_name for region in group
+                            for file_name in file_names_by_region[region]]
+        n_batches = math.ceil(len(group_file_names) / max_batch_size)
+        bounds = [round(i * len(group_file_names) / n_batches)
+                  for i in range(n_batches + 1)]
+        batches += [group_file_names[bounds[i]:bounds[i + 1]]
+                    for i in range(n_batches)]
+    return batches
+
+
+def plot_bed_regions(trp, file_names, plot_kwargs, prefetch_depth=0):
+    """
+    Plots one after the other the regions of file_names
+    (list of tuples (file_name, chrom, start, end)).
+    If prefetch_depth is above 0, the data of the prefetch_depth
+    next regions are read by a background thread while the current
+    region is plotted.
+    A region which fails to be plotted does not stop the other ones.
+    Returns a list with, for each region, the file_name and None
+    if the plot was successful or a description of the error.
+    """
+    results = []
+    # Only one thread is used so the regions are read in order
+    # (each of them can use trp.fetch_threads)
+    # The current region is read by this thread too, so the data of
+    # the next regions are read while the current one is plotted
+    prefetched = {}
+    with ThreadPoolExecutor(max_workers=1) as prefetcher:
+        for i, (file_name, chrom, start, end) in enumerate(file_names):
+            sys.stderr.write(f"saving {file_name}\n")
+            try:
+                if prefetch_depth > 0:
+                    if trp.lazy_loading and trp.load_region(chrom, start, end):
+                        # The data of the regions of this group were not
+                        # prefetched because their tracks were not loaded
+                        prefetched = {}
+                    for j in range(i, min(i + 1 + prefetch_depth, len(file_names))):
+                        if j not in prefetched:
+                            prefetched[j] = prefetcher.submit(trp.prefetch_data,
+                                                              *file_names[j][1:])
+                    # Wait for the data of the current region
+                    # (this will raise the errors if any)
+                    prefetched.pop(i).result()
+                current_fig = trp.plot(file_name, chrom, start, end, **plot_kwargs)
+                plt.close(current_fig)
+            except Exception as e:
+                plt.close('all')
+                warnings.warn(f"{file_name} could not be plotted: "
+                              f"{type(e).__name__}: {e}\n")
+                results.append((file_name, f"{type(e).__name__}: {e}"))
+            else:
+                results.append((file_name, None))
+    return results
+
+
+def plot_bed_regions_in_parallel(args, batches, trp_args, trp_kwargs,
+                                 plot_kwargs):
+    """
+    Plots the batches of regions (list of lists of tuples
+    (file_name, chrom, start, end)) on a pool of args.numberOfProcessors
+    workers. Each worker creates its own PlotTracks and plots
+    whole batches (see plot_bed_regions).
+    Returns the results of all regions (see plot_bed_regions).
+    """
+    tasks = [(batch, plot_kwargs, args.prefetchDepth) for batch in batches]
+    # The datasets used by all the regions are computed once
+    # and given to the PlotTracks of each worker
+    parent_trp = PlotTracks(*trp_args, **dict(trp_kwargs, lazy_loading=True))
+    trp_kwargs = dict(trp_kwargs, run_data=parent_trp.compute_run_data())
+    results = []
+    with multiprocessing.Pool(min(args.numberOfProcessors, len(tasks)),
+                              initializer=init_worker,
+                              initargs=(trp_args, trp_kwargs)) as pool:
+        for batch_results in pool.starmap(plot_regions_in_worker, tasks,
+                                          chunksize=1):
+            results += batch_results
+    return results
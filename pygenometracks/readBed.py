@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 import sys
 import collections
+import numpy as np
 from .utilities import to_string, InputError
 
 
@@ -10,6 +11,11 @@ class ReadBed(object):
     it tries to guess the type of bed file used. Current options
     are bed3, bed6 and bed12
 
+    The file is read by chunks and, when all lines of a chunk are
+    valid, each column of the chunk is converted at once.
+    Otherwise, the lines of the chunk are processed one by one
+    to report the invalid values with their line number.
+
     Example:
     bed = ReadBed(open("file.bed", 'r'))
     for interval in bed:
@@ -17,9 +23,10 @@ class ReadBed(object):
 
     """
 
-    def __init__(self, file_handle):
+    def __init__(self, file_handle, chunk_size=2 ** 25):
         """
         :param file_handle: file handle
+        :param chunk_size: approximate number of bytes read and parsed at once
         :return:
         """
 
@@ -29,7 +36,11 @@ class ReadBed(object):
         # Can be 3 to 12
         self.fields_to_read = 12
         self.file_handle = file_handle
+        self.chunk_size = chunk_size
         self.line_number = 0
+        # The intervals of the chunk being read
+        self.chunk = []
+        self.chunk_position = 0
         # guess file type
         try:
             fields = self.get_no_comment_line()
@@ -75,11 +86,101 @@ class ReadBed(object):
         """
         :return: bedInterval object
         """
-        line = self.get_no_comment_line()
+        while self.chunk_position == len(self.chunk):
+            self.read_chunk()
+        bed = self.chunk[self.chunk_position]
+        self.chunk_position += 1
+        return bed
 
-        bed = self.get_bed_interval(line)
+    def read_chunk(self):
+        """
+        Reads the next chunk of lines and converts them
+        into bedInterval objects stored in self.chunk
+        """
+        lines = self.file_handle.readlines(self.chunk_size)
+        if len(lines) == 0:
+            raise StopIteration
+        lines = [line for line in map(to_string, lines)
+                 if not line.startswith(("#", "track", "browser"))
+                 and line.strip() != '']
+        self.chunk_position = 0
+        try:
+            self.chunk = self.get_bed_intervals(lines)
+        except (ValueError, OverflowError):
+            # Process the lines one by one to get the
+            # warnings and errors with the line number
+            self.chunk = []
+            for line in lines:
+                self.line_number += 1
+                self.chunk.append(self.get_bed_interval(line))
+        else:
+            self.line_number += len(lines)
 
-        return bed
+    def get_bed_intervals(self, bed_lines):
+        r"""
+        Processes a list of bed lines at once, converting each column
+        in a single step. Raises a ValueError if one of the lines
+        would need a correction or a warning from get_bed_interval.
+
+        >>> bed_lines = ["chr1\t0\t1000\tgene_1\t0.5\t-\n",
+        ...              "chr2\t10\t20\tgene_2\t1\t+\n"]
+        >>> with open('/tmp/test.bed', 'w') as fh:
+        ...     foo = fh.writelines(bed_lines)
+        >>> bed_f = ReadBed(open('/tmp/test.bed','r'))
+        >>> bed_f.get_bed_intervals(bed_lines)[1]
+        BedInterval(chromosome='chr2', start=10, end=20, name='gene_2', score=1.0, strand='+')
+        """
+        if len(bed_lines) == 0:
+            return []
+        rows = [line.strip().split("\t") for line in bed_lines]
+        if min(map(len, rows)) < self.fields_to_read:
+            raise ValueError("Not enough fields.")
+        columns = list(zip(*[row[:self.fields_to_read] for row in rows]))
+
+        values = [list(columns[0])]
+        starts = np.array(columns[1], dtype=np.int64)
+        ends = np.array(columns[2], dtype=np.int64)
+        if np.any(ends <= starts):
+            raise ValueError("Start position larger or equal than end.")
+        values += [starts.tolist(), ends.tolist()]
+        if self.fields_to_read > 3:
+            values.append(list(columns[3]))
+        if self.fields_to_read > 4:
+            values.append(np.array(columns[4], dtype=float).tolist())
+        if self.fields_to_read > 5:
+            if not set(columns[5]).issubset(['+', '-', '.']):
+                raise ValueError("Invalid strand.")
+            values.append(list(columns[5]))
+        if self.fields_to_read > 6:
+            values.append(np.array(columns[6], dtype=np.int64).tolist())
+            values.append(np.array(columns[7], dtype=np.int64).tolist())
+        if self.fields_to_read > 8:
+            n_commas = set(rgb.count(',') for rgb in columns[8])
+            if n_commas == {0}:
+                rgbs = np.zeros((len(rows), 3), dtype=np.int64)
+                rgbs[:, 2] = np.array(columns[8], dtype=np.int64)
+            elif n_commas == {2}:
+                rgbs = np.array(",".join(columns[8]).split(","),
+                                dtype=np.int64).reshape(-1, 3)
+            else:
+                raise ValueError("Invalid rgb.")
+            values.append(rgbs.tolist())
+        if self.fields_to_read > 9:
+            values.append(np.array(columns[9], dtype=np.int64).tolist())
+            for idx in [10, 11]:
+                values.append([[int(x) for x in r.split(',') if x != '']
+                               for r in columns[idx]])
+            for i, line_values in enumerate(zip(*values)):
+                check_bed12(line_values, self.line_number + i + 1,
+                            bed_lines[i])
+
+        if self.fields_to_read < 6:
+            # If there is less than 6 fields, the default values will be added
+            default = [".", 0, "."]
+            values += [[default[i - 3]] * len(rows)
+                       for i in range(self.fields_to_read, 6)]
+
+        return list(map(self.BedInterval._make, zip(*values)))
 
     def get_bed_interval(self, bed_line, is_first_line=False):
         r"""
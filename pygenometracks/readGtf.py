@@ -3,7 +3,7 @@ import collections
 
 import gffutils
 import warnings
-from .utilities import InputError
+from .utilities import InputError, to_string
 import logging
 
 
@@ -47,6 +47,7 @@ class ReadGtf(object):
                  merge_overlapping_exons=True):
         """
         :param file_path: the path of the gtf file
+                          or a binary file handle
         :return:
         """
 
@@ -69,17 +70,25 @@ class ReadGtf(object):
 
         # Will process the gtf to get one item per transcript:
         # This will create a database:
+        if isinstance(file_path, str):
+            data = file_path
+            from_string = False
+        else:
+            data = to_string(file_path.read())
+            file_path.close()
+            from_string = True
         try:
-            self.db = gffutils.create_db(file_path, ':memory:')
+            self.db = gffutils.create_db(data, ':memory:',
+                                         from_string=from_string)
         except ValueError as ve:
             if "No lines parsed" in str(ve):
                 self.length = 0
-                self.all_transcripts = open(file_path, 'r')
+                self.all_transcripts = iter([])
             else:
                 raise InputError("This is not a gtf file.")
         except gffutils.exceptions.EmptyInputError:
             self.length = 0
-            self.all_transcripts = open(file_path, 'r')
+            self.all_transcripts = iter([])
         else:
             if self.merge_transcripts:
                 self.length = self.db.count_features_of_type("gene")
@@ -5,8 +5,12 @@ from matplotlib.testing.compare import compare_images
 from tempfile import NamedTemporaryFile
 import os
 import shutil
+import time
+import pytest
 import pygenometracks.plotTracks
 from pygenometracks.utilities import InputError
+from pygenometracks.tracks.BedGraphTrack import BedGraphTrack
+import numpy as np
 
 ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
                     "test_data")
@@ -332,6 +336,156 @@ def test_plot_bedgraph_tracks_with_bed():
         os.remove(output_file)
 
 
+def test_plot_bedgraph_tracks_with_bed_parallel():
+    extension = '.png'
+
+    outfile = NamedTemporaryFile(suffix=extension, prefix='pyGenomeTracks_test_',
+                                 delete=False)
+    ini_file = os.path.join(ROOT, "bedgraph_useMid.ini")
+    bed_file = os.path.join(ROOT, 'regions_imbricated_chr2.bed')
+    args = f"--tracks {ini_file} --BED {bed_file} "\
+           "--trackLabelFraction 0.2 --width 38 --dpi 130 "\
+           "--numberOfProcessors 2 "\
+           f"--outFileName {outfile.name}".split()
+    pygenometracks.plotTracks.main(args)
+    for region in ['chr2:73800000-75744000', 'chr2:74000000-74800000']:
+        region_str = region.replace(':', '-')
+        output_file = outfile.name[:-4] + '_' + region_str + extension
+        expected_file = os.path.join(ROOT, 'master_bedgraph_useMid_'
+                                     + region_str + extension)
+        res = compare_images(expected_file,
+                             output_file, tolerance)
+        assert res is None, res
+
+        os.remove(output_file)
+
+
+def test_plot_bedgraph_tracks_with_bed_locality_parallel():
+    extension = '.png'
+
+    outfile = NamedTemporaryFile(suffix=extension, prefix='pyGenomeTracks_test_',
+                                 delete=False)
+    ini_file = os.path.join(ROOT, "bedgraph_useMid.ini")
+    # All regions are on chr2, they are split between the 2 processors
+    bed_file = os.path.join(ROOT, 'regions_imbricated_chr2.bed')
+    file_names = [(outfile.name, 'chr2', 73800000, 75744000),
+                  (outfile.name, 'chr2', 74000000, 74800000)]
+    assert pygenometracks.plotTracks.schedule_regions(file_names, 'locality',
+                                                      number_of_batches=2) == \
+        [[file_names[0]], [file_names[1]]]
+    args = f"--tracks {ini_file} --BED {bed_file} "\
+           "--trackLabelFraction 0.2 --width 38 --dpi 130 "\
+           "--numberOfProcessors 2 --regionOrder locality "\
+           f"--outFileName {outfile.name}".split()
+    pygenometracks.plotTracks.main(args)
+    for region in ['chr2:73800000-75744000', 'chr2:74000000-74800000']:
+        region_str = region.replace(':', '-')
+        output_file = outfile.name[:-4] + '_' + region_str + extension
+        expected_file = os.path.join(ROOT, 'master_bedgraph_useMid_'
+                                     + region_str + extension)
+        res = compare_images(expected_file,
+                             output_file, tolerance)
+        assert res is None, res
+
+        os.remove(output_file)
+
+
+def test_plot_bedgraph_tracks_with_bed_prefetch():
+    extension = '.png'
+
+    outfile = NamedTemporaryFile(suffix=extension, prefix='pyGenomeTracks_test_',
+                                 delete=False)
+    ini_file = os.path.join(ROOT, "bedgraph_useMid.ini")
+    bed_file = os.path.join(ROOT, 'regions_imbricated_chr2.bed')
+    args = f"--tracks {ini_file} --BED {bed_file} "\
+           "--trackLabelFraction 0.2 --width 38 --dpi 130 "\
+           "--prefetchDepth 1 --fetchThreads 2 "\
+           f"--outFileName {outfile.name}".split()
+    pygenometracks.plotTracks.main(args)
+    for region in ['chr2:73800000-75744000', 'chr2:74000000-74800000']:
+        region_str = region.replace(':', '-')
+        output_file = outfile.name[:-4] + '_' + region_str + extension
+        expected_file = os.path.join(ROOT, 'master_bedgraph_useMid_'
+                                     + region_str + extension)
+        res = compare_images(expected_file,
+                             output_file, tolerance)
+        assert res is None, res
+
+        os.remove(output_file)
+
+
+def test_plot_bedgraph_tracks_with_bed_prefetch_overlap(monkeypatch):
+    # The data of the next region must be read
+    # while the current region is plotted
+    intervals = {'fetch_data': [], 'plot': []}
+
+    def timed(name):
+        function = getattr(BedGraphTrack, name)
+
+        def timed_function(*args):
+            begin = time.monotonic()
+            time.sleep(0.2)
+            result = function(*args)
+            intervals[name].append((begin, time.monotonic()))
+            return result
+        return timed_function
+
+    for name in intervals:
+        monkeypatch.setattr(BedGraphTrack, name, timed(name))
+    extension = '.png'
+
+    outfile = NamedTemporaryFile(suffix=extension, prefix='pyGenomeTracks_test_',
+                                 delete=False)
+    ini_file = os.path.join(ROOT, "bedgraph_useMid.ini")
+    bed_file = os.path.join(ROOT, 'regions_imbricated_chr2.bed')
+    args = f"--tracks {ini_file} --BED {bed_file} "\
+           "--trackLabelFraction 0.2 --width 38 --dpi 130 "\
+           "--prefetchDepth 1 "\
+           f"--outFileName {outfile.name}".split()
+    pygenometracks.plotTracks.main(args)
+    assert any(fetch_start < plot_end and plot_start < fetch_end
+               for fetch_start, fetch_end in intervals['fetch_data']
+               for plot_start, plot_end in intervals['plot'])
+    for region in ['chr2:73800000-75744000', 'chr2:74000000-74800000']:
+        region_str = region.replace(':', '-')
+        os.remove(outfile.name[:-4] + '_' + region_str + extension)
+
+
+def test_plot_bedgraph_tracks_with_bed_failed_region(monkeypatch):
+    # A region which fails does not stop the other ones
+    # but the exit status is 1, with or without processors
+    plot = BedGraphTrack.plot
+
+    def failing_plot(self, ax, chrom_region, start_region, end_region):
+        if start_region == 74000000:
+            raise ValueError("failing region")
+        return plot(self, ax, chrom_region, start_region, end_region)
+
+    monkeypatch.setattr(BedGraphTrack, 'plot', failing_plot)
+    extension = '.png'
+    ini_file = os.path.join(ROOT, "bedgraph_useMid.ini")
+    bed_file = os.path.join(ROOT, 'regions_imbricated_chr2.bed')
+    for options in ["", "--prefetchDepth 1", "--numberOfProcessors 2"]:
+        outfile = NamedTemporaryFile(suffix=extension, prefix='pyGenomeTracks_test_',
+                                     delete=False)
+        args = f"--tracks {ini_file} --BED {bed_file} "\
+               f"--trackLabelFraction 0.2 --width 38 --dpi 130 {options} "\
+               f"--outFileName {outfile.name}".split()
+        with pytest.raises(SystemExit) as exit_info:
+            pygenometracks.plotTracks.main(args)
+        assert exit_info.value.code == 1
+        region_str = 'chr2-73800000-75744000'
+        output_file = outfile.name[:-4] + '_' + region_str + extension
+        expected_file = os.path.join(ROOT, 'master_bedgraph_useMid_'
+                                     + region_str + extension)
+        res = compare_images(expected_file,
+                             output_file, tolerance)
+        assert res is None, res
+        os.remove(output_file)
+        assert not os.path.exists(outfile.name[:-4] + '_chr2-74000000-74800000'
+                                  + extension)
+
+
 def test_plot_bedgraph_tracks_individual():
     extension = '.png'
 
@@ -585,3 +739,18 @@ def test_bedgraph_end_not_covered():
     assert res is None, res
 
     os.remove(outfile.name)
+
+
+def test_bedgraph_scores_as_arrays():
+    track = BedGraphTrack({'file': os.path.join(ROOT, "bedgraph_withNA.bdg"),
+                           'section_name': 'test'})
+    starts, ends, scores = track.get_scores_as_arrays('X', 1000000, 5000000)
+    # The NA and the regions not covered are nan
+    assert starts.tolist() == [1000000, 2000000, 3000000, 3070000, 3080750, 4000800]
+    assert ends.tolist() == [2000000, 3000000, 3070000, 3080750, 4000800, 5000000]
+    np.testing.assert_array_equal(scores, [np.nan, 1, np.nan, np.nan, 2, np.nan])
+    starts, ends, scores = track.get_scores_as_arrays('chrX', 3500000, 3600000,
+                                                      return_nans=False)
+    assert starts.tolist() == [3080750]
+    starts, ends, scores = track.get_scores_as_arrays('chr2', 0, 1000)
+    assert len(starts) == 0
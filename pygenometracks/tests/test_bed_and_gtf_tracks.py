@@ -3,9 +3,12 @@ import matplotlib as mpl
 mpl.use('agg')
 from matplotlib.testing.compare import compare_images
 from tempfile import NamedTemporaryFile
+import tempfile
+import shutil
 import os.path
 import pygenometracks.plotTracks
-from pygenometracks.utilities import InputError
+from pygenometracks.tracksClass import PlotTracks
+from pygenometracks.utilities import InputError, get_region
 
 
 ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
@@ -1789,3 +1792,73 @@ def test_plot_tracks_bed_displays():
     assert res is None, res
 
     os.remove(outfile.name)
+
+
+def test_bed_shared_between_sections():
+    ini_file = NamedTemporaryFile(suffix='.ini', prefix='pgt_test_', delete=False)
+    genes = os.path.join(ROOT, 'dm3_genes.bed.gz')
+    with open(ini_file.name, 'w') as fh:
+        fh.write(f"[genes]\nfile = {genes}\n\n"
+                 f"[genes collapsed]\nfile = {genes}\ndisplay = collapsed\n\n"
+                 f"[genes global]\nfile = {genes}\nglobal_max_row = true\n")
+    region = "X:3000000-3300000"
+    trp = PlotTracks(ini_file.name, plot_regions=[get_region(region)])
+    # The first two sections use the same file with the same parameters
+    assert trp.track_obj_list[0].interval_tree is trp.track_obj_list[1].interval_tree
+    assert trp.track_obj_list[0].interval_tree is not trp.track_obj_list[2].interval_tree
+    trp.close_files()
+    os.remove(ini_file.name)
+
+
+def test_bed_lazy_loading():
+    ini_file = NamedTemporaryFile(suffix='.ini', prefix='pgt_test_', delete=False)
+    with open(ini_file.name, 'w') as fh:
+        fh.write(f"[tads]\nfile = {os.path.join(ROOT, 'tad_classification.bed')}\n")
+    regions = [get_region("chrX:3000000-3300000"),
+               get_region("chr2L:100000-400000"),
+               get_region("chrX:3400000-3700000")]
+    trp = PlotTracks(ini_file.name, plot_regions=regions, lazy_loading=True)
+    # Nothing is loaded before the first plot
+    assert trp.track_obj_list == []
+    for region in regions:
+        trp.load_region(*region)
+        assert list(trp.track_obj_list[0].interval_tree) == [region[0]]
+    # The regions of chrX are loaded together
+    assert trp.loaded_group == [regions[0], regions[2]]
+    trp.close_files()
+    # Unless they are too far apart
+    trp = PlotTracks(ini_file.name, plot_regions=regions, lazy_loading=True,
+                     merge_distance=50000)
+    trp.load_region(*regions[2])
+    assert trp.loaded_group == [regions[2]]
+    trp.close_files()
+    os.remove(ini_file.name)
+
+
+def test_bed_gtf_and_links_file_cache():
+    cache_dir = tempfile.mkdtemp()
+    ini_file = NamedTemporaryFile(suffix='.ini', prefix='pgt_test_', delete=False)
+    with open(ini_file.name, 'w') as fh:
+        fh.write(f"[genes]\nfile = {os.path.join(ROOT, 'dm3_genes.bed.gz')}\n\n"
+                 f"[tads]\nfile = {os.path.join(ROOT, 'tad_classification.bed')}\n\n"
+                 f"[gtf]\nfile = {os.path.join(ROOT, 'dm3_subset_BDGP5.78.gtf.gz')}\n\n"
+                 f"[links]\nfile = {os.path.join(ROOT, 'test.arcs')}\n\n"
+                 f"[links middle]\nfile = {os.path.join(ROOT, 'test.arcs')}\n"
+                 "use_middle = true\n")
+    regions = [get_region("X:3000000-3300000")]
+    expected_trp = PlotTracks(ini_file.name, plot_regions=regions)
+    # The first run parses and stores the files, the second loads them
+    for __ in range(2):
+        trp = PlotTracks(ini_file.name, plot_regions=regions, cache_dir=cache_dir)
+        for track, expected_track in zip(trp.track_obj_list,
+                                         expected_trp.track_obj_list):
+            assert list(track.interval_tree) == list(expected_track.interval_tree)
+            for chrom in track.interval_tree:
+                assert list(track.interval_tree[chrom]) == \
+                    list(expected_track.interval_tree[chrom])
+        trp.close_files()
+    # One archive per section (use_middle is part of the key)
+    assert len(os.listdir(cache_dir)) == 5
+    expected_trp.close_files()
+    os.remove(ini_file.name)
+    shutil.rmtree(cache_dir)
@@ -4,7 +4,12 @@ mpl.use('agg')
 from matplotlib.testing.compare import compare_images
 from tempfile import NamedTemporaryFile
 import os.path
+import logging
 import pygenometracks.plotTracks
+from pygenometracks.tracksClass import PlotTracks
+from pygenometracks.utilities import get_region, BigWigReader, BigWigPool, InputError
+import numpy as np
+import pytest
 
 ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
                     "test_data")
@@ -663,3 +668,121 @@ def test_op_with_scientific_notation():
     assert res is None, res
 
     os.remove(outfile.name)
+
+
+def test_bigwig_shared_reader():
+    ini_file = NamedTemporaryFile(suffix='.ini', prefix='pgt_test_', delete=False)
+    bigwig = os.path.join(ROOT, "bigwig2_X_2.5e6_3.5e6.bw")
+    with open(ini_file.name, 'w') as fh:
+        fh.write(f"[bw mean]\nfile = {bigwig}\nnans_to_zeros = true\n\n"
+                 f"[bw max]\nfile = {bigwig}\nsummary_method = max\n\n"
+                 f"[bw diff]\nfile = {bigwig}\nsecond_file = {bigwig}\n"
+                 "operation = file - second_file\n")
+    trp = PlotTracks(ini_file.name, plot_regions=[get_region("X:2700000-3100000")])
+    # All sections use the same handle
+    readers = [track.bw for track in trp.track_obj_list] + [trp.track_obj_list[2].bw2]
+    assert all(reader is readers[0] for reader in readers)
+    # The stats already computed are not computed again
+    # and can be modified by the tracks
+    stats = readers[0].stats('X', 2700000, 3100000, nBins=10)
+    stats[:] = 0
+    assert len(readers[0].stats_cache) == 1
+    assert np.any(readers[0].stats('X', 2700000, 3100000, nBins=10) != 0)
+    trp.close_files()
+    assert readers[0].bw is None
+    os.remove(ini_file.name)
+
+
+def test_bigwig_zoom_levels(caplog):
+    bigwig = os.path.join(ROOT, "bigwig2_X_2.5e6_3.5e6.bw")
+    reader = BigWigReader(bigwig)
+    assert reader.zoom_levels() == [400, 1600, 6400, 25600, 102400, 409600, 1638400]
+    chrom_size = reader.chroms()['X']
+    # The coarsest level with at least 2 records per bin
+    assert reader.zoom_level(0, chrom_size, 700) == 6400
+    assert reader.zoom_level(2700000, 2701000, 700) is None
+    # The values are the ones of pyBigWig
+    for start, end, summary_method in [(0, chrom_size, 'mean'),
+                                       (0, chrom_size, 'max'),
+                                       (2000000, 3000000, 'coverage'),
+                                       (2700000, 2701000, 'mean')]:
+        np.testing.assert_allclose(reader.stats('X', start, end, 700, summary_method,
+                                                use_zoom_levels=True),
+                                   reader.stats('X', start, end, 700, summary_method),
+                                   rtol=1e-5)
+    # The zoom level used is reported in the log
+    with caplog.at_level(logging.DEBUG, logger='pygenometracks.utilities'):
+        reader.stats('X', 0, chrom_size, 699, use_zoom_levels=True)
+        reader.stats('X', 2700000, 2701000, 699, use_zoom_levels=True)
+    assert f"with 6400 bases per record is used for X:0-{chrom_size}" in caplog.text
+    assert "X:2700000-2701000, the raw data is used" in caplog.text
+    reader.close()
+    # The sums are not computed from the zoom levels
+    ini_file = NamedTemporaryFile(suffix='.ini', prefix='pgt_test_', delete=False)
+    with open(ini_file.name, 'w') as fh:
+        fh.write(f"[bw]\nfile = {bigwig}\nsummary_method = sum\n"
+                 "use_zoom_levels = true\n")
+    trp = PlotTracks(ini_file.name, plot_regions=[get_region("X:2700000-3100000")])
+    assert not trp.track_obj_list[0].properties['use_zoom_levels']
+    trp.close_files()
+    os.remove(ini_file.name)
+
+
+def test_bigwig_reader_processes():
+    bigwig = os.path.join(ROOT, "bigwig2_X_2.5e6_3.5e6.bw")
+    reader = BigWigReader(bigwig)
+    expected = reader.stats('X', 2700000, 3100000, nBins=10)
+    # In a forked process the reader opens its own handle
+    parent_handle = reader.bw
+    reader.pid = -1
+    assert reader.chroms() == {'X': 22422827}
+    assert reader.bw is not parent_handle
+    assert reader.pid == os.getpid()
+    # All the summary methods of the bigwig tracks are supported
+    np.testing.assert_allclose(reader.stats('X', 2700000, 3100000, nBins=10,
+                                            type='average'), expected)
+    np.testing.assert_allclose(reader.stats('X', 2700000, 3100000, nBins=10,
+                                            type='stdev'),
+                               reader.stats('X', 2700000, 3100000, nBins=10,
+                                            type='dev'))
+    reader.close()
+    # The lock of the pool may have been held when the process was forked
+    pool = BigWigPool()
+    pool.lock.acquire()
+    pool.pid = -1
+    assert pool.get(bigwig).chroms() == {'X': 22422827}
+    assert pool.pid == os.getpid()
+    pool.close()
+    # The errors are not hidden
+    ini_file = NamedTemporaryFile(suffix='.ini', prefix='pgt_test_', delete=False)
+    with open(ini_file.name, 'w') as fh:
+        fh.write(f"[bw]\nfile = {bigwig}\n")
+    trp = PlotTracks(ini_file.name, plot_regions=[get_region("X:2700000-3100000")])
+    with pytest.raises(InputError, match="could not be read on X:3100000-2700000"):
+        trp.track_obj_list[0].get_scores('self.bw', bigwig, 'X', 3100000, 2700000)
+    trp.close_files()
+    os.remove(ini_file.name)
+
+
+def test_bigwig_region_at_chromosome_end():
+    # A region starting at the end of the chromosome gives an empty track
+    bigwig = os.path.join(ROOT, "bigwig2_X_2.5e6_3.5e6.bw")
+    ini_file = NamedTemporaryFile(suffix='.ini', prefix='pgt_test_', delete=False)
+    with open(ini_file.name, 'w') as fh:
+        fh.write(f"[bw]\nfile = {bigwig}\n\n"
+                 f"[bw operation]\nfile = {bigwig}\nsecond_file = {bigwig}\n"
+                 "operation = file - second_file\n")
+    chrom_size = 22422827
+    region = ('X', chrom_size, chrom_size + 100000)
+    trp = PlotTracks(ini_file.name, plot_regions=[region])
+    for track in trp.track_obj_list:
+        end_region, nbins, scores = track.get_scores('self.bw', bigwig, *region)
+        assert (end_region, nbins) == (region[2], 700)
+        assert np.all(np.isnan(scores))
+    trp.close_files()
+    outfile = NamedTemporaryFile(suffix='.png', prefix='pgt_test_', delete=False)
+    args = f"--tracks {ini_file.name} --region X:{region[1]}-{region[2]} "\
+           f"--outFileName {outfile.name}".split()
+    pygenometracks.plotTracks.main(args)
+    os.remove(ini_file.name)
+    os.remove(outfile.name)
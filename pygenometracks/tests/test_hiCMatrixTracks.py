@@ -6,6 +6,10 @@ import os.path
 import shutil
 import pygenometracks.plotTracks
 import sys
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from pygenometracks.tracksClass import PlotTracks
+from pygenometracks.tracks.HiCMatrixTrack import HiCMatrixTrack
 
 ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
                     "test_data")
@@ -248,6 +252,59 @@ file_type = hic_matrix
 with open(os.path.join(ROOT, "mcool.ini"), 'w') as fh:
     fh.write(browser_tracks_with_mcool)
 
+with open(os.path.join(ROOT, "mcool_image.ini"), 'w') as fh:
+    fh.write(browser_tracks_with_mcool.replace("file_type = hic_matrix",
+                                               "file_type = hic_matrix\nrenderer = image"))
+
+browser_tracks_with_mcool_max_bins = """
+[x-axis]
+
+[mcool default]
+file = matrix.mcool
+title = matrix.mcool (40kb)
+depth = 1000000
+file_type = hic_matrix
+
+[mcool 5 bins]
+file = matrix.mcool
+title = matrix.mcool max_bins = 5 (320kb)
+depth = 1000000
+max_bins = 5
+file_type = hic_matrix
+
+[mcool 15 bins]
+file = matrix.mcool
+title = matrix.mcool max_bins = 15 (80kb)
+depth = 1000000
+max_bins = 15
+file_type = hic_matrix
+"""
+
+with open(os.path.join(ROOT, "mcool_max_bins.ini"), 'w') as fh:
+    fh.write(browser_tracks_with_mcool_max_bins)
+
+browser_tracks_with_mcool_min_max_from = """
+[x-axis]
+
+[mcool region]
+file = matrix.mcool::/4
+title = min_max_from = region (default)
+depth = 1000000
+transform = log1p
+file_type = hic_matrix
+
+[mcool matrix]
+file = matrix.mcool::/4
+title = min_max_from = matrix
+depth = 1000000
+transform = log1p
+min_max_from = matrix
+file_type = hic_matrix
+"""
+
+with open(os.path.join(ROOT, "mcool_min_max_from.ini"), 'w') as fh:
+    fh.write(browser_tracks_with_mcool_min_max_from)
+
 browser_tracks_with_hic_small_2 = """
 [hic matrix]
 file = small_test2.cool
@@ -721,6 +778,93 @@ def test_plot_tracks_with_mcool():
     os.remove(outfile.name)
 
 
+def test_plot_tracks_with_mcool_image():
+
+    outfile = NamedTemporaryFile(suffix='.png', prefix='pyGenomeTracks_test_',
+                                 delete=False)
+    args = "--tracks {0} --region X:2500000-3500000 "\
+           "--trackLabelFraction 0.23 --width 38 " \
+           "--dpi 130 --outFileName {1}" \
+           "".format(os.path.join(ROOT,
+                                  'mcool_image.ini'),
+                     outfile.name).split()
+    pygenometracks.plotTracks.main(args)
+    res = compare_images(os.path.join(ROOT,
+                                      'master_mcool_image.png'),
+                         outfile.name, tolerance)
+    assert res is None, res
+
+    os.remove(outfile.name)
+
+
+def test_plot_tracks_with_mcool_max_bins():
+
+    outfile = NamedTemporaryFile(suffix='.png', prefix='pyGenomeTracks_test_',
+                                 delete=False)
+    args = "--tracks {0} --region X:2500000-3500000 "\
+           "--trackLabelFraction 0.23 --width 38 " \
+           "--dpi 130 --outFileName {1}" \
+           "".format(os.path.join(ROOT,
+                                  'mcool_max_bins.ini'),
+                     outfile.name).split()
+    pygenometracks.plotTracks.main(args)
+    res = compare_images(os.path.join(ROOT,
+                                      'master_mcool_max_bins.png'),
+                         outfile.name, tolerance)
+    assert res is None, res
+
+    os.remove(outfile.name)
+
+
+def test_plot_tracks_with_mcool_min_max_from():
+
+    outfile = NamedTemporaryFile(suffix='.png', prefix='pyGenomeTracks_test_',
+                                 delete=False)
+    args = "--tracks {0} --region X:2500000-3500000 "\
+           "--trackLabelFraction 0.23 --width 38 " \
+           "--dpi 130 --outFileName {1}" \
+           "".format(os.path.join(ROOT,
+                                  'mcool_min_max_from.ini'),
+                     outfile.name).split()
+    pygenometracks.plotTracks.main(args)
+    res = compare_images(os.path.join(ROOT,
+                                      'master_mcool_min_max_from.png'),
+                         outfile.name, tolerance)
+    assert res is None, res
+
+    os.remove(outfile.name)
+
+
+def test_plot_tracks_with_mcool_min_max_from_bed():
+    # With min_max_from = matrix, the scale does not depend
+    # on the other regions plotted
+    extension = '.png'
+    region_str = 'X-2500000-3500000'
+    for other_region in ['X\t5000000\t6000000\n', '2L\t1000000\t2000000\n']:
+        bed_file = NamedTemporaryFile(suffix='.bed', prefix='pgt_test_',
+                                      delete=False, mode='w')
+        bed_file.write('X\t2500000\t3500000\n' + other_region)
+        bed_file.close()
+        outfile = NamedTemporaryFile(suffix=extension, prefix='pyGenomeTracks_test_',
+                                     delete=False)
+        args = "--tracks {0} --BED {1} "\
+               "--trackLabelFraction 0.23 --width 38 " \
+               "--dpi 130 --outFileName {2}" \
+               "".format(os.path.join(ROOT,
+                                      'mcool_min_max_from.ini'),
+                         bed_file.name, outfile.name).split()
+        pygenometracks.plotTracks.main(args)
+        output_file = outfile.name[:-4] + '_' + region_str + extension
+        res = compare_images(os.path.join(ROOT,
+                                          'master_mcool_min_max_from.png'),
+                             output_file, tolerance)
+        assert res is None, res
+
+        os.remove(output_file)
+        os.remove(outfile.name[:-4] + '_' + other_region.strip().replace('\t', '-') + extension)
+        os.remove(bed_file.name)
+
+
 def test_plot_tracks_with_hic_one_interaction_cool():
     extension = '.png'
 
@@ -744,6 +888,53 @@ def test_plot_tracks_with_hic_one_interaction_cool():
         os.remove(output_file)
 
 
+def test_plot_tracks_with_hic_one_interaction_cool_lazy_loading():
+    extension = '.png'
+
+    outfile = NamedTemporaryFile(suffix=extension, prefix='pyGenomeTracks_test_',
+                                 delete=False)
+    ini_file = os.path.join(ROOT, "browser_tracks_hic_one_interaction_cool.ini")
+    bed_file = os.path.join(ROOT, 'regions_chr1XY.bed')
+    args = f"--tracks {ini_file} --BED {bed_file} "\
+           "--trackLabelFraction 0.23 --width 38 --lazyLoading "\
+           f"--outFileName {outfile.name}".split()
+    pygenometracks.plotTracks.main(args)
+    for region in ['chr1:0-500000', 'chrX:2500000-2600000', 'chrY:0-1000000']:
+        region_str = region.replace(':', '-')
+        output_file = outfile.name[:-4] + '_' + region_str + extension
+        expected_file = os.path.join(ROOT, 'master_plot_hic_one_interaction_withBED_'
+                                     + region_str + extension)
+        res = compare_images(expected_file,
+                             output_file, tolerance)
+        assert res is None, res
+
+        os.remove(output_file)
+
+
+def test_plot_tracks_with_hic_one_interaction_cool_prefetch():
+    extension = '.png'
+
+    outfile = NamedTemporaryFile(suffix=extension, prefix='pyGenomeTracks_test_',
+                                 delete=False)
+    ini_file = os.path.join(ROOT, "browser_tracks_hic_one_interaction_cool.ini")
+    bed_file = os.path.join(ROOT, 'regions_chr1XY.bed')
+    args = f"--tracks {ini_file} --BED {bed_file} "\
+           "--trackLabelFraction 0.23 --width 38 "\
+           "--prefetchDepth 1 --fetchThreads 2 "\
+           f"--outFileName {outfile.name}".split()
+    pygenometracks.plotTracks.main(args)
+    for region in ['chr1:0-500000', 'chrX:2500000-2600000', 'chrY:0-1000000']:
+        region_str = region.replace(':', '-')
+        output_file = outfile.name[:-4] + '_' + region_str + extension
+        expected_file = os.path.join(ROOT, 'master_plot_hic_one_interaction_withBED_'
+                                     + region_str + extension)
+        res = compare_images(expected_file,
+                             output_file, tolerance)
+        assert res is None, res
+
+        os.remove(output_file)
+
+
 def test_plot_tracks_with_hic_one_interaction_h5():
     extension = '.png'
 
@@ -899,3 +1090,124 @@ def test_plot_tracks_with_hic_force_scale():
     assert res is None, res
 
     os.remove(outfile.name)
+
+
+def test_prefetch_data_concurrent_regions():
+    # The data prefetched for two regions at the same time
+    # are the same as the data read one region after the other
+    ini_file = os.path.join(ROOT, "browser_tracks_hic_one_interaction_cool.ini")
+    regions = [('chr1', 0, 500000), ('chrX', 2500000, 2600000),
+               ('chrY', 0, 1000000)]
+    serial_trp = PlotTracks(ini_file, plot_regions=regions)
+    concurrent_trp = PlotTracks(ini_file, plot_regions=regions)
+    for serial_track, track in zip(serial_trp.track_obj_list,
+                                   concurrent_trp.track_obj_list):
+        with ThreadPoolExecutor(max_workers=len(regions)) as executor:
+            futures = [executor.submit(track.prefetch_data, *region)
+                       for region in regions]
+            for future in futures:
+                future.result()
+        for region in regions:
+            data = track.get_data(*region)
+            expected_data = serial_track.get_data(*region)
+            if not isinstance(track, HiCMatrixTrack):
+                assert data is None and expected_data is None
+                continue
+            (hic_ma, chrom_sizes, bin_starts, bin_ends), summary = data
+            (expected_hic_ma, expected_chrom_sizes,
+             expected_bin_starts, expected_bin_ends), expected_summary = expected_data
+            assert (hic_ma.matrix != expected_hic_ma.matrix).nnz == 0
+            assert chrom_sizes == expected_chrom_sizes
+            np.testing.assert_array_equal(bin_starts, expected_bin_starts)
+            np.testing.assert_array_equal(bin_ends, expected_bin_ends)
+            assert summary == expected_summary
+
+
+def test_hic_bins_in_region_and_45deg_mesh():
+    ini_file = NamedTemporaryFile(suffix='.ini', prefix='pgt_test_', delete=False)
+    with open(ini_file.name, 'w') as fh:
+        fh.write(f"[hic]\nfile = {os.path.join(ROOT, 'matrix.mcool')}::/1\n"
+                 "depth = 1000000\nfile_type = hic_matrix\n")
+    region = ('chrX', 3000000, 8000000)
+    trp = PlotTracks(ini_file.name, plot_regions=[region])
+    track = trp.track_obj_list[0]
+    track.use_region_data(*region)
+    # The bins selected are the ones of the chromosome inside the region
+    for start_bp, end_bp in [(3000000, 8000000), (3123456, 6543210),
+                             (0, 10 ** 9), (4000000, 4000001)]:
+        idx, start_pos = track.get_bins_in_region('chrX', start_bp, end_bp)
+        expected = [i for i, (chrom, start, end, __) in enumerate(track.hic_ma.cut_intervals)
+                    if chrom == 'chrX' and start >= start_bp and end <= end_bp]
+        assert idx.tolist() == expected
+        if len(expected) == 0:
+            assert start_pos is None
+        else:
+            assert list(start_pos) == [track.hic_ma.cut_intervals[i][1] for i in expected] + \
+                [track.hic_ma.cut_intervals[expected[-1]][2]]
+    trp.close_files()
+    os.remove(ini_file.name)
+
+    # Each pixel of the mesh turned 45 degrees is at the position
+    # of its bins and has the value of the matrix
+    n, number_of_diagonals, depth = 150, 4, 5
+    rng = np.random.default_rng(0)
+    start_pos = np.concatenate([[0], np.cumsum(rng.integers(1, 3, n))]).astype(float)
+    band = rng.random((n, number_of_diagonals))
+    fig, ax = mpl.pyplot.subplots()
+    track.current_norm = None
+    images = track.pcolormesh_45deg(ax, band, start_pos, depth, outside_value=-1)
+    assert len(images) == 3
+    pixels = {}
+    for img in images:
+        coordinates = img.get_coordinates()
+        values = img.get_array().reshape(coordinates.shape[0] - 1,
+                                         coordinates.shape[1] - 1)
+        # the lower corner of each pixel is (start of row, start of column)
+        x, y = coordinates[1:, :-1, 0], coordinates[1:, :-1, 1]
+        rows = np.searchsorted(start_pos, x - y / 2)
+        cols = np.searchsorted(start_pos, x + y / 2)
+        for row, col, value in zip(rows.ravel(), cols.ravel(), values.ravel()):
+            pixels[(row, col)] = value
+    for row in range(n):
+        for col in range(row, n):
+            if col - row < number_of_diagonals:
+                assert pixels[(row, col)] == band[row, col - row]
+            elif start_pos[col] - start_pos[row + 1] < depth:
+                assert pixels[(row, col)] == -1
+    mpl.pyplot.close(fig)
+
+
+def test_matrix_summary_computed_once_for_workers():
+    # The summary used with min_max_from = matrix is computed
+    # by the parent and the workers only load their regions
+    ini_file = os.path.join(ROOT, "mcool_min_max_from.ini")
+    regions = [('X', 2500000, 3500000), ('X', 5000000, 6000000)]
+    parent_trp = PlotTracks(ini_file, plot_regions=regions, lazy_loading=True)
+    run_data = parent_trp.compute_run_data()
+    assert len(run_data) == 1
+    summary = list(run_data.values())[0]
+    worker_trp = PlotTracks(ini_file, plot_regions=regions, run_data=run_data)
+    track = worker_trp.track_obj_list[2]
+    assert track.properties['min_max_from'] == 'matrix'
+    loaded_regions = []
+    load_window = track.load_window
+
+    def counting_load_window(region, matrix_file):
+        loaded_regions.append(region)
+        return load_window(region, matrix_file)
+
+    track.load_window = counting_load_window
+    for region in regions:
+        track.use_region_data(*region)
+        assert track.matrix_summary is summary
+    assert len(loaded_regions) == len(regions)
+    worker_trp.close_files()
+    # The summaries are also computed to fill the main diagonal
+    # of the matrices without main diagonal
+    ini_file = os.path.join(ROOT, "browser_tracks_hic_one_interaction_cool.ini")
+    regions = [('chr1', 0, 500000), ('chrX', 2500000, 2600000)]
+    parent_trp = PlotTracks(ini_file, plot_regions=regions, lazy_loading=True)
+    run_data = parent_trp.compute_run_data()
+    assert len(run_data) == 3
+    for summary in run_data.values():
+        assert summary['main_diagonal_value'] is not None
@@ -5,6 +5,8 @@ from matplotlib.testing.compare import compare_images
 from tempfile import NamedTemporaryFile
 import os.path
 import pygenometracks.plotTracks
+from pygenometracks.readBed import ReadBed
+from pygenometracks.utilities import opener
 
 
 ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
@@ -358,3 +360,21 @@ def test_plot_tracks_bed_invalid_zero_block():
     else:
         raise Exception("invalid_zero_block should fail.")
     os.remove(ini_file)
+
+
+def test_read_bed_by_chunks():
+    # The intervals must be the same whether the lines
+    # are converted by chunks or one by one (chunks of one line)
+    for bed_file in ["dm3_genes.bed.gz", "dm3_genes.bed4.gz",
+                     "dm3_genes.bed6.gz", "hoxd_genes_rgb.bed.gz",
+                     "filtered.results.bed", "strange_strand.bed",
+                     "invalid_strand.bed", "invalid_rgb.bed",
+                     "invalid_rgb2.bed", "invalid_blockCount.bed",
+                     "invalid_CDScoo.bed", "invalid_score.bed"]:
+        file_name = os.path.join(ROOT, bed_file)
+        with opener(file_name) as fh:
+            intervals = list(ReadBed(fh))
+        with opener(file_name) as fh:
+            intervals_by_line = list(ReadBed(fh, chunk_size=1))
+        assert len(intervals) > 0
+        assert intervals == intervals_by_line
@@ -1,5 +1,9 @@
 import unittest
 import os
+import shutil
+import tempfile
+import numpy as np
+import scipy.sparse
 from pygenometracks import utilities
 import matplotlib.pyplot as plt
 
@@ -18,6 +22,11 @@ class FakeAxis:
         return self.vmin, self.vmax
 
 
+def count_lines_in(file_name):
+    with utilities.opener(file_name) as fh:
+        return len(fh.readlines())
+
+
 class TestUilitiesMethods(unittest.TestCase):
 
     def test_to_string_array(self):
@@ -50,6 +59,255 @@ class TestUilitiesMethods(unittest.TestCase):
         utilities.plot_coverage(ax, x_values, score_list, plot_type, size, color, negative_color, alpha, grid)
         assert len(ax.get_children()) == n_children + 1
 
+    def test_interval_index(self):
+        index = utilities.IntervalIndex([10, 0, 5, 30], [20, 100, 8, 40],
+                                        ['b', 'a', 'c', 'd'])
+        assert len(index) == 4
+        assert [iv.data for iv in index[0:5]] == ['a']
+        assert [iv.data for iv in index[8:30]] == ['a', 'b']
+        assert [(iv.begin, iv.end) for iv in index[35:36]] == [(0, 100), (30, 40)]
+        assert index[100:200] == []
+        assert index[20:10] == []
+        assert [iv.data for iv in sorted(index)] == ['a', 'c', 'b', 'd']
+        # Like an IntervalTree, the identical intervals are kept once
+        # and the intervals with the same positions are sorted by data
+        index = utilities.intervals_to_index([(5, 10, [2, 'b']), (0, 3, [1, 'a']),
+                                              (5, 10, [1, 'c']), (0, 3, [1, 'a'])])
+        assert [(iv.begin, iv.end, iv.data) for iv in sorted(index[0:20])] == \
+            [(0, 3, [1, 'a']), (5, 10, [1, 'c']), (5, 10, [2, 'b'])]
+        # The float positions are kept
+        index = utilities.IntervalIndex([1.5, 0], [2.5, 1])
+        assert [(iv.begin, iv.end) for iv in index[2:3]] == [(1.5, 2.5)]
+
+    def test_file_to_intervaltree(self):
+        file_name = os.path.join(ROOT, "bedgraph_withNA.bdg")
+        interval_tree, min_value, max_value = utilities.file_to_intervaltree(file_name)
+        assert list(interval_tree) == ['chrX']
+        intervals = interval_tree['chrX'][0:10000000]
+        assert len(intervals) == 3
+        assert intervals[0].data == ['1']
+        assert min_value == 1
+        assert max_value == 2
+
+    def test_file_to_intervaltree_invalid_line(self):
+        # The line number must be correct
+        # whatever the size of the chunks
+        file_name = os.path.join(ROOT, "invalid_bedgraph3.bdg")
+        for chunk_size in [1, 100, 2 ** 25]:
+            with self.assertRaisesRegex(utilities.InputError,
+                                        "Error reading line: 10. The end field"):
+                utilities.file_to_intervaltree(file_name, chunk_size=chunk_size)
+
+    def test_parse_bed_like_chunk_invalid_integer(self):
+        lines = ["track name=test\n", "chr1\t0\t10\t1\n", "chr1\t1.5\t20\t2\n"]
+        with self.assertRaisesRegex(utilities.InputError,
+                                    "Error reading line: 3. The start field"):
+            utilities.parse_bed_like_chunk(lines, 1, "file.bed")
+
+    def test_parse_bed_like_chunk_empty_interval(self):
+        lines = ["chr1\t0\t10\t1\n", "chr1\t10\t10\t2\n", "chr1\t10\t20\t3\n"]
+        with self.assertRaisesRegex(utilities.InputError,
+                                    "Error reading line: 2 of file.bed. Start position"):
+            utilities.parse_bed_like_chunk(lines, 1, "file.bed")
+        # The rows fetched with tabix skip the empty intervals
+        chroms, starts, ends, values = \
+            utilities.parse_bed_like_chunk(lines, 1, "file.bed", skip_empty=True)
+        assert starts.tolist() == [0, 10]
+        assert ends.tolist() == [10, 20]
+        assert values.tolist() == [['1'], ['3']]
+
+    def test_file_cache(self):
+        cache_dir = tempfile.mkdtemp()
+        file_cache = utilities.FileCache(cache_dir)
+        for file_name in ["bedgraph_withNA.bdg", "tad_classification.bed",
+                          "bedgraph_chrx_2e6_5e6.bg.bgz"]:
+            file_name = os.path.join(ROOT, file_name)
+            expected = utilities.file_to_intervaltree(file_name)
+            # First call parses and stores, second call loads
+            for __ in range(2):
+                interval_tree, min_value, max_value = \
+                    utilities.file_to_intervaltree(file_name, file_cache=file_cache)
+                assert (min_value, max_value) == expected[1:]
+                assert list(interval_tree) == list(expected[0])
+                for chrom in interval_tree:
+                    assert list(interval_tree[chrom]) == list(expected[0][chrom])
+        assert len(os.listdir(cache_dir)) == 3
+        # The parameters are part of the key
+        utilities.file_to_intervaltree(file_name, [('X', 0, 2500000)],
+                                       file_cache=file_cache)
+        assert len(os.listdir(cache_dir)) == 4
+        # Only the most recent file is kept when the cache is too small
+        file_cache.max_size = 0
+        file_cache.evict()
+        assert len(os.listdir(cache_dir)) == 1
+        shutil.rmtree(cache_dir)
+
+    def test_open_intersected(self):
+        file_name = os.path.join(ROOT, "dm3_genes.bed.gz")
+        with utilities.opener(file_name) as fh:
+            all_lines = fh.readlines()
+        # The chromosome name is changed from X to chrX
+        region = ('X', 20000, 30000)
+        with utilities.open_intersected(file_name, [region]) as fh:
+            lines = fh.readlines()
+        expected = [line for line in all_lines
+                    if line.split(b'\t')[0] == b'chrX'
+                    and int(line.split(b'\t')[1]) < region[2]
+                    and int(line.split(b'\t')[2]) > region[1]]
+        assert len(expected) > 0
+        assert lines == expected
+        # around_region extends the region
+        with utilities.open_intersected(file_name, [region], 10000) as fh:
+            assert len(fh.readlines()) > len(expected)
+        # The gtf coordinates are 1-based
+        file_name = os.path.join(ROOT, "HoxD.gtf")
+        with utilities.open_intersected(file_name, [('chr2', 0, 1)], gtf=True) as fh:
+            assert fh.readlines() == []
+        with utilities.open_intersected(file_name, [('chr2', 0, 10 ** 9)], gtf=True) as fh:
+            assert len(fh.readlines()) == count_lines_in(file_name)
+
+    def test_open_intersected_invalid(self):
+        # When a line can not be parsed the whole file is used
+        file_name = os.path.join(ROOT, "invalid_bedgraph2.bdg")
+        with utilities.open_intersected(file_name, [('chrX', 0, 1)]) as fh:
+            assert len(fh.readlines()) == count_lines_in(file_name)
+
+    def test_group_nearby_regions(self):
+        regions = [('chrX', 500, 600), ('chr2', 0, 100), ('chrX', 0, 100),
+                   ('chrX', 150, 300), ('chr2', 0, 100)]
+        assert utilities.group_nearby_regions(regions) == \
+            [[('chrX', 0, 100), ('chrX', 150, 300), ('chrX', 500, 600)],
+             [('chr2', 0, 100), ('chr2', 0, 100)]]
+        assert utilities.group_nearby_regions(regions, max_gap=50) == \
+            [[('chrX', 0, 100), ('chrX', 150, 300)], [('chrX', 500, 600)],
+             [('chr2', 0, 100), ('chr2', 0, 100)]]
+        assert utilities.group_nearby_regions(regions, max_gap=0) == \
+            [[('chrX', 0, 100)], [('chrX', 150, 300)], [('chrX', 500, 600)],
+             [('chr2', 0, 100), ('chr2', 0, 100)]]
+
+    def test_summarize_in_bins(self):
+        starts = [0, 10, 20]
+        ends = [10, 20, 30]
+        values = [1, 2, 4]
+        expected = {'mean': [4 / 3, 10 / 3], 'max': [2, 4], 'min': [1, 2],
+                    'sum': [20, 50], 'coverage': [1, 1],
+                    'stdev': [0.48795, 0.97590]}
+        for summary_method, expected_scores in expected.items():
+            scores = utilities.summarize_in_bins(starts, ends, values, 0, 30,
+                                                 2, summary_method)
+            np.testing.assert_allclose(scores, expected_scores, rtol=1e-5)
+        # Bins without interval are nan
+        scores = utilities.summarize_in_bins(starts, ends, values, 0, 40, 4,
+                                             'coverage')
+        np.testing.assert_allclose(scores, [1, 1, 1, np.nan])
+
+    def test_summarize_zoom_records(self):
+        # The second record is split between the 2 first bins
+        records = np.array([(0, 0, 10, 10, 1, 1, 10, 10),
+                            (0, 10, 30, 10, 2, 4, 30, 100)],
+                           dtype=utilities.BIGWIG_ZOOM_RECORD)
+        expected = {'mean': [25 / 15, 3, np.nan], 'max': [4, 4, np.nan],
+                    'min': [1, 2, np.nan], 'sum': [25, 15, np.nan],
+                    'coverage': [0.75, 0.25, np.nan]}
+        for summary_method, expected_scores in expected.items():
+            scores = utilities.summarize_zoom_records(records, 0, 60, 3,
+                                                      summary_method)
+            np.testing.assert_allclose(scores, expected_scores)
+
+    def test_interpolate_on(self):
+        x_values = [10, 20, 40]
+        scores = [1, 2, 0]
+        new_x = [5, 10, 15, 30, 40, 45]
+        np.testing.assert_allclose(utilities.interpolate_on(new_x, x_values, scores),
+                                   [np.nan, 1, 1.5, 1, 0, np.nan])
+        assert np.isnan(utilities.interpolate_on(new_x, [], [])).all()
+
+    def test_sparse_to_band(self):
+        dense = np.array([[1, 2, 0, 4],
+                          [0, 5, 6, 0],
+                          [9, 0, 7, 8],
+                          [0, 0, 0, 3]], dtype=float)
+        band = utilities.sparse_to_band(scipy.sparse.csr_matrix(dense), 2)
+        np.testing.assert_array_equal(band, [[1, 2], [5, 6], [7, 8], [3, 0]])
+        rows, offsets, values = utilities.sparse_band_values(scipy.sparse.csr_matrix(dense), 2)
+        np.testing.assert_array_equal(rows, [0, 0, 1, 1, 2, 2, 3])
+        np.testing.assert_array_equal(offsets, [0, 1, 0, 1, 0, 1, 0])
+        np.testing.assert_array_equal(values, [1, 2, 5, 6, 7, 8, 3])
+        for offset in range(4):
+            np.testing.assert_array_equal(utilities.band_diagonal(band, offset),
+                                          np.diag(dense, offset) if offset < 2
+                                          else np.zeros(4 - offset))
+        np.testing.assert_array_equal(utilities.band_diagonal(band, 3, -1), [-1])
+        assert len(utilities.band_diagonal(band, 5)) == 0
+
+    def test_sparse_upper_band(self):
+        dense = np.array([[0, 2, 0, 4],
+                          [1, 0, 6, 0],
+                          [9, 0, 0, 8],
+                          [0, 5, 0, 0]], dtype=float)
+        matrix = utilities.sparse_upper_band(scipy.sparse.csr_matrix(dense), 2)
+        expected = np.triu(dense) - np.triu(dense, 2)
+        np.testing.assert_array_equal(matrix.toarray(), expected)
+        matrix = utilities.fill_main_diagonal(matrix, 10)
+        np.testing.assert_array_equal(matrix.toarray(), expected + 10 * np.eye(4))
+        assert matrix.has_sorted_indices
+        matrix = utilities.fill_main_diagonal(matrix, 1)
+        np.testing.assert_array_equal(matrix.toarray(), expected + 11 * np.eye(4))
+
+    def test_diagonal_stats(self):
+        first = np.array([[1, 2, 0],
+                          [0, 0, -3],
+                          [0, 0, 7]], dtype=float)
+        second = np.array([[4, 5],
+                           [0, 0]], dtype=float)
+        stats = utilities.DiagonalStats([0, 1, 2, 3])
+        stats.add(scipy.sparse.csr_matrix(first))
+        stats.add(scipy.sparse.csr_matrix(second))
+        for offset in range(3):
+            values = np.concatenate([np.diag(first, offset),
+                                     np.diag(second, offset)])
+            for q in [0, 20, 50, 80, 100]:
+                self.assertAlmostEqual(stats.percentile(offset, q),
+                                       np.percentile(values, q))
+        assert stats.percentile(3, 50) is None
+        # The rows of an overlapping matrix already added are skipped
+        overlapping = np.array([[0, -3, 1, 0],
+                                [0, 7, 0, 2],
+                                [0, 0, 8, 9],
+                                [0, 0, 0, 6]], dtype=float)
+        stats = utilities.DiagonalStats([0, 1])
+        stats.add(scipy.sparse.csr_matrix(first))
+        stats.add(scipy.sparse.csr_matrix(overlapping), first_row=2)
+        for offset in range(2):
+            values = np.concatenate([np.diag(first, offset),
+                                     np.diag(overlapping[2:, 2:], offset)])
+            for q in [0, 50, 100]:
+                self.assertAlmostEqual(stats.percentile(offset, q),
+                                       np.percentile(values, q))
+
+    def test_compile_operation(self):
+        file = np.array([1, np.nan, 3])
+        second_file = np.array([2, 1, np.nan])
+        operation = utilities.compile_operation("log2((1 + file) / (1 + second_file))")
+        np.testing.assert_allclose(operation(file, second_file),
+                                   [np.log2(2 / 3), np.nan, np.nan])
+        # max and min behave like the python ones with nan
+        operation = utilities.compile_operation("max(file, second_file)")
+        np.testing.assert_allclose(operation(file, second_file), [2, np.nan, 3])
+        operation = utilities.compile_operation("- 0.5 * file + 1e1")
+        np.testing.assert_allclose(operation(file), [9.5, np.nan, 8.5])
+        operation = utilities.compile_operation("file // 2 + second_file / 4")
+        np.testing.assert_allclose(operation(file, second_file), [0.5, np.nan, np.nan])
+        # As with the python floats, dividing by zero raises an error
+        for operation in ["file / (second_file - 1)", "1 // (file - 1)"]:
+            with self.assertRaises(ZeroDivisionError):
+                utilities.compile_operation(operation)(file, second_file)
+        for operation in ["quit()", "file.real", "file[0]", "x * file",
+                          "max(file, key=1)", "'file'", "file + 0.0.0",
+                          "file % 2", "_divide(file, 2)"]:
+            with self.assertRaises(utilities.InputError):
+                utilities.compile_operation(operation)
+
 
 class TestFormatter(unittest.TestCase):
 
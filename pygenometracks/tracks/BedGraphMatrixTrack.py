@@ -105,12 +105,15 @@ file_type = {TRACK_TYPE}
             for param in ['individual_color', 'summary_color']:
                 self.process_color(param, colormap_possible=False)
 
+    def fetch_data(self, chrom_region, start_region, end_region):
+        return self.get_scores(chrom_region, start_region, end_region)
+
     def plot(self, ax, chrom_region, start_region, end_region):
         """
         Plots a bedgraph matrix file, that instead of having
         a single value per bin, it has several values.
         """
-        values_list, start_pos = self.get_scores(chrom_region, start_region, end_region)
+        values_list, start_pos = self.get_data(chrom_region, start_region, end_region)
         if start_pos == []:
             self.adjust_ylim(ax)
             return
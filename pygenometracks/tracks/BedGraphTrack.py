@@ -1,9 +1,6 @@
 from . GenomeTrack import GenomeTrack
-from .. utilities import file_to_intervaltree, plot_coverage, InputError, transform, change_chrom_names
+from .. utilities import file_to_intervaltree, plot_coverage, InputError, transform, change_chrom_names, summarize_in_bins, parse_bed_like_chunk, to_string, interpolate_on
 import numpy as np
-import pyBigWig
-import tempfile
-import os
 import pysam
 
 DEFAULT_BEDGRAPH_COLOR = '#a6cee3'
@@ -147,8 +144,12 @@ file_type = {TRACK_TYPE}
                     self.tbx2 = pysam.TabixFile(self.properties['second_file'])
                 except IOError:
                     # load the file as an interval tree
-                    self.interval_tree2, __, __ = file_to_intervaltree(self.properties['second_file'],
-                                                                       self.properties['region'])
+                    self.interval_tree2, __, __ = \
+                        self.get_shared_data(('file_to_intervaltree', self.properties['second_file'],
+                                              self.properties['region']),
+                                             lambda: file_to_intervaltree(self.properties['second_file'],
+                                                                          self.properties['region'],
+                                                                          file_cache=self.properties.get('file_cache')))
 
     def set_properties_defaults(self):
         super(BedGraphTrack, self).set_properties_defaults()
@@ -191,8 +192,12 @@ file_type = {TRACK_TYPE}
             self.tbx = pysam.TabixFile(self.properties['file'])
         except IOError:
             # load the file as an interval tree
-            self.interval_tree, __, __ = file_to_intervaltree(self.properties['file'],
-                                                              self.properties['region'])
+            self.interval_tree, __, __ = \
+                self.get_shared_data(('file_to_intervaltree', self.properties['file'],
+                                      self.properties['region']),
+                                     lambda: file_to_intervaltree(self.properties['file'],
+                                                                  self.properties['region'],
+                                                                  file_cache=self.properties.get('file_cache')))
 
         self.num_fields = None
 
@@ -245,35 +250,14 @@ file_type = {TRACK_TYPE}
         score_list = []
         pos_list = []
         tbx = eval(tbx_var)
+        inttree = eval(inttree_var) if tbx is None else None
+        chrom_region = self._check_chrom_name(chrom_region, start_region,
+                                              end_region, tbx, inttree)
+        if chrom_region is None:
+            return score_list, pos_list
         if tbx is not None:
-            if chrom_region not in tbx.contigs:
-                chrom_region_before = chrom_region
-                chrom_region = change_chrom_names(chrom_region)
-                if chrom_region not in tbx.contigs:
-                    self.log.warning("*Warning*\nNeither "
-                                     + chrom_region_before + " nor "
-                                     + chrom_region + " exists as a "
-                                     "chromosome name inside the bedgraph "
-                                     "file. This will generate an empty "
-                                     "track!!\n")
-                    return score_list, pos_list
-
             iterator = tbx.fetch(chrom_region, start_region, end_region)
-
         else:
-            inttree = eval(inttree_var)
-            if chrom_region not in list(inttree):
-                chrom_region_before = chrom_region
-                chrom_region = change_chrom_names(chrom_region)
-                if chrom_region not in list(inttree):
-                    self.log.warning("*Warning*\nNo interval was found when "
-                                     "overlapping with both "
-                                     f"{chrom_region_before}:{start_region}-{end_region}"
-                                     f" and {chrom_region}:{start_region}-{end_region}"
-                                     " inside the bedgraph file. "
-                                     "This will generate an empty "
-                                     "track!!\n")
-                    return score_list, pos_list
             iterator = iter(sorted(inttree[chrom_region][start_region - 10000:end_region + 10000]))
 
         prev_end = start_region
@@ -299,129 +283,173 @@ file_type = {TRACK_TYPE}
 
         return score_list, pos_list
 
+    def _check_chrom_name(self, chrom_region, start_region, end_region,
+                          tbx, inttree):
+        """
+        Returns the name of chrom_region used in the file
+        (chrom_region or its alternative name) or None
+        if it is not in the file.
+        """
+        if tbx is not None:
+            chrom_names = tbx.contigs
+        else:
+            chrom_names = list(inttree)
+        if chrom_region in chrom_names:
+            return chrom_region
+        chrom_region_before = chrom_region
+        chrom_region = change_chrom_names(chrom_region)
+        if chrom_region in chrom_names:
+            return chrom_region
+        if tbx is not None:
+            self.log.warning("*Warning*\nNeither "
+                             + chrom_region_before + " nor "
+                             + chrom_region + " exists as a "
+                             "chromosome name inside the bedgraph "
+                             "file. This will generate an empty "
+                             "track!!\n")
+        else:
+            self.log.warning("*Warning*\nNo interval was found when "
+                             "overlapping with both "
+                             f"{chrom_region_before}:{start_region}-{end_region}"
+                             f" and {chrom_region}:{start_region}-{end_region}"
+                             " inside the bedgraph file. "
+                             "This will generate an empty "
+                             "track!!\n")
+        return None
+
+    def get_scores_as_arrays(self, chrom_region, start_region, end_region,
+                             return_nans=True, tbx_var='self.tbx',
+                             inttree_var='self.interval_tree'):
+        """
+        Same as get_scores but only for the first score of each interval
+        and as arrays. If return_nans is True, the intervals not covered by
+        the file (until at least end_region) are added with a nan score.
+        Args:
+            chrom_region:
+            start_region:
+            end_region:
+        Returns:
+            tuple:
+                starts, ends, scores (arrays, empty if there is no
+                item in the region)
+        """
+        starts = np.array([], dtype=np.int64)
+        ends = np.array([], dtype=np.int64)
+        scores = np.array([], dtype=float)
+        tbx = eval(tbx_var)
+        inttree = eval(inttree_var) if tbx is None else None
+        chrom_region = self._check_chrom_name(chrom_region, start_region,
+                                              end_region, tbx, inttree)
+        if chrom_region is None:
+            return starts, ends, scores
+        if tbx is not None:
+            rows = list(tbx.fetch(chrom_region, start_region, end_region))
+            # The line numbers are not known, the rows
+            # with the same start and end are skipped
+            __, starts, ends, values = \
+                parse_bed_like_chunk(rows, 1, to_string(tbx.filename),
+                                     skip_empty=True)
+        else:
+            index = inttree[chrom_region]
+            indices = index.overlap_indices(start_region - 10000, end_region + 10000)
+            starts = index.starts[indices]
+            ends = index.ends[indices]
+            values = index.data
+            if values is not None:
+                if isinstance(values, np.ndarray):
+                    values = values[indices]
+                else:
+                    values = [values[i] for i in indices]
+        if len(starts) == 0:
+            return starts, ends, scores
+        if isinstance(values, np.ndarray) and values.ndim == 2:
+            scores = values[:, 0]
+        else:
+            scores = np.array([value[0] for value in values])
+        scores = self._scores_to_float(scores)
+
+        if return_nans:
+            # The regions not covered between the intervals
+            # and until end_region are nans
+            prev_ends = np.concatenate(([start_region], ends[:-1]))
+            gaps = np.flatnonzero(prev_ends < starts)
+            starts, ends = np.insert(starts, gaps, prev_ends[gaps]), \
+                np.insert(ends, gaps, starts[gaps])
+            scores = np.insert(scores, gaps, np.nan)
+            if ends[-1] < end_region:
+                starts = np.append(starts, ends[-1])
+                ends = np.append(ends, end_region)
+                scores = np.append(scores, np.nan)
+        return starts, ends, scores
+
+    def _scores_to_float(self, scores):
+        if scores.dtype.kind in 'US':
+            is_na = scores == 'NA'
+            if np.any(is_na):
+                self.log.warning("*Warning*\nNA were found in the bedgraph"
+                                 " will be replaced by nan.\n")
+                scores = np.where(is_na, 'nan', scores)
+        return scores.astype(float)
+
+    def fetch_data(self, chrom_region, start_region, end_region):
+        scores = self.get_scores_as_arrays(chrom_region, start_region, end_region)
+        if self.tbx2 is not None or self.interval_tree2 is not None:
+            scores2 = self.get_scores_as_arrays(chrom_region, start_region, end_region,
+                                                tbx_var='self.tbx2',
+                                                inttree_var='self.interval_tree2')
+        else:
+            scores2 = None
+        return scores, scores2
+
     def plot(self, ax, chrom_region, start_region, end_region):
-        score_list, pos_list = self.get_scores(chrom_region, start_region, end_region)
-        if pos_list == []:
+        (starts, ends, score_list), scores2 = self.get_data(chrom_region,
+                                                            start_region,
+                                                            end_region)
+        if len(starts) == 0:
             self.adjust_ylim(ax)
             return
-        try:
-            score_list = [float(x[0]) for x in score_list]
-        except ValueError as ve:
-            if "could not convert string to float: 'NA'" in str(ve):
-                self.log.warning("*Warning*\nNA were found in the bedgraph"
-                                 " will be replaced by nan.\n")
-                score_list = [float(x[0]) if x[0] != 'NA' else float('nan') for x in score_list]
-            else:
-                raise ve
         if self.properties['use_middle']:
-            x_values = np.asarray([(t[0] + t[1]) / 2
-                                   for i, t in enumerate(pos_list)
-                                   if not np.isnan(score_list[i])],
-                                  dtype=float)
-            score_list = np.asarray([x for x in score_list if not np.isnan(x)],
-                                    dtype=float)
+            not_nan = ~np.isnan(score_list)
+            x_values = ((starts + ends) / 2)[not_nan]
+            score_list = score_list[not_nan]
         elif self.properties['summary_method'] is not None:
-            score_list, x_values = self.get_values_as_bigwig(score_list,
-                                                             pos_list,
-                                                             chrom_region,
-                                                             start_region,
-                                                             end_region)
+            score_list, x_values = self.get_values_in_bins(score_list,
+                                                           starts, ends,
+                                                           start_region,
+                                                           end_region)
         else:
             score_list, x_values = self.get_values_as_bdg(score_list,
-                                                          pos_list)
+                                                          starts, ends)
         # compute the operation
         operation = self.properties['operation']
-        # Substitute log by np.log to make it evaluable:
-        operation = operation.replace('log', 'np.log')
         if operation == 'file':
             pass
         elif 'second_file' not in operation:
-            try:
-                new_score_list = eval('[' + operation + ' for file in score_list]')
-                new_score_list = np.array(new_score_list)
-            except Exception as e:
-                raise Exception("The operation in section "
-                                f"{self.properties['section_name']} could not "
-                                f"be computed: {e}")
-            else:
-                score_list = new_score_list
+            score_list = self.compute_operation(score_list)
 
         else:
-            score_list2, pos_list2 = self.get_scores(chrom_region, start_region, end_region,
-                                                     tbx_var='self.tbx2',
-                                                     inttree_var='self.interval_tree2')
-            if pos_list2 == []:
+            starts2, ends2, score_list2 = scores2
+            if len(starts2) == 0:
                 self.adjust_ylim(ax)
                 return
-            try:
-                score_list2 = [float(x[0]) for x in score_list2]
-            except ValueError as ve:
-                if "could not convert string to float: 'NA'" in str(ve):
-                    self.log.warning("*Warning*\nNA were found in the bedgraph"
-                                     " will be replaced by nan.\n")
-                    score_list2 = [float(x[0]) if x[0] != 'NA' else float('nan') for x in score_list2]
-                else:
-                    raise ve
             if self.properties['use_middle']:
-                x_values2 = np.asarray([(t[0] + t[1]) / 2
-                                        for i, t in enumerate(pos_list2)
-                                        if not np.isnan(score_list2[i])],
-                                       dtype=float)
-                score_list2 = np.asarray([x for x in score_list2 if not np.isnan(x)],
-                                         dtype=float)
-                if not all([x1 == x2 for x1, x2 in zip(x_values, x_values2)]):
-                    # The x are not compatible we need to extrapolate:
-                    new_x = sorted(np.unique(np.concatenate((x_values, x_values2), axis=0)))
-                    new_score_list = []
-                    i = 0
-                    new_score_list2 = []
-                    i2 = 0
-                    for x in new_x:
-                        if x_values[i] == x:
-                            new_score_list.append(score_list[i])
-                            i += 1
-                        elif i == 0:
-                            new_score_list.append(np.nan)
-                        elif i == len(score_list):
-                            new_score_list.append(np.nan)
-                        else:
-                            y1 = score_list[i - 1]
-                            y2 = score_list[i]
-                            x1 = x_values[i - 1]
-                            x2 = x_values[i]
-                            new_score_list.append(y1 + (y2 - y1) * (x - x1) / (x2 - x1))
-                        if x_values2[i2] == x:
-                            new_score_list2.append(score_list2[i2])
-                            i2 += 1
-                        elif i2 == 0:
-                            new_score_list.append(np.nan)
-                        elif i2 == len(score_list):
-                            new_score_list.append(np.nan)
-                        else:
-                            y1 = score_list2[i2 - 1]
-                            y2 = score_list2[i2]
-                            x1 = x_values2[i2 - 1]
-                            x2 = x_values2[i2]
-                            new_score_list2.append(y1 + (y2 - y1) * (x - x1) / (x2 - x1))
-                    x_values = np.array(new_x)
-                    score_list = new_score_list
-                    score_list2 = new_score_list2
+                not_nan = ~np.isnan(score_list2)
+                x_values2 = ((starts2 + ends2) / 2)[not_nan]
+                score_list2 = score_list2[not_nan]
+                if not np.array_equal(x_values, x_values2):
+                    # The x are not compatible we need to interpolate
+                    # each file on all x (nan outside of its range):
+                    new_x = np.union1d(x_values, x_values2)
+                    score_list = interpolate_on(new_x, x_values, score_list)
+                    score_list2 = interpolate_on(new_x, x_values2, score_list2)
+                    x_values = new_x
             else:
-                score_list2, x_values2 = self.get_values_as_bigwig(score_list2,
-                                                                   pos_list2,
-                                                                   chrom_region,
-                                                                   start_region,
-                                                                   end_region)
+                score_list2, x_values2 = self.get_values_in_bins(score_list2,
+                                                                 starts2, ends2,
+                                                                 start_region,
+                                                                 end_region)
             # compute the operation
-            try:
-                new_score_list = eval('[' + operation + ' for file,second_file in zip(score_list, score_list2)]')
-                new_score_list = np.array(new_score_list)
-            except Exception as e:
-                raise Exception("The operation in section "
-                                f"{self.properties['section_name']} could not"
-                                f" be computed: {e}")
-            else:
-                score_list = new_score_list
+            score_list = self.compute_operation(score_list, score_list2)
 
         transformed_scores = transform(score_list,
                                        self.properties['transform'],
@@ -440,30 +468,14 @@ file_type = {TRACK_TYPE}
         if self.properties['rasterize']:
             ax.set_rasterized(True)
 
-    def get_values_as_bigwig(self, score_list, pos_list, chrom_region,
-                             start_region, end_region):
-        # A temporary file is created
-        id, temp_bigwig_file = tempfile.mkstemp(suffix='.bw')
-        # We write into it
-        bw = pyBigWig.open(temp_bigwig_file, 'w')
-        # The list of chromosome size is the name of the current chromosome to
-        # the last position of the pos_list
-        bw.addHeader([(chrom_region, pos_list[-1][1])])
-        # The starts, ends, score are stored
-        bw.addEntries([chrom_region] * len(pos_list),
-                      [p[0] for p in pos_list],
-                      ends=[p[1] for p in pos_list],
-                      values=score_list)
-        bw.close()
-        # The temporary file is opened
-        bw = pyBigWig.open(temp_bigwig_file)
-        # The scores are the summary:
-        scores_per_bin = np.array(bw.stats(chrom_region,
-                                           start_region,
-                                           end_region,
-                                           nBins=self.properties['number_of_bins'],
-                                           type=self.properties['summary_method'])).astype(float)
-        os.remove(temp_bigwig_file)
+    def get_values_in_bins(self, score_list, starts, ends, start_region,
+                           end_region):
+        # The scores are summarized in number_of_bins bins
+        # (like pyBigWig stats do)
+        scores_per_bin = summarize_in_bins(starts, ends, score_list,
+                                           start_region, end_region,
+                                           self.properties['number_of_bins'],
+                                           self.properties['summary_method'])
         if self.properties['nans_to_zeros'] and np.any(np.isnan(scores_per_bin)):
             scores_per_bin[np.isnan(scores_per_bin)] = 0
         x_values = np.linspace(start_region, end_region,
@@ -471,17 +483,16 @@ file_type = {TRACK_TYPE}
 
         return scores_per_bin, x_values
 
-    def get_values_as_bdg(self, score_list, pos_list):
+    def get_values_as_bdg(self, score_list, starts, ends):
         # the following two lines will convert the score_list and the
-        # tuples in pos list (where is item is tuple(start, end)
-        # into an x value (pos_list) and a y value (score_list)
+        # starts and ends into an x value and a y value
         # where x = start1, end1, star2, end2 ...
         # and y = score1, score1, score2, score2 ...
 
         # convert [1, 2, 3 ...] in [1, 1, 2, 2, 3, 3 ...]
         score_list = np.repeat(score_list, 2)
-        # convert [(0, 10), (10, 20), (20, 30)] into [0, 10, 10, 20, 20, 30]
-        x_values = np.asarray(sum(pos_list, tuple()), dtype=float)
+        # convert [0, 10, 20] and [10, 20, 30] into [0, 10, 10, 20, 20, 30]
+        x_values = np.column_stack((starts, ends)).ravel().astype(float)
 
         if self.properties['nans_to_zeros']:
             score_list[np.isnan(score_list)] = 0
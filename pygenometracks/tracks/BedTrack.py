@@ -3,12 +3,11 @@ from .. readBed import ReadBed
 # To remove next 1.0
 from .. readGtf import ReadGtf
 # End to remove
-from .. utilities import opener, get_length_w, count_lines, temp_file_from_intersect, change_chrom_names, InputError
+from .. utilities import opener, get_length_w, count_lines, open_intersected, change_chrom_names, InputError, IntervalIndex, intervals_to_index
 import matplotlib
 from matplotlib import font_manager
 from matplotlib.patches import Rectangle, Polygon, FancyArrowPatch
 from matplotlib.lines import Line2D
-from intervaltree import IntervalTree, Interval
 import numpy as np
 from tqdm import tqdm
 
@@ -201,7 +200,24 @@ file_type = {TRACK_TYPE}
         # this is bed3, bed4, bed5, bed6, bed8, bed9 or bed12
         self.current_len_w = None  # this is the length of the letter 'w' given the font size
         self.interval_tree = {}  # interval tree of the bed regions
-        self.interval_tree, min_score, max_score = self.process_bed(self.properties['region'])
+        # The gtf parameters are used by ReadGtf
+        load_params = [self.properties.get(p) for p in
+                       ['global_max_row', 'prefered_name',
+                        'merge_transcripts', 'merge_overlapping_exons']]
+        load_key = (type(self).get_bed_handler.__qualname__,
+                    self.properties['file'], self.properties['region'],
+                    load_params)
+        self.interval_tree, min_score, max_score, self.bed_type = \
+            self.get_shared_data(load_key,
+                                 lambda: self.load_with_file_cache(
+                                     load_key,
+                                     lambda: self.process_bed(self.properties['region'])))
+        if self.properties['color'] == 'bed_rgb' and \
+           self.bed_type not in ['bed12', 'bed9']:
+            self.log.warning("*WARNING* Color set to 'bed_rgb', "
+                             "but bed file does not have the rgb field. "
+                             f"The color has been set to {DEFAULT_BED_COLOR}.\n")
+            self.properties['color'] = DEFAULT_BED_COLOR
         if self.colormap is not None:
             if self.properties['min_value'] is not None:
                 min_score = self.properties['min_value']
@@ -261,15 +277,19 @@ file_type = {TRACK_TYPE}
         self.row_scale = 2.3
 
     def get_bed_handler(self, plot_regions=None):
+        # To remove in next 1.0
+        is_gtf = self.properties['file'].endswith('gtf') or \
+            self.properties['file'].endswith('gtf.gz')
+        # end of remove
         if not self.properties['global_max_row']:
             # I do the intersection:
-            file_to_open = temp_file_from_intersect(self.properties['file'],
-                                                    plot_regions, AROUND_REGION)
+            file_to_open = open_intersected(self.properties['file'],
+                                            plot_regions, AROUND_REGION,
+                                            gtf=is_gtf)
         else:
             file_to_open = self.properties['file']
         # To remove in next 1.0
-        if self.properties['file'].endswith('gtf') or \
-           self.properties['file'].endswith('gtf.gz'):
+        if is_gtf:
             self.log.warning("Deprecation Warning: "
                              f"In section {self.properties['section_name']},"
                              f" file_type was set to {self.TRACK_TYPE}"
@@ -283,26 +303,20 @@ file_type = {TRACK_TYPE}
             total_length = bed_file_h.length
         else:
             # end of remove
-            total_length = count_lines(opener(file_to_open),
-                                       asBed=True)
-            bed_file_h = ReadBed(opener(file_to_open))
+            if self.properties['global_max_row']:
+                file_to_open = opener(file_to_open)
+            total_length = count_lines(file_to_open, asBed=True)
+            bed_file_h = ReadBed(file_to_open)
 
         return bed_file_h, total_length
 
     def process_bed(self, plot_regions=None):
 
         bed_file_h, total_length = self.get_bed_handler(plot_regions)
-        self.bed_type = bed_file_h.file_type
-
-        if self.properties['color'] == 'bed_rgb' and \
-           self.bed_type not in ['bed12', 'bed9']:
-            self.log.warning("*WARNING* Color set to 'bed_rgb', "
-                             "but bed file does not have the rgb field. "
-                             f"The color has been set to {DEFAULT_BED_COLOR}.\n")
-            self.properties['color'] = DEFAULT_BED_COLOR
 
         valid_intervals = 0
-        interval_tree = {}
+        # For each chromosome, the list of (start, end, bed)
+        intervals = {}
 
         max_score = float('-inf')
         min_score = float('inf')
@@ -312,11 +326,10 @@ file_type = {TRACK_TYPE}
             if bed.score > max_score:
                 max_score = bed.score
 
-            if bed.chromosome not in interval_tree:
-                interval_tree[bed.chromosome] = IntervalTree()
+            if bed.chromosome not in intervals:
+                intervals[bed.chromosome] = []
 
-            interval_tree[bed.chromosome].add(Interval(bed.start,
-                                                       bed.end, bed))
+            intervals[bed.chromosome].append((bed.start, bed.end, bed))
             valid_intervals += 1
 
         try:
@@ -328,7 +341,9 @@ file_type = {TRACK_TYPE}
             self.log.warning("No valid intervals were found in file "
                              f"{self.properties['file']}.\n")
 
-        return interval_tree, min_score, max_score
+        interval_tree = {chrom: intervals_to_index(chrom_intervals)
+                         for chrom, chrom_intervals in intervals.items()}
+        return interval_tree, min_score, max_score, bed_file_h.file_type
 
     def get_max_num_row(self, len_w, small_relative):
         ''' Process the whole bed regions at the given figure length
@@ -412,11 +427,11 @@ file_type = {TRACK_TYPE}
                                      " inside the bed file. "
                                      "This will generate an empty track!!\n")
                     return
-                else:
-                    self.interval_tree[chrom_region] = IntervalTree()
 
+        # self.interval_tree may be shared with other tracks
+        # so it is not modified when the chromosome is missing
         genes_overlap = \
-            sorted(self.interval_tree[chrom_region][start_region:end_region])
+            sorted(self.interval_tree.get(chrom_region, IntervalIndex([], []))[start_region:end_region])
 
         if self.properties['display'] == 'triangles':
             self.plot_triangles(ax, genes_overlap)
@@ -1,7 +1,6 @@
 from . GenomeTrack import GenomeTrack
 import numpy as np
-from .. utilities import plot_coverage, InputError, transform, change_chrom_names
-import pyBigWig
+from .. utilities import plot_coverage, InputError, transform, change_chrom_names, BigWigReader
 
 DEFAULT_BIGWIG_COLOR = '#33a02c'
 
@@ -31,6 +30,14 @@ nans_to_zeros = true
 # mean/average/stdev/dev/max/min/cov/coverage/sum
 # default is mean
 summary_method = mean
+# On large regions, the summaries can be computed from the
+# zoom level of the bigwig with the coarsest resolution
+# which still has at least 2 records per bin.
+# This is much faster on large files (the zoom level used
+# is reported in the log).
+# It is not used with summary_method = sum as the sums
+# computed from the zoom levels are slightly different.
+#use_zoom_levels = true
 # for type, the options are: line, points, fill. Default is fill
 # to add the preferred line width or point size use:
 # type = line:lw where lw (linewidth) is float
@@ -78,6 +85,7 @@ file_type = {TRACK_TYPE}
                            'alpha': 1,
                            'nans_to_zeros': False,
                            'summary_method': 'mean',
+                           'use_zoom_levels': False,
                            'number_of_bins': 700,
                            'type': 'fill',
                            'transform': 'no',
@@ -96,7 +104,8 @@ file_type = {TRACK_TYPE}
                            'transform': ['no', 'log', 'log1p', '-log', 'log2',
                                          'log10'],
                            'y_axis_values': ['original', 'transformed']}
-    BOOLEAN_PROPERTIES = ['nans_to_zeros', 'show_data_range', 'grid']
+    BOOLEAN_PROPERTIES = ['nans_to_zeros', 'show_data_range', 'grid',
+                          'use_zoom_levels']
     STRING_PROPERTIES = ['file', 'file_type', 'overlay_previous',
                          'orientation', 'summary_method',
                          'title', 'color', 'negative_color',
@@ -113,7 +122,7 @@ file_type = {TRACK_TYPE}
 
     def __init__(self, *args, **kwargs):
         super(self.__class__, self).__init__(*args, **kwargs)
-        self.bw = pyBigWig.open(self.properties['file'])
+        self.bw = self.open_bigwig(self.properties['file'])
         self.bw2 = None
         if 'second_file' in self.properties['operation']:
             if self.properties['second_file'] is None:
@@ -121,7 +130,17 @@ file_type = {TRACK_TYPE}
                                  " requires to set the parameter"
                                  " second_file.")
             else:
-                self.bw2 = pyBigWig.open(self.properties['second_file'])
+                self.bw2 = self.open_bigwig(self.properties['second_file'])
+
+    def open_bigwig(self, file_name):
+        """
+        Returns the BigWigReader of file_name shared by all tracks
+        of the PlotTracks (or a new one if there is no PlotTracks).
+        """
+        bigwig_pool = self.properties.get('bigwig_pool')
+        if bigwig_pool is None:
+            return BigWigReader(file_name)
+        return bigwig_pool.get(file_name)
 
     def set_properties_defaults(self):
         super(BigWigTrack, self).set_properties_defaults()
@@ -131,6 +150,13 @@ file_type = {TRACK_TYPE}
             self.properties['negative_color'] = self.properties['color']
         else:
             self.process_color('negative_color')
+        if self.properties['use_zoom_levels'] and \
+           self.properties['summary_method'] == 'sum':
+            self.log.warning("*Warning* 'use_zoom_levels' cannot be used "
+                             "with 'summary_method' = sum in section "
+                             f"{self.properties['section_name']}. "
+                             "The raw data will be used.\n")
+            self.properties['use_zoom_levels'] = False
         if self.properties['operation'] != 'file':
             self.checkoperation()
             if self.properties['transform'] != 'no':
@@ -144,13 +170,19 @@ file_type = {TRACK_TYPE}
                                  " It will be set as 'transformed'.\n")
                 self.properties['y_axis_values'] = 'transformed'
 
-    def plot(self, ax, chrom_region, start_region, end_region):
+    def fetch_data(self, chrom_region, start_region, end_region):
+        scores = self.get_scores('self.bw', self.properties['file'],
+                                 chrom_region, start_region, end_region)
+        if self.bw2 is not None:
+            scores2 = self.get_scores('self.bw2', self.properties['second_file'],
+                                      chrom_region, start_region, end_region)
+        else:
+            scores2 = None
+        return scores, scores2
 
-        temp_end_region, temp_nbins, scores_per_bin = self.get_scores('self.bw', self.properties['file'],
-                                                                      chrom_region, start_region, end_region)
-        if scores_per_bin is None:
-            self.log.warning("Scores could not be computed. This will generate an empty track\n")
-            return
+    def plot(self, ax, chrom_region, start_region, end_region):
+        scores, scores2 = self.get_data(chrom_region, start_region, end_region)
+        temp_end_region, temp_nbins, scores_per_bin = scores
 
         if self.properties['nans_to_zeros'] and np.any(np.isnan(scores_per_bin)):
             scores_per_bin[np.isnan(scores_per_bin)] = 0
@@ -158,26 +190,12 @@ file_type = {TRACK_TYPE}
         x_values = np.linspace(start_region, temp_end_region, temp_nbins)
         # compute the operation
         operation = self.properties['operation']
-        # Substitute log by np.log to make it evaluable:
-        operation = operation.replace('log', 'np.log')
         if operation == 'file':
             pass
         elif 'second_file' not in operation:
-            try:
-                new_scores_per_bin = eval('[' + operation + ' for file in scores_per_bin]')
-                new_scores_per_bin = np.array(new_scores_per_bin)
-            except Exception as e:
-                raise Exception("The operation in section "
-                                f"{self.properties['section_name']} could not "
-                                f"be computed: {e}")
-            else:
-                scores_per_bin = new_scores_per_bin
+            scores_per_bin = self.compute_operation(scores_per_bin)
         else:
-            temp_end_region2, temp_nbins2, scores_per_bin2 = self.get_scores('self.bw2', self.properties['second_file'],
-                                                                             chrom_region, start_region, end_region)
-            if scores_per_bin2 is None:
-                self.log.warning("Scores for second_file could not be computed. This will generate an empty track\n")
-                return
+            temp_end_region2, temp_nbins2, scores_per_bin2 = scores2
 
             if self.properties['nans_to_zeros'] and np.any(np.isnan(scores_per_bin2)):
                 scores_per_bin2[np.isnan(scores_per_bin2)] = 0
@@ -187,18 +205,8 @@ file_type = {TRACK_TYPE}
                 raise Exception('The two bigwig files are not compatible on this region:'
                                 f'{chrom_region}:{start_region}-{end_region}')
             # compute the operation
-            try:
-                new_scores_per_bin = eval('[' + operation
-                                          + ' for file, second_file in'
-                                          ' zip(scores_per_bin,'
-                                          ' scores_per_bin2)]')
-                new_scores_per_bin = np.array(new_scores_per_bin)
-            except Exception as e:
-                raise Exception("The operation in section "
-                                f"{self.properties['section_name']} could not "
-                                f"be computed: {e}")
-            else:
-                scores_per_bin = new_scores_per_bin
+            scores_per_bin = self.compute_operation(scores_per_bin,
+                                                    scores_per_bin2)
 
         transformed_scores = transform(scores_per_bin,
                                        self.properties['transform'],
@@ -224,8 +232,15 @@ file_type = {TRACK_TYPE}
                                              self.properties['grid'])
 
     def get_scores(self, bw_var, bw_file, chrom_region, start_region, end_region):
+        """
+        :return: temp_end_region, temp_nbins, scores_per_bin
+                 where temp_end_region is end_region or the end of the
+                 chromosome. The scores are nan when there is no part of
+                 the region inside the chromosome.
+        """
         bw = eval(bw_var)
-        scores_per_bin = None
+        nan_scores = (end_region, self.properties['number_of_bins'],
+                      np.array([np.nan] * self.properties['number_of_bins']))
         if chrom_region not in bw.chroms().keys():
             chrom_region_before = chrom_region
             chrom_region = change_chrom_names(chrom_region)
@@ -235,17 +250,17 @@ file_type = {TRACK_TYPE}
                                  "chromosome name inside the bigwig file. "
                                  "No score will be computed for"
                                  f" {bw_file}.\n")
-                scores_per_bin = np.array([np.nan] * self.properties['number_of_bins'])
+                return nan_scores
 
-        if scores_per_bin is None and start_region > bw.chroms()[chrom_region]:
+        if start_region > bw.chroms()[chrom_region]:
             self.log.warning("*Warning*\nThe region to plot starts beyond the"
                              " chromosome size. No score will be computed for"
                              f" {bw_file}.\n"
                              f"{chrom_region} size: {bw.chroms()[chrom_region]}"
                              f". Region to plot {start_region}-{end_region}\n")
-            scores_per_bin = np.array([np.nan] * self.properties['number_of_bins'])
+            return nan_scores
 
-        if scores_per_bin is None and end_region > bw.chroms()[chrom_region]:
+        if end_region > bw.chroms()[chrom_region]:
             self.log.warning("*Warning*\nThe region to plot extends beyond the"
                              " chromosome size. Please check.\n"
                              f"{chrom_region} size: {bw.chroms()[chrom_region]}"
@@ -255,31 +270,29 @@ file_type = {TRACK_TYPE}
         else:
             temp_end_region = end_region
             temp_nbins = self.properties['number_of_bins']
-        # on rare occasions pyBigWig may throw an error, apparently caused by a corruption
-        # of the memory. This only occurs when calling trackPlot from different
-        # processors. Reloading the file solves the problem.
-        if scores_per_bin is None:
-            num_tries = 0
-            while num_tries < 5:
-                num_tries += 1
-                try:
-                    scores_per_bin = np.array(bw.stats(chrom_region, start_region,
-                                                       temp_end_region, nBins=temp_nbins,
-                                                       type=self.properties['summary_method'])).astype(float)
-                except Exception as e:
-                    bw = pyBigWig.open(self.properties['file'])
-
-                    self.log.warning("error found while reading bigwig scores "
-                                     f"({e}).\nTrying again."
-                                     f" Iter num: {num_tries}.\n")
-                    pass
-                else:
-                    if num_tries > 1:
-                        self.log.warning(f"After {num_tries} the scores could be computed.\n")
-                    break
+        if temp_nbins < 1:
+            # For example when the region starts at the end of the chromosome
+            self.log.warning("*Warning*\nThe part of the region to plot inside"
+                             " the chromosome is too small. No score will be"
+                             f" computed for {bw_file}.\n")
+            return nan_scores
+        # Each process reads the file with its own handle
+        # (see BigWigReader.check_process)
+        try:
+            scores_per_bin = bw.stats(chrom_region, start_region,
+                                      temp_end_region, nBins=temp_nbins,
+                                      type=self.properties['summary_method'],
+                                      use_zoom_levels=self.properties['use_zoom_levels'])
+        except Exception as e:
+            raise InputError(f"The scores of {bw_file} could not be read on"
+                             f" {chrom_region}:{start_region}-{temp_end_region}"
+                             f" ({e}).") from e
         return temp_end_region, temp_nbins, scores_per_bin
 
     def __del__(self):
+        if self.properties.get('bigwig_pool') is not None:
+            # The files are closed by the PlotTracks
+            return
         try:
             self.bw.close()
         except AttributeError:
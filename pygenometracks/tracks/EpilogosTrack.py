@@ -65,6 +65,9 @@ file_type = {TRACK_TYPE}
         else:
             self.categories = None
 
+    def fetch_data(self, chrom_region, start_region, end_region):
+        return self.get_scores(chrom_region, start_region, end_region)
+
     def plot(self, ax, chrom_region, start_region, end_region):
         """
         Plots a bedgraph matrix file, that instead of having
@@ -72,7 +75,7 @@ file_type = {TRACK_TYPE}
         """
         cmap = cm.get_cmap('tab20b')
 
-        values_list, pos_list = self.get_scores(chrom_region, start_region, end_region)
+        values_list, pos_list = self.get_data(chrom_region, start_region, end_region)
         if pos_list == []:
             return
 
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
-from .. utilities import InputError, transform
+from .. utilities import InputError, transform, compile_operation, \
+    interval_indices_to_arrays, interval_indices_from_arrays
 import logging
 import numpy as np
 from matplotlib import colors as mc
@@ -8,6 +9,8 @@ import matplotlib.pyplot as plt
 from matplotlib.ticker import LogFormatter
 import re
 import math
+import threading
+from concurrent.futures import Future
 
 # This is a regex for float which would work for 11, 102.25, but also .2
 float_regex = r'(?:\d+)?(?:\.\d+)?'
@@ -60,6 +63,16 @@ height = 2
         log.setLevel(logging.DEBUG)
         self.log = log
         self.properties = properties_dict
+        # data read by fetch_data before the plot
+        # the key is (chrom_region, start_region, end_region)
+        # and the value is a Future with the data
+        self.prefetched_data = {}
+        # prefetched_data is used from different threads
+        # (to prefetch the next region for example)
+        self.prefetch_lock = threading.Lock()
+        # fetch_data may be called from different threads
+        # but the file handles are not shared safely
+        self.fetch_lock = threading.Lock()
         self.set_properties_defaults()
         self.file_type = 'test'
 
@@ -81,6 +94,109 @@ height = 2
                                  f"{default_value}.\n")
                 self.properties[prop] = default_value
 
+    def get_shared_data(self, key, loader, whole_run=False):
+        """
+        Returns the dataset identified by key (usually the file name
+        and the parameters used to read it) from the registry of the
+        PlotTracks. loader() is only called if no other track
+        loaded it before. The dataset must not be modified.
+        With whole_run, the dataset does not depend on the regions
+        the track was initialized with and is kept until the end
+        of the run (even in lazy loading mode).
+        """
+        if whole_run:
+            registry = self.properties.get('run_registry')
+        else:
+            registry = self.properties.get('dataset_registry')
+        if registry is None:
+            return loader()
+        return registry.get(key, loader)
+
+    def compute_run_data(self):
+        """
+        Computes the datasets kept for the whole run
+        (see get_shared_data). When the regions are plotted
+        by several processes, it is called once before
+        so that each process does not compute them again.
+        """
+        pass
+
+    def load_with_file_cache(self, key, loader):
+        """
+        Returns loader() which must return a dictionary of IntervalIndex
+        followed by other values (see interval_indices_to_arrays).
+        When a cache directory is used, the output is stored in
+        the FileCache with key so that later runs do not need
+        to parse self.properties['file'] again.
+        """
+        file_cache = self.properties.get('file_cache')
+        if file_cache is None:
+            return loader()
+        arrays = file_cache.load(self.properties['file'], key)
+        if arrays is not None:
+            return interval_indices_from_arrays(arrays)
+        output = loader()
+        try:
+            arrays = interval_indices_to_arrays(*output)
+        except ValueError as e:
+            self.log.debug(f"{self.properties['file']} is not cached: {e}")
+        else:
+            file_cache.save(self.properties['file'], key, arrays)
+        return output
+
+    def fetch_data(self, chrom_region, start_region, end_region):
+        """
+        Reads from the file(s) the data needed to plot a region.
+        This is the I/O part of the plot: it must not use matplotlib
+        nor modify the attributes used by plot, so it can be run in a
+        thread while other tracks are fetched or plotted.
+        It is always called with the fetch_lock of the track held
+        (see prefetch_data and get_data), so it can use the file handles
+        of the track and update its caches (for example the matrices
+        loaded by the Hi-C tracks) without other locks. The data
+        returned must be new objects or objects which are never modified.
+        By default, nothing is read in advance and the plot method
+        reads what it needs.
+
+        Returns:
+            the data which will be given back by get_data
+        """
+        return None
+
+    def prefetch_data(self, chrom_region, start_region, end_region):
+        """
+        Stores the result of fetch_data for the region
+        (if it was not already prefetched or being prefetched).
+        """
+        key = (chrom_region, start_region, end_region)
+        with self.prefetch_lock:
+            if key in self.prefetched_data:
+                return
+            future = Future()
+            self.prefetched_data[key] = future
+        # The I/O is done without prefetch_lock so the data of
+        # the regions already prefetched can be plotted meanwhile
+        try:
+            with self.fetch_lock:
+                data = self.fetch_data(chrom_region, start_region, end_region)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        future.set_result(data)
+
+    def get_data(self, chrom_region, start_region, end_region):
+        """
+        Returns the data prefetched for the region (waiting for it
+        if it is being prefetched) or fetch it if it was not prefetched.
+        """
+        with self.prefetch_lock:
+            future = self.prefetched_data.pop((chrom_region, start_region,
+                                               end_region), None)
+        if future is None:
+            with self.fetch_lock:
+                return self.fetch_data(chrom_region, start_region, end_region)
+        return future.result()
+
     def plot_y_axis(self, ax, plot_axis, transform='no', log_pseudocount=0,
                     y_axis='transformed', only_at_ticks=False):
         """
@@ -535,21 +651,24 @@ height = 2
                 return True
 
     def checkoperation(self):
-        "Will check if the operation is 'safe'"
-        allowed_words = ['second_file', 'file',
-                         'sum', 'min', 'max',
-                         'log1p', 'log']
-        allowed_signs = ['+', '-', '*', '/',
-                         '(', ')', '.', ',', ' ', 'e'] + \
-                        [f"{i}" for i in range(10)]
-        operation = self.properties['operation']
-        for word in allowed_words:
-            operation = operation.replace(word, "")
-        forbidden_signs = [s for s in operation if s not in allowed_signs]
-        if len(forbidden_signs) > 0:
-            raise InputError(f"operation: {self.properties['operation']}"
-                             " uses signs which are not allowed: "
-                             f"{','.join(forbidden_signs)}.")
+        """
+        Will check if the operation is 'safe' and compile it
+        into self.compiled_operation which computes it
+        on the arrays of scores
+        """
+        self.compiled_operation = compile_operation(self.properties['operation'])
+
+    def compute_operation(self, scores, scores2=None):
+        """
+        Returns the result of the operation on the arrays of
+        scores of file and second_file.
+        """
+        try:
+            return self.compiled_operation(scores, scores2)
+        except Exception as e:
+            raise Exception("The operation in section "
+                            f"{self.properties['section_name']} could not "
+                            f"be computed: {e}")
 
     def plot_custom_cobar(self, axis, fraction=0.95):
         if self.properties.get('transform', 'no') in ['log', 'log1p']:
@@ -2,7 +2,7 @@ from . GenomeTrack import GenomeTrack
 from . BedTrack import BedTrack
 from .. readGtf import ReadGtf
 from matplotlib import font_manager
-from .. utilities import temp_file_from_intersect
+from .. utilities import open_intersected
 import numpy as np
 
 DEFAULT_BED_COLOR = '#1f78b4'
@@ -193,8 +193,9 @@ file_type = {TRACK_TYPE}
     def get_bed_handler(self, plot_regions=None):
         if not self.properties['global_max_row']:
             # I do the intersection:
-            file_to_open = temp_file_from_intersect(self.properties['file'],
-                                                    plot_regions, AROUND_REGION)
+            file_to_open = open_intersected(self.properties['file'],
+                                            plot_regions, AROUND_REGION,
+                                            gtf=True)
         else:
             file_to_open = self.properties['file']
 
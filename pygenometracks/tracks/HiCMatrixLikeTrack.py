@@ -1,18 +1,45 @@
 from hicmatrix import HiCMatrix
 import hicmatrix.utilities
+import cooler
 import scipy.sparse
 from matplotlib import cm
 import numpy as np
 from . GenomeTrack import GenomeTrack
-from .. utilities import change_chrom_names
+from .. utilities import change_chrom_names, sparse_upper_band, fill_main_diagonal
 import logging
 import copy
+import threading
+from collections import OrderedDict
 
 DEFAULT_MATRIX_COLORMAP = 'RdYlBu_r'
 logging.basicConfig(level=logging.DEBUG)
 log = logging.getLogger(__name__)
 
 
+class QuietLoadingFilter(logging.Filter):
+    """
+    Hides the messages of hicmatrix logged by a thread while it tries
+    to load a matrix (the errors raised are handled by the track).
+    The level of the loggers is never changed so the
+    messages of the other threads are kept.
+    """
+
+    def __init__(self):
+        super(QuietLoadingFilter, self).__init__()
+        self.state = threading.local()
+
+    def set_quiet(self, quiet):
+        self.state.quiet = quiet
+
+    def filter(self, record):
+        return not getattr(self.state, 'quiet', False)
+
+
+QUIET_LOADING_FILTER = QuietLoadingFilter()
+for logger_name in ['hicmatrix.HiCMatrix', 'hicmatrix.lib.cool']:
+    logging.getLogger(logger_name).addFilter(QUIET_LOADING_FILTER)
+
+
 class HiCMatrixLikeTrack(GenomeTrack):
     SUPPORTED_ENDINGS = []
     TRACK_TYPE = None
@@ -44,6 +71,11 @@ show_masked_bins = false
 # You can choose to keep the matrix as not rasterized
 # (only used if you use pdf or svg output format) by using:
 # rasterize = false
+# For multi-resolution cool files (.mcool), the resolution can be chosen with:
+# file = matrix.mcool::/resolutions/10000
+# If only the .mcool file is given, the resolution used is the finest one
+# with at most max_bins bins in the widest region plotted:
+# max_bins = 1000
     """
     DEFAULTS_PROPERTIES = {'region': None,  # Cannot be set manually but is set by tracksClass
                            'orientation': None,
@@ -53,6 +85,7 @@ show_masked_bins = false
                            'max_value': None,
                            'min_value': None,
                            'rasterize': True,
+                           'max_bins': 1000,
                            'colormap': DEFAULT_MATRIX_COLORMAP}
     NECESSARY_PROPERTIES = ['file']
     SYNONYMOUS_PROPERTIES = {'max_value': {'auto': None},
@@ -67,8 +100,15 @@ show_masked_bins = false
                         'min_value': [- np.inf, np.inf],
                         'scale_factor': [- np.inf, np.inf],
                         'height': [0, np.inf]}
-    INTEGER_PROPERTIES = {}
+    INTEGER_PROPERTIES = {'max_bins': [1, np.inf]}
     # The colormap can only be a colormap
+    # Number of matrices loaded for different regions kept in memory
+    MAX_LOADED_WINDOWS = 3
+    # Number of bins needed around the regions plotted
+    # when the matrix is loaded by region
+    MARGIN_IN_BINS = 0
+    # Number of pixels read at once to look for the main diagonal
+    PIXELS_CHUNK_SIZE = 10 ** 6
 
     def __init__(self, *args, **kwargs):
         super(HiCMatrixLikeTrack, self).__init__(*args, **kwargs)
@@ -78,108 +118,246 @@ show_masked_bins = false
         super(HiCMatrixLikeTrack, self).set_properties_defaults()
         # Put default img to None for y axis
         self.last_img_plotted = None
+        # The matrices loaded for the different regions to plot
+        # the most recently used is the last one
+        self.loaded_windows = OrderedDict()
+        self.windowed = False
+        # The resolutions of a multi-resolution cool file
+        self.resolutions = None
+        # The summaries of the matrices (see get_matrix_summary)
+        self.matrix_summaries = {}
+        # The binsizes of the matrices loaded
+        self.binsizes = {}
+        all_regions = self.get_all_plotted_regions()
+        if all_regions is not None and len(set(all_regions)) > 1:
+            # The matrix is loaded for each region when it is plotted
+            # so only the bins around this region are loaded
+            self.windowed = True
+        else:
+            matrix_file = self.get_matrix_file(self.properties['region'])
+            window = self.load_window(self.get_region_to_load(self.properties['region']),
+                                      matrix_file)
+            if not self.needs_matrix_summary():
+                # The main diagonal is filled with the values of the region
+                self.matrix_summaries[matrix_file] = self.summarize_windows([window[0]])
+            self.fill_empty_main_diagonal(window[0], matrix_file)
+            self.loaded_windows[(matrix_file, None)] = window
+
+        self.process_color('colormap', colormap_possible=True,
+                           colormap_only=True, default_value_is_colormap=True)
+
+        self.cmap = copy.copy(cm.get_cmap(self.properties['colormap']))
+        self.cmap.set_bad('black')
+
+    def get_all_plotted_regions(self):
+        """
+        Returns the regions plotted on the x axis during the whole run.
+        In lazy loading mode, the track is only initialized
+        with a group of them.
+        """
+        if self.properties.get('all_regions') is not None:
+            return self.properties['all_regions']
+        return self.get_plotted_regions(self.properties['region'])
+
+    def get_plotted_regions(self, regions):
+        """
+        Returns the regions plotted on the x axis among
+        the regions the matrix is loaded for.
+        """
+        return regions
+
+    def get_region_to_load(self, regions, margin=0):
+        """
+        Returns the region of the matrix needed to plot the regions
+        (list of (chrom, start, end)) extended of margin as a list with
+        a single 'chrom:start-end' string or None
+        to load the whole matrix.
+        """
         region = None
-        if self.properties['region'] is not None:
+        if regions is not None:
             # We need to restrict it to a single region because
             # HiCMatrix does not accept more
             # We check if everything is on a single chrom:
-            if len(set([r[0] for r in self.properties['region']])) == 1:
-                chrom = self.properties['region'][0][0]
-                start = min([r[1] for r in self.properties['region']])
-                end = max([r[2] for r in self.properties['region']])
+            if len(set([r[0] for r in regions])) == 1:
+                chrom = regions[0][0]
+                start = min([r[1] for r in regions])
+                end = max([r[2] for r in regions])
                 # I extend of depth to avoid triangle effect in the plot
                 if 'depth' in self.properties:
                     start = max(0, start - self.properties['depth'])
                     end += self.properties['depth']
+                start = max(0, start - margin)
+                end += margin
                 # I would like to find a way to sligthly above start-end
                 # When there is no depth (hic_matrix_square)
                 # Like 3 bins each direction but I don't manage
                 # To think about a good way.
                 region = [f"{chrom}:{start}-{end}"]
-        # Cooler and thus HiCMatrix with cool file will raise an error if:
-        # - the file is a cool file and:
-        #    - the region goes over the chromosome size
-        #   or
-        #   - the chromosome is not part of the matrix
+        return region
+
+    def get_window_to_load(self, chrom_region, region_start, region_end):
+        """
+        Returns the matrix file and the region (see get_region_to_load)
+        to load to plot the region.
+        """
+        # The regions which are not plotted on the x axis
+        # are always needed (region2 of hic_matrix_square)
+        plotted_regions = self.get_plotted_regions(self.properties['region'])
+        regions = [(chrom_region, region_start, region_end)] + \
+            self.properties['region'][len(plotted_regions):]
+        matrix_file = self.get_matrix_file(regions)
+        if self.MARGIN_IN_BINS > 0 and matrix_file not in self.binsizes:
+            # The binsize is needed to know the margin
+            self.load_window(self.get_region_to_load(regions), matrix_file)
+        region = self.get_region_to_load(regions, self.MARGIN_IN_BINS
+                                         * self.binsizes.get(matrix_file, 0))
+        return matrix_file, region
+
+    def load_region(self, chrom_region, region_start, region_end):
+        """
+        Returns the matrix file and the matrix (see load_window)
+        to plot the region.
+        The matrices loaded for the last regions are kept and reused
+        when they contain the region needed.
+        """
+        if not self.windowed:
+            return next(iter(self.loaded_windows.items()))
+        matrix_file, region = self.get_window_to_load(chrom_region, region_start, region_end)
+        if region is not None:
+            chrom, position = region[0].split(':')
+            start, end = [int(p) for p in position.split('-')]
+        for key in self.loaded_windows:
+            window_file, window = key
+            if window_file != matrix_file:
+                continue
+            if window is None or \
+                    (region is not None and window[0] == chrom
+                     and window[1] <= start and window[2] >= end):
+                self.log.debug(f"Reusing the matrix loaded for {window}")
+                self.loaded_windows.move_to_end(key)
+                return key, self.loaded_windows[key]
+        if region is None:
+            window = None
+        else:
+            window = (chrom, start, end)
+        # The data of the least recently used matrix are released
+        # before loading the new one
+        while len(self.loaded_windows) >= self.MAX_LOADED_WINDOWS:
+            self.loaded_windows.popitem(last=False)
+        loaded_window = self.load_window(region, matrix_file)
+        self.fill_empty_main_diagonal(loaded_window[0], matrix_file)
+        self.loaded_windows[(matrix_file, window)] = loaded_window
+        return (matrix_file, window), loaded_window
 
-        # We need to change the log level because we don't want
-        # the user to see all the errors raised during the try except
-        logging.getLogger('hicmatrix').setLevel(logging.CRITICAL)
+    def fetch_data(self, chrom_region, region_start, region_end):
+        """
+        Loads the matrix needed to plot the region
+        (see load_region) and the summary of its matrix file
+        if it is needed to plot.
+        """
+        (matrix_file, window), loaded_window = \
+            self.load_region(chrom_region, region_start, region_end)
+        summary = None
+        if self.needs_matrix_summary():
+            summary = self.get_matrix_summary(matrix_file)
+        return loaded_window, summary
+
+    def needs_matrix_summary(self):
+        """
+        Returns True if plot uses the summary of the matrix file.
+        """
+        return False
+
+    def compute_run_data(self):
+        """
+        Computes the summaries of the matrix files used to plot
+        all the regions (see get_matrix_summary) if they are needed
+        to plot (see needs_matrix_summary) or to fill the main diagonal
+        of a matrix without main diagonal (see fill_empty_main_diagonal).
+        """
+        if not self.windowed:
+            return
+        matrix_files = set([self.get_window_to_load(*region)[0]
+                            for region in self.get_all_plotted_regions()])
+        for matrix_file in sorted(matrix_files):
+            if self.needs_matrix_summary() or \
+                    ('depth' in self.properties
+                     and not self.has_main_diagonal(matrix_file)):
+                self.get_matrix_summary(matrix_file)
+
+    def use_region_data(self, chrom_region, region_start, region_end):
+        """
+        Makes the matrix loaded for the region (by fetch_data)
+        the one which is plotted.
+        """
+        loaded_window, self.matrix_summary = self.get_data(chrom_region, region_start,
+                                                           region_end)
+        self.hic_ma, self.chrom_sizes, self.bin_starts, self.bin_ends = loaded_window
+
+    def load_window(self, region, matrix_file):
+        """
+        Loads the matrix restricted to region (see get_region_to_load)
+        and prepares it to be plotted (the main diagonal is not filled,
+        see fill_empty_main_diagonal).
+        Returns the HiCMatrix, the chromosome sizes and the
+        start and end positions of the bins.
+        """
+        chrom_sizes = {}
+        bin_starts = np.array([], dtype=int)
+        bin_ends = np.array([], dtype=int)
+        # We don't want the user to see all the errors
+        # raised during the try except of read_matrix
+        QUIET_LOADING_FILTER.set_quiet(True)
         try:
-            self.hic_ma = HiCMatrix.hiCMatrix(self.properties['file'],
-                                              pChrnameList=region)
-        except ValueError as ve:
-            if region is not None:
-                if "Unknown sequence label" in str(ve):
-                    rs = region[0].split(':')
-                    chrom_region = rs[0]
-                    chrom_region_before = chrom_region
-                    chrom_region = change_chrom_names(chrom_region)
-                    region = [f"{chrom_region}:{rs[1]}"]
-                    try:
-                        self.hic_ma = HiCMatrix.hiCMatrix(self.properties['file'],
-                                                          pChrnameList=region)
-                    except ValueError as ve2:
-                        if "Unknown sequence label" in str(ve2):
-                            self.log.warning("*Warning*\nNeither " + chrom_region_before
-                                             + " nor " + chrom_region + " exists as a "
-                                             "chromosome name on the matrix. "
-                                             "This will generate an empty track!!\n")
-                            self.hic_ma = HiCMatrix.hiCMatrix()
-                            self.hic_ma.matrix = scipy.sparse.csr_matrix((0, 0))
-                        elif "Genomic region out of bounds" in str(ve2):
-                            region = [chrom_region]
-                            self.hic_ma = HiCMatrix.hiCMatrix(self.properties['file'],
-                                                              pChrnameList=region)
-                        else:
-                            raise ve2
-                elif "Genomic region out of bounds" in str(ve):
-                    region = [region[0].split(':')[0]]
-                    self.hic_ma = HiCMatrix.hiCMatrix(self.properties['file'],
-                                                      pChrnameList=region)
-                else:
-                    raise ve
-            else:
-                raise ve
-        # We put back the log to warning
-        logging.getLogger('hicmatrix').setLevel(logging.WARNING)
+            hic_ma, region = self.read_matrix(region, matrix_file)
+        finally:
+            QUIET_LOADING_FILTER.set_quiet(False)
 
-        if len(self.hic_ma.matrix.data) == 0:
+        if len(hic_ma.matrix.data) == 0:
             if region is None:
                 # This is not due to a restriction of the matrix
                 raise Exception(f"Matrix {self.properties['file']} is empty")
-            else:
-                return
+            elif not self.windowed or hic_ma.matrix.shape[0] == 0:
+                return hic_ma, chrom_sizes, bin_starts, bin_ends
+            # When the matrix is loaded by region, the bins of the region
+            # are kept even without interactions, like they would be
+            # in the whole matrix
         # We need to get the size before masking bins because
         # HiCMatrix>=v13 give smaller chromosome_sizes after:
-        self.chrom_sizes = self.hic_ma.get_chromosome_sizes()
+        chrom_sizes = hic_ma.get_chromosome_sizes()
         if self.properties['show_masked_bins']:
             pass
         else:
-            self.hic_ma.maskBins(self.hic_ma.nan_bins)
+            hic_ma.maskBins(hic_ma.nan_bins)
+            if hic_ma.matrix.shape[0] == 0:
+                # All bins of the region were masked
+                return hic_ma, chrom_sizes, bin_starts, bin_ends
 
         # check that the matrix can be log transformed
-        if self.properties['transform'] != 'no':
+        if self.properties['transform'] != 'no' and len(hic_ma.matrix.data) > 0:
             if self.properties['transform'] == 'log1p':
-                if self.hic_ma.matrix.data.min() + 1 <= 0:
+                if hic_ma.matrix.data.min() + 1 <= 0:
                     raise Exception("\n*ERROR*\nMatrix contains values below - 1.\n"
                                     "log1p transformation can not be applied to \n"
                                     f"values in matrix: {self.properties['file']}")
 
             elif self.properties['transform'] in ['-log', 'log']:
-                if self.hic_ma.matrix.data.min() < 0:
+                if hic_ma.matrix.data.min() < 0:
                     # For values not filled or equal to zero there will be a
                     # mask, they will be replaced by the minimum value after 0.
                     raise Exception("\n*ERROR*\nMatrix contains negative values.\n"
                                     "log transformation can not be applied to \n"
                                     f"values in matrix: {self.properties['file']}")
 
-        new_intervals = hicmatrix.utilities.enlarge_bins(self.hic_ma.cut_intervals)
-        self.hic_ma.interval_trees, self.hic_ma.chrBinBoundaries = \
-            self.hic_ma.intervalListToIntervalTree(new_intervals)
+        new_intervals = hicmatrix.utilities.enlarge_bins(hic_ma.cut_intervals)
+        hic_ma.interval_trees, hic_ma.chrBinBoundaries = \
+            hic_ma.intervalListToIntervalTree(new_intervals)
 
-        self.hic_ma.cut_intervals = new_intervals
-        binsize = self.hic_ma.getBinSize()
+        hic_ma.cut_intervals = new_intervals
+        bin_starts = np.array([x[1] for x in new_intervals])
+        bin_ends = np.array([x[2] for x in new_intervals])
+        binsize = hic_ma.getBinSize()
+        self.binsizes[matrix_file] = binsize
 
         if 'depth' in self.properties:
             max_depth_in_bins = int(self.properties['depth'] / binsize)
@@ -188,41 +366,215 @@ show_masked_bins = false
                 self.log.warning(f"*Warning*\nThe depth({self.properties['depth']})"
                                  f" is smaller than binsize({binsize})"
                                  "This will generate an empty track!!\n")
-                self.hic_ma.matrix = scipy.sparse.csr_matrix((0, 0))
-                return
+                hic_ma.matrix = scipy.sparse.csr_matrix((0, 0))
+                return hic_ma, chrom_sizes, bin_starts, bin_ends
 
-            self.reduce_matrix(max_depth_in_bins)
+            self.reduce_matrix(hic_ma, max_depth_in_bins)
+        return hic_ma, chrom_sizes, bin_starts, bin_ends
 
-        self.process_color('colormap', colormap_possible=True,
-                           colormap_only=True, default_value_is_colormap=True)
+    def read_matrix(self, region, matrix_file):
+        """
+        Returns the HiCMatrix of matrix_file restricted to region
+        (see get_region_to_load) and the region which was read.
+        """
+        # Cooler and thus HiCMatrix with cool file will raise an error if:
+        # - the file is a cool file and:
+        #    - the region goes over the chromosome size
+        #   or
+        #   - the chromosome is not part of the matrix
+        try:
+            hic_ma = HiCMatrix.hiCMatrix(matrix_file,
+                                         pChrnameList=region)
+        except ValueError as ve:
+            if region is not None:
+                if "Unknown sequence label" in str(ve):
+                    rs = region[0].split(':')
+                    chrom_region = rs[0]
+                    chrom_region_before = chrom_region
+                    chrom_region = change_chrom_names(chrom_region)
+                    region = [f"{chrom_region}:{rs[1]}"]
+                    try:
+                        hic_ma = HiCMatrix.hiCMatrix(matrix_file,
+                                                     pChrnameList=region)
+                    except ValueError as ve2:
+                        if "Unknown sequence label" in str(ve2):
+                            self.log.warning("*Warning*\nNeither " + chrom_region_before
+                                             + " nor " + chrom_region + " exists as a "
+                                             "chromosome name on the matrix. "
+                                             "This will generate an empty track!!\n")
+                            hic_ma = HiCMatrix.hiCMatrix()
+                            hic_ma.matrix = scipy.sparse.csr_matrix((0, 0))
+                        elif "Genomic region out of bounds" in str(ve2):
+                            region = [chrom_region]
+                            hic_ma = HiCMatrix.hiCMatrix(matrix_file,
+                                                         pChrnameList=region)
+                        else:
+                            raise ve2
+                elif "Genomic region out of bounds" in str(ve):
+                    region = [region[0].split(':')[0]]
+                    hic_ma = HiCMatrix.hiCMatrix(matrix_file,
+                                                 pChrnameList=region)
+                else:
+                    raise ve
+            else:
+                raise ve
+        return hic_ma, region
 
-        self.cmap = copy.copy(cm.get_cmap(self.properties['colormap']))
-        self.cmap.set_bad('black')
+    def get_matrix_file(self, regions):
+        """
+        Returns the path of the matrix to load to plot the regions.
+        For a multi-resolution cool file given without '::',
+        this is the finest resolution with at most max_bins bins
+        in the widest region (the coarsest if there is none).
+        """
+        file = self.properties['file']
+        if '::' in file or not file.endswith('.mcool'):
+            return file
+        if self.resolutions is None:
+            self.resolutions = []
+            for group in cooler.fileops.list_coolers(file):
+                binsize = cooler.Cooler(f"{file}::{group}").binsize
+                # Coolers with variable bins have no binsize
+                if binsize is not None:
+                    self.resolutions.append((binsize, group))
+            self.resolutions.sort()
+        resolutions = self.resolutions
+        if len(resolutions) == 0:
+            return file
+        binsize, group = resolutions[-1]
+        if regions is not None:
+            width = max([r[2] - r[1] for r in regions])
+            for binsize, group in resolutions:
+                if width / binsize <= self.properties['max_bins']:
+                    break
+        self.log.debug(f"Using the resolution {binsize} ({group}) of {file}")
+        return f"{file}::{group}"
 
-    def reduce_matrix(self, max_depth_in_bins):
+    def reduce_matrix(self, hic_ma, max_depth_in_bins):
         # work only with the lower matrix
         # and remove all pixels that are beyond
         # 2 * max_depth_in_bis which are not required
-        # (this is done by subtracting a second sparse matrix
-        # that contains only the lower matrix that wants to be removed.
+        # (this is done in a single pass on the indices
+        # to avoid copies of the whole matrix).
         limit = 2 * max_depth_in_bins
-        self.hic_ma.matrix = scipy.sparse.triu(self.hic_ma.matrix, k=0, format='csr') - \
-            scipy.sparse.triu(self.hic_ma.matrix, k=limit, format='csr')
-        self.hic_ma.matrix.eliminate_zeros()
-
-        # fill the main diagonal, otherwise it looks
-        # not so good. The main diagonal is filled
-        # with an array containing the max value found
-        # in the matrix
-        if sum(self.hic_ma.matrix.diagonal()) == 0:
+        hic_ma.matrix = sparse_upper_band(hic_ma.matrix, limit)
+
+    def fill_empty_main_diagonal(self, hic_ma, matrix_file):
+        """
+        Fills the main diagonal of hic_ma if it is empty, otherwise it
+        looks not so good. The main diagonal is filled with the max value
+        found in the region loaded or, if the matrix is loaded for each
+        region or its summary is used to plot, in the whole matrix
+        (see get_matrix_summary) if its main diagonal is empty.
+        """
+        if 'depth' not in self.properties or hic_ma.matrix.shape[0] == 0:
+            return
+        if sum(hic_ma.matrix.diagonal()) == 0:
+            max_value = self.get_matrix_summary(matrix_file)['main_diagonal_value']
+            if max_value is None:
+                return
             self.log.info("Filling main diagonal with max value because it empty and looks bad...\n")
-            max_value = self.hic_ma.matrix.data.max()
-            main_diagonal = scipy.sparse.dia_matrix(([max_value] * self.hic_ma.matrix.shape[0], [0]),
-                                                    shape=self.hic_ma.matrix.shape)
-            self.hic_ma.matrix = self.hic_ma.matrix + main_diagonal
+            hic_ma.matrix = fill_main_diagonal(hic_ma.matrix, max_value)
+
+    def has_main_diagonal(self, matrix_file):
+        """
+        Returns True if some pixels of matrix_file are on the main diagonal.
+        The pixels of cool files are read by chunks until one is found,
+        the other files are considered without main diagonal.
+        """
+        if not cooler.fileops.is_cooler(matrix_file):
+            return False
+        pixels = cooler.Cooler(matrix_file).pixels()
+        for start in range(0, len(pixels), self.PIXELS_CHUNK_SIZE):
+            chunk = pixels[['bin1_id', 'bin2_id']][start:start + self.PIXELS_CHUNK_SIZE]
+            if (chunk['bin1_id'] == chunk['bin2_id']).any():
+                return True
+        return False
+
+    def get_matrix_summary(self, matrix_file):
+        """
+        Returns the summary (see summarize_windows) of the whole
+        matrix_file (see load_summary_windows). It does not depend
+        on the regions plotted and is computed once for the whole run.
+        """
+        if matrix_file not in self.matrix_summaries:
+            # The summary is shared by the tracks with the same
+            # parameters and kept for the whole run in lazy loading mode
+            key = ('matrix_summary', self.TRACK_TYPE, matrix_file,
+                   self.properties.get('depth'),
+                   self.properties['show_masked_bins'],
+                   self.properties['transform'],
+                   self.properties['scale_factor'],
+                   self.properties.get('min_max_from'))
+            self.matrix_summaries[matrix_file] = \
+                self.get_shared_data(key,
+                                     lambda: self.summarize_windows(self.load_summary_windows(matrix_file)),
+                                     whole_run=True)
+        return self.matrix_summaries[matrix_file]
+
+    def load_summary_windows(self, matrix_file):
+        """
+        Loads the whole matrix_file one chromosome after the other
+        (see load_window) and yields the matrix of each chromosome.
+        The files which are not cool files are loaded at once.
+        """
+        if cooler.fileops.is_cooler(matrix_file):
+            regions = [[chrom] for chrom in cooler.Cooler(matrix_file).chromnames]
+        else:
+            regions = [None]
+        for region in regions:
+            hic_ma = self.load_window(region, matrix_file)[0]
+            if hic_ma.matrix.shape[0] > 0:
+                yield hic_ma
+
+    def summarize_windows(self, windows):
+        """
+        Returns a dictionary with the values which are used for all regions
+        computed on the HiCMatrix of windows (matrices without common bins).
+        The matrices are summarized one by one (see add_to_summary).
+        """
+        summary = {'diagonal_sum': 0, 'max_value': None}
+        for hic_ma in windows:
+            self.add_to_summary(summary, hic_ma)
+        return self.finish_summary(summary)
+
+    def add_to_summary(self, summary, hic_ma):
+        """
+        Adds the values of the matrix to the summary being computed.
+        """
+        summary['diagonal_sum'] += sum(hic_ma.matrix.diagonal())
+        if len(hic_ma.matrix.data) > 0:
+            max_value = hic_ma.matrix.data.max()
+            if summary['max_value'] is None or max_value > summary['max_value']:
+                summary['max_value'] = max_value
+
+    def finish_summary(self, summary):
+        """
+        Returns the summary once all the matrices were added.
+        """
+        main_diagonal_value = None
+        if summary['diagonal_sum'] == 0:
+            main_diagonal_value = summary['max_value']
+        return {'main_diagonal_value': main_diagonal_value}
+
+    def get_bins_in_region(self, chrom_region, start_bp, end_bp):
+        """
+        Returns the indices of the bins of chrom_region which are
+        between start_bp and end_bp and the tuple with
+        the start positions of these bins and the end of the last one
+        (None if there is no bin).
+        """
+        chr_start_id, chr_end_id = self.hic_ma.getChrBinRange(chrom_region)
+        starts = self.bin_starts[chr_start_id:chr_end_id]
+        ends = self.bin_ends[chr_start_id:chr_end_id]
+        idx = chr_start_id + np.flatnonzero((starts >= start_bp) & (ends <= end_bp))
+        if len(idx) == 0:
+            return idx, None
+        return idx, tuple(self.bin_starts[idx]) + (self.bin_ends[idx[-1]],)
 
     def check_before_plotting(self, chrom_region, region_start, region_end, suffix=''):
-        if len(self.hic_ma.matrix.data) == 0:
+        if len(self.hic_ma.matrix.data) == 0 and \
+                (not self.windowed or self.hic_ma.matrix.shape[0] == 0):
             self.log.warning("*Warning*\nThere is no data for the region "
                              "considered on the matrix. "
                              "This will generate an empty track!!\n")
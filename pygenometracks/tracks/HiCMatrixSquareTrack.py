@@ -26,6 +26,8 @@ file_type = {TRACK_TYPE}
     DEFAULTS_PROPERTIES = dict({'region2': None},
                                **HiCMatrixLikeTrack.DEFAULTS_PROPERTIES)
     STRING_PROPERTIES = HiCMatrixLikeTrack.STRING_PROPERTIES + ['region2']
+    # 3 bins are plotted on each side of the regions
+    MARGIN_IN_BINS = 3
 
     def set_properties_defaults(self):
         # First I add region2 to region to get the matrix
@@ -35,8 +37,15 @@ file_type = {TRACK_TYPE}
             self.properties['region'].append(region2)
         super(HiCMatrixSquareTrack, self).set_properties_defaults()
 
+    def get_plotted_regions(self, regions):
+        # region2 was added at the end of the regions
+        if regions is not None and self.properties['region2'] is not None:
+            return regions[:-1]
+        return regions
+
     def plot(self, ax, chrom_region, region_start, region_end):
 
+        self.use_region_data(chrom_region, region_start, region_end)
         continue_plotting, chrom_region = self.check_before_plotting(chrom_region, region_start, region_end)
         if not continue_plotting:
             return
@@ -47,15 +56,13 @@ file_type = {TRACK_TYPE}
         chr_end_x = self.hic_ma.cut_intervals[chr_end_id_x - 1][2]
         start_bp_x = max(chr_start_x, region_start - 3 * self.hic_ma.getBinSize())
         end_bp_x = min(chr_end_x, region_end + 3 * self.hic_ma.getBinSize())
-        idx = [idx for idx, x in enumerate(self.hic_ma.cut_intervals)
-               if x[0] == chrom_region and x[1] >= start_bp_x and x[2] <= end_bp_x]
+        idx, start_pos = self.get_bins_in_region(chrom_region, start_bp_x, end_bp_x)
         if len(idx) == 0:
             self.log.warning("*Warning*\nThere is no data for the region "
                              "considered on the matrix. "
                              "This will generate an empty track!!\n")
             self.img = None
             return
-        start_pos = [x[1] for i, x in enumerate(self.hic_ma.cut_intervals) if i in idx]
 
         # Process region2:
         if self.properties['region2'] is None:
@@ -75,21 +82,16 @@ file_type = {TRACK_TYPE}
             chr_end_y = self.hic_ma.cut_intervals[chr_end_id_y - 1][2]
             start_bp_y = max(chr_start_y, region_start_y - 3 * self.hic_ma.getBinSize())
             end_bp_y = min(chr_end_y, region_end_y + 3 * self.hic_ma.getBinSize())
-            idx_y = [idx for idx, x in enumerate(self.hic_ma.cut_intervals)
-                     if x[0] == chrom_region_y and x[1] >= start_bp_y and x[2] <= end_bp_y]
+            idx_y, start_pos_y = self.get_bins_in_region(chrom_region_y, start_bp_y, end_bp_y)
             if len(idx_y) == 0:
                 self.log.warning("*Warning*\nThere is no data for the region "
                                  "considered on the matrix. "
                                  "This will generate an empty track!!\n")
                 self.img = None
                 return
-            start_pos_y = [x[1] for i, x in enumerate(self.hic_ma.cut_intervals) if i in idx_y]
 
         # select only relevant matrix part
         matrix = self.hic_ma.matrix[idx, :][:, idx_y]
-        # update the start_pos to add the last end:
-        start_pos = tuple(list(start_pos) + [self.hic_ma.cut_intervals[idx[-1]][2]])
-        start_pos_y = tuple(list(start_pos_y) + [self.hic_ma.cut_intervals[idx_y[-1]][2]])
         # Using todense will replace all nan values by 0.
         matrix = np.asarray(matrix.todense().astype(float))
 
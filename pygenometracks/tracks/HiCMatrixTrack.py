@@ -1,15 +1,73 @@
-import scipy.sparse
 from matplotlib import colors
+from matplotlib.image import AxesImage
 import numpy as np
 from . HiCMatrixLikeTrack import HiCMatrixLikeTrack
 import logging
-import itertools
+from .. utilities import sparse_band_values, band_diagonal, DiagonalStats
 
 DEFAULT_MATRIX_COLORMAP = 'RdYlBu_r'
 logging.basicConfig(level=logging.DEBUG)
 log = logging.getLogger(__name__)
 
 
+class BandImage(AxesImage):
+    """
+    Image of the matrix stored in band (see sparse_to_band)
+    turned 45 degrees. The image is computed when it is drawn,
+    with one value per pixel of the axes, so the time depends
+    on the size of the output and not on the number of bins.
+    """
+
+    def __init__(self, ax, band, start_pos_vector, outside_value=0, **kwargs):
+        super(BandImage, self).__init__(ax, interpolation='nearest',
+                                        origin='lower', **kwargs)
+        self.band = band
+        self.start_pos_vector = np.asarray(start_pos_vector, dtype=float)
+        self.outside_value = outside_value
+        # The values are used to scale the norm if needed
+        # before the first draw
+        self.set_data(band)
+
+    def band_to_rgba(self, x, y):
+        """
+        Returns the colors at the positions x (columns) and y (rows).
+        The pixels outside of the matrix are transparent.
+        """
+        n, number_of_diagonals = self.band.shape
+        # The pixel x, y is in the bin i, j of the matrix with
+        # x = (pos_i + pos_j) / 2 and y = pos_j - pos_i
+        i = np.searchsorted(self.start_pos_vector,
+                            x[np.newaxis, :] - y[:, np.newaxis] / 2,
+                            side='right') - 1
+        j = np.searchsorted(self.start_pos_vector,
+                            x[np.newaxis, :] + y[:, np.newaxis] / 2,
+                            side='right') - 1
+        in_matrix = (i >= 0) & (i < n) & (j >= 0) & (j < n)
+        offsets = j - i
+        in_band = in_matrix & (offsets >= 0) & (offsets < number_of_diagonals)
+        values = np.full(i.shape, self.outside_value, dtype=float)
+        values[in_band] = self.band[i[in_band], offsets[in_band]]
+        # like for pcolormesh, the colors are rounded to 8 bits
+        rgba = np.round(self.to_rgba(values) * 255).astype(np.uint8)
+        rgba[~in_matrix, 3] = 0
+        return rgba
+
+    def draw(self, renderer, *args, **kwargs):
+        ax = self.axes
+        bbox = ax.get_window_extent(renderer)
+        magnification = renderer.get_image_magnification()
+        width = max(1, int(round(bbox.width * magnification)))
+        height = max(1, int(round(bbox.height * magnification)))
+        x_start, x_end = ax.get_xlim()
+        y_start, y_end = ax.get_ylim()
+        # the value of each pixel is the value at its center
+        x = x_start + (np.arange(width) + 0.5) * (x_end - x_start) / width
+        y = y_start + (np.arange(height) + 0.5) * (y_end - y_start) / height
+        self.set_data(self.band_to_rgba(x, y))
+        self.set_extent((x_start, x_end, y_start, y_end))
+        super(BandImage, self).draw(renderer, *args, **kwargs)
+
+
 class HiCMatrixTrack(HiCMatrixLikeTrack):
     SUPPORTED_ENDINGS = ['.h5', '.cool', '.mcool']
     TRACK_TYPE = 'hic_matrix'
@@ -18,16 +76,36 @@ class HiCMatrixTrack(HiCMatrixLikeTrack):
 # If it is more than 125% of the plotted region, it will
 # be adjsted to this maximum value.
 depth = 100000
+# By default, each bin of the matrix is plotted with pcolormesh.
+# With renderer = image, the matrix is converted to an image
+# with the resolution of the output (one value per pixel),
+# which is faster for large regions.
+#renderer = image
+# When min_value or max_value are not set, they are computed
+# from the values of the region plotted.
+# With min_max_from = matrix, they are computed once
+# from the whole matrix so all regions have the same scale
+# whatever the regions plotted. The matrix is read
+# one chromosome after the other.
+#min_max_from = matrix
 file_type = {TRACK_TYPE}
     """
-    DEFAULTS_PROPERTIES = dict({'depth': 100000},
+    DEFAULTS_PROPERTIES = dict({'depth': 100000,
+                                'renderer': 'pcolormesh',
+                                'min_max_from': 'region'},
                                **HiCMatrixLikeTrack.DEFAULTS_PROPERTIES)
+    POSSIBLE_PROPERTIES = dict({'renderer': ['pcolormesh', 'image'],
+                                'min_max_from': ['region', 'matrix']},
+                               **HiCMatrixLikeTrack.POSSIBLE_PROPERTIES)
+    STRING_PROPERTIES = HiCMatrixLikeTrack.STRING_PROPERTIES + ['renderer',
+                                                                'min_max_from']
     INTEGER_PROPERTIES = dict({'depth': [1, np.inf]},
                               **HiCMatrixLikeTrack.INTEGER_PROPERTIES)
     # The colormap can only be a colormap
 
     def plot(self, ax, chrom_region, region_start, region_end):
 
+        self.use_region_data(chrom_region, region_start, region_end)
         continue_plotting, chrom_region = self.check_before_plotting(chrom_region, region_start, region_end)
         if not continue_plotting:
             return
@@ -40,19 +118,15 @@ file_type = {TRACK_TYPE}
         chr_end = self.hic_ma.cut_intervals[chr_end_id - 1][2]
         start_bp = max(chr_start, region_start - self.properties['depth'])
         end_bp = min(chr_end, region_end + self.properties['depth'])
-        idx = [idx for idx, x in enumerate(self.hic_ma.cut_intervals)
-               if x[0] == chrom_region and x[1] >= start_bp and x[2] <= end_bp]
+        idx, start_pos = self.get_bins_in_region(chrom_region, start_bp, end_bp)
         if len(idx) == 0:
             self.log.warning("*Warning*\nThere is no data for the region "
                              "considered on the matrix. "
                              "This will generate an empty track!!\n")
             self.img = None
             return
-        start_pos = [x[1] for i, x in enumerate(self.hic_ma.cut_intervals) if i in idx]
         # select only relevant matrix part
         matrix = self.hic_ma.matrix[idx, :][:, idx]
-        # update the start_pos to add the last end:
-        start_pos = tuple(list(start_pos) + [self.hic_ma.cut_intervals[idx[-1]][2]])
         # limit the 'depth' based on the length of the region being viewed
 
         region_len = region_end - region_start
@@ -60,60 +134,53 @@ file_type = {TRACK_TYPE}
         # Need to be sure that you keep at least one bin even if the depth is
         # smaller than the binsize
         depth_in_bins = max(1, int(1.5 * region_len / self.hic_ma.getBinSize()))
+        # The matrix has no value beyond the limit of reduce_matrix
+        number_of_diagonals = 2 * int(self.properties['depth'] / self.hic_ma.getBinSize())
 
         if depth < self.properties['depth']:
             log.warning(f"The depth was set to {self.properties['depth']} which is more than 125%"
                         " of the region plotted. The depth will be set "
                         f"to {depth}.\n")
             # remove from matrix all data points that are not visible.
-            matrix = matrix - scipy.sparse.triu(matrix, k=depth_in_bins, format='csr')
-        # Using todense will replace all nan values by 0.
-        matrix = np.asarray(matrix.todense().astype(float))
-
-        matrix = matrix * self.properties['scale_factor']
+            number_of_diagonals = min(number_of_diagonals, depth_in_bins)
+        # Only the diagonals with values are extracted:
+        # band[i, d] is the value of the matrix at i, i + d.
+        # The pixels outside of the band have the value outside_value.
+        number_of_diagonals = max(1, min(number_of_diagonals, matrix.shape[0]))
+        rows, offsets, values = sparse_band_values(matrix, number_of_diagonals)
+        # The values stored are transformed, the other pixels
+        # have the value of a transformed 0 (outside_value)
+        values, outside_value = self.transform_band_values(values)
+        band = np.full((matrix.shape[0], number_of_diagonals), outside_value)
+        band[rows, offsets] = values
 
-        if self.properties['transform'] == 'log1p':
-            matrix += 1
-
-        elif self.properties['transform'] in ['-log', 'log']:
-            # We first replace 0 values by minimum values after 0
-            mask = matrix == 0
-            try:
-                matrix[mask] = matrix[mask == False].min()
-                matrix = np.log(matrix)
-            except ValueError:
-                self.log.info('All values are 0, no log applied.')
-            else:
-                if self.properties['transform'] == '-log':
-                    matrix = - matrix
+        if self.properties['min_max_from'] == 'matrix' and \
+                (self.properties['max_value'] is None
+                 or self.properties['min_value'] is None):
+            matrix_vmin, matrix_vmax = self.matrix_summary['min_max']
 
         if self.properties['max_value'] is not None:
             vmax = self.properties['max_value']
-
+        elif self.properties['min_max_from'] == 'matrix':
+            vmax = matrix_vmax
         else:
             # try to use a 'aesthetically pleasant' max value
             try:
-                vmax = np.percentile(matrix.diagonal(1), 80)
+                vmax = np.percentile(band_diagonal(band, 1, outside_value), 80)
             except Exception:
                 vmax = None
 
         if self.properties['min_value'] is not None:
             vmin = self.properties['min_value']
+        elif self.properties['min_max_from'] == 'matrix':
+            vmin = matrix_vmin
         else:
-            if depth_in_bins > matrix.shape[0]:
-                # Make sure you keep one bin
-                depth_in_bins = max(1, matrix.shape[0] - 5)
-
             # if the region length is large with respect to the chromosome length, the diagonal may have
-            # very few values or none. Thus, the following lines reduce the number of bins until the
-            # diagonal is at least length 5 but make sure you have at least one value:
+            # very few values or none. Thus, the diagonal used is the most distant
+            # one which has at least 6 values (or the main diagonal):
             num_bins_from_diagonal = max(1, int(region_len / self.hic_ma.getBinSize()))
-            for num_bins in range(0, num_bins_from_diagonal)[::-1]:
-                distant_diagonal_values = matrix.diagonal(num_bins)
-                if len(distant_diagonal_values) > 5:
-                    break
-
-            vmin = np.median(distant_diagonal_values)
+            num_bins = max(0, min(num_bins_from_diagonal - 1, band.shape[0] - 6))
+            vmin = np.median(band_diagonal(band, num_bins, outside_value))
 
         self.log.info("setting min, max values for track "
                       f"{self.properties['section_name']} to: "
@@ -124,31 +191,160 @@ file_type = {TRACK_TYPE}
         else:
             self.current_norm = colors.Normalize(vmin=vmin, vmax=vmax)
 
-        self.last_img_plotted = self.pcolormesh_45deg(ax, matrix, start_pos)
-        if self.properties['rasterize']:
-            self.last_img_plotted.set_rasterized(True)
+        if self.properties['renderer'] == 'image':
+            images = [BandImage(ax, band, start_pos, outside_value,
+                                cmap=self.cmap, norm=self.current_norm)]
+            ax.add_image(images[0])
+        else:
+            images = self.pcolormesh_45deg(ax, band, start_pos, depth, outside_value)
+            # an image is always rasterized
+            if self.properties['rasterize']:
+                for img in images:
+                    img.set_rasterized(True)
+        self.last_img_plotted = images[0]
         if self.properties['orientation'] == 'inverted':
             ax.set_ylim(depth, 0)
         else:
             ax.set_ylim(0, depth)
 
-    def pcolormesh_45deg(self, ax, matrix_c, start_pos_vector):
+    def transform_band_values(self, values):
+        """
+        Scales and transforms the values stored in the band.
+        :return: the transformed values and the value of the pixels
+        without value (0 once transformed)
+        """
+        values = values.astype(float) * self.properties['scale_factor']
+        outside_value = 0.
+
+        if self.properties['transform'] == 'log1p':
+            values += 1
+            outside_value += 1
+
+        elif self.properties['transform'] in ['-log', 'log']:
+            # We first replace 0 values by minimum values after 0
+            mask = values == 0
+            try:
+                outside_value = values[mask == False].min()
+                values[mask] = outside_value
+                values = np.log(values)
+                outside_value = np.log(outside_value)
+            except ValueError:
+                self.log.info('All values are 0, no log applied.')
+            else:
+                if self.properties['transform'] == '-log':
+                    values = - values
+                    outside_value = - outside_value
+        return values, outside_value
+
+    def needs_matrix_summary(self):
+        return self.properties['min_max_from'] == 'matrix' and \
+            (self.properties['max_value'] is None
+             or self.properties['min_value'] is None)
+
+    def add_to_summary(self, summary, hic_ma):
+        """
+        Adds the diagonals used for the min and max values
+        (see finish_summary) one chromosome at a time (see DiagonalStats).
+        """
+        super(HiCMatrixTrack, self).add_to_summary(summary, hic_ma)
+        if self.properties['min_max_from'] != 'matrix':
+            return
+        if 'diagonal_stats' not in summary:
+            summary['depth_in_bins'] = max(1, int(self.properties['depth'] / hic_ma.getBinSize()))
+            summary['diagonal_stats'] = DiagonalStats([1, summary['depth_in_bins']])
+            summary['min_positive_value'] = None
+        for chr_start_id, chr_end_id in hic_ma.chrBinBoundaries.values():
+            summary['diagonal_stats'].add(hic_ma.matrix[chr_start_id:chr_end_id, chr_start_id:chr_end_id])
+        positive_values = hic_ma.matrix.data[hic_ma.matrix.data > 0]
+        if len(positive_values) > 0:
+            min_positive_value = positive_values.min()
+            if summary['min_positive_value'] is None or \
+                    min_positive_value < summary['min_positive_value']:
+                summary['min_positive_value'] = min_positive_value
+
+    def finish_summary(self, summary):
+        """
+        With min_max_from = matrix, adds the min and max values of the
+        matrices computed like for a region: the max value is the
+        80th percentile of the first diagonal and the min value is
+        the median of the diagonal at depth.
+        """
+        matrix_summary = super(HiCMatrixTrack, self).finish_summary(summary)
+        if self.properties['min_max_from'] != 'matrix':
+            return matrix_summary
+        if summary['max_value'] is None:
+            # There is no value in the matrices
+            matrix_summary['min_max'] = (None, None)
+            return matrix_summary
+        stats = summary['diagonal_stats']
+        min_positive_value = summary['min_positive_value']
+        depth_in_bins = summary['depth_in_bins']
+        # -log reverses the order of the values
+        max_percentile = 20 if self.properties['transform'] == '-log' else 80
+        vmax = stats.percentile(1, max_percentile)
+        vmin = stats.percentile(depth_in_bins, 50)
+        if vmax is not None:
+            vmax = self.transform_value(vmax, min_positive_value)
+        if vmin is not None:
+            vmin = self.transform_value(vmin, min_positive_value)
+        matrix_summary['min_max'] = (vmin, vmax)
+        return matrix_summary
+
+    def transform_value(self, value, min_positive_value):
+        """
+        Returns the value of the matrix once scaled and transformed
+        like in plot (0 is replaced by the min_positive_value
+        for the log transformations).
+        """
+        value = value * self.properties['scale_factor']
+        if self.properties['transform'] == 'log1p':
+            value += 1
+        elif self.properties['transform'] in ['-log', 'log']:
+            if min_positive_value is None:
+                # All values are 0, no log is applied
+                return value
+            value = np.log(max(value, min_positive_value * self.properties['scale_factor']))
+            if self.properties['transform'] == '-log':
+                value = - value
+        return value
+
+    def pcolormesh_45deg(self, ax, band, start_pos_vector, depth,
+                         outside_value=0):
         """
-        Turns the matrix 45 degrees and adjusts the
-        bins to match the actual start end positions.
+        Turns the matrix stored in band (see sparse_to_band) 45 degrees
+        and adjusts the bins to match the actual start end positions.
+        The matrix is plotted by blocks of rows. Each block
+        is the rectangle of the matrix with all the pixels of its rows
+        below depth, so the matrix is never made dense.
+        Returns the list of QuadMesh.
         """
-        # code for rotating the image 45 degrees
-        n = matrix_c.shape[0]
-        # create rotation/scaling matrix
-        t = np.array([[1, 0.5], [-1, 0.5]])
-        # create coordinate matrix and transform it
-        matrix_a = np.dot(np.array([(i[1], i[0])
-                                    for i in itertools.product(start_pos_vector[::-1],
-                                                               start_pos_vector)]), t)
-        # this is to convert the indices into bp ranges
-        x = matrix_a[:, 1].reshape(n + 1, n + 1)
-        y = matrix_a[:, 0].reshape(n + 1, n + 1)
-        # plot
-        im = ax.pcolormesh(x, y, np.flipud(matrix_c),
-                           cmap=self.cmap, norm=self.current_norm)
-        return im
+        n, number_of_diagonals = band.shape
+        start_pos_vector = np.asarray(start_pos_vector, dtype=float)
+        rows_per_block = max(64, number_of_diagonals)
+        images = []
+        # The rows are plotted from the last one (like the previous
+        # version with np.flipud) because the pixels on the edges of
+        # the bins take the color of the last bin plotted
+        for first_row in range(0, n, rows_per_block)[::-1]:
+            last_row = min(n, first_row + rows_per_block)
+            # The pixel i, j is visible when
+            # start_pos_vector[j] - start_pos_vector[i + 1] < depth
+            last_col = max(np.searchsorted(start_pos_vector,
+                                           start_pos_vector[last_row] + depth),
+                           last_row + number_of_diagonals - 1)
+            last_col = min(n, last_col)
+            rows = np.arange(first_row, last_row)[:, np.newaxis]
+            cols = rows + np.arange(number_of_diagonals)
+            in_block = cols < last_col
+            block = np.full((last_row - first_row, last_col - first_row),
+                            outside_value, dtype=float)
+            block[np.broadcast_to(rows, cols.shape)[in_block] - first_row,
+                  cols[in_block] - first_row] = band[first_row:last_row][in_block]
+            # this is to convert the indices into bp ranges
+            row_pos = start_pos_vector[first_row:last_row + 1, np.newaxis]
+            col_pos = start_pos_vector[np.newaxis, first_row:last_col + 1]
+            x = (col_pos + row_pos) / 2
+            y = col_pos - row_pos
+            images.append(ax.pcolormesh(x[::-1], y[::-1], np.flipud(block),
+                                        cmap=self.cmap, norm=self.current_norm))
+        return images
@@ -1,10 +1,9 @@
 from . GenomeTrack import GenomeTrack
 from pygenometracks.utilities import InputError
-from intervaltree import IntervalTree, Interval
 import matplotlib
 import numpy as np
 from matplotlib.patches import Arc, Polygon
-from .. utilities import opener, to_string, change_chrom_names, temp_file_from_intersect, get_region
+from .. utilities import opener, to_string, change_chrom_names, open_intersected, get_region, intervals_to_index
 from tqdm import tqdm
 
 DEFAULT_LINKS_COLOR = 'blue'
@@ -129,7 +128,14 @@ file_type = {TRACK_TYPE}
                                  "\n")
                 self.properties['use_middle'] = False
 
-        self.interval_tree, min_score, max_score, has_score = self.process_link_file(self.properties['region'])
+        load_key = ('process_link_file', self.properties['file'],
+                    self.properties['region'], self.properties['region2'],
+                    self.properties['use_middle'])
+        self.interval_tree, min_score, max_score, has_score = \
+            self.get_shared_data(load_key,
+                                 lambda: self.load_with_file_cache(
+                                     load_key,
+                                     lambda: self.process_link_file(self.properties['region'])))
         if self.properties['line_width'] is None and not has_score:
             self.log.warning("*WARNING* for section "
                              f"{self.properties['section_name']}"
@@ -417,21 +423,21 @@ file_type = {TRACK_TYPE}
         # where the last value is a score.
 
         if plot_regions is None:
-            file_to_open = self.properties['file']
+            file_h = opener(self.properties['file'])
         else:
             # To be sure we do not miss links we will intersect with bed with
             # only chromosomes used in plot_regions
             plot_regions_adapted = [(chrom, 0, HUGE_NUMBER) for chrom, __, __ in plot_regions]
-            file_to_open = temp_file_from_intersect(self.properties['file'],
-                                                    plot_regions_adapted)
+            file_h = open_intersected(self.properties['file'],
+                                      plot_regions_adapted)
 
         valid_intervals = 0
-        interval_tree = {}
+        # For each chromosome, the list of (start, end, data)
+        intervals = {}
         line_number = 0
         has_score = True
         max_score = float('-inf')
         min_score = float('inf')
-        file_h = opener(file_to_open)
         for line in tqdm(file_h.readlines()):
             line_number += 1
             line = to_string(line)
@@ -498,8 +504,8 @@ file_type = {TRACK_TYPE}
                     if score > max_score:
                         max_score = score
 
-            if chrom1 not in interval_tree:
-                interval_tree[chrom1] = IntervalTree()
+            if chrom1 not in intervals:
+                intervals[chrom1] = []
             if start2 < start1 and not is_trans:
                 start1, start2 = start2, start1
                 end1, end2 = end2, end1
@@ -507,20 +513,22 @@ file_type = {TRACK_TYPE}
                 mid1 = (start1 + end1) / 2
                 mid2 = (start2 + end2) / 2
                 if mid1 < mid2:
-                    interval_tree[chrom1].add(Interval(mid1, mid2, [start1, end1, start2, end2, score]))
+                    intervals[chrom1].append((mid1, mid2, [start1, end1, start2, end2, score]))
                 else:
-                    interval_tree[chrom1].add(Interval(mid2, mid1, [start2, end2, start1, end1, score]))
+                    intervals[chrom1].append((mid2, mid1, [start2, end2, start1, end1, score]))
             else:
                 if not is_trans:
                     # each interval spans from the smallest start to the largest end
-                    interval_tree[chrom1].add(Interval(start1, max(end1, end2), [start1, end1, start2, end2, score]))
+                    intervals[chrom1].append((start1, max(end1, end2), [start1, end1, start2, end2, score]))
                 else:
                     # For the trans we keep start1 and end1
-                    interval_tree[chrom1].add(Interval(start1, end1, [start1, end1, start2, end2, score]))
+                    intervals[chrom1].append((start1, end1, [start1, end1, start2, end2, score]))
             valid_intervals += 1
 
         if valid_intervals == 0:
             self.log.warning(f"No valid intervals were found in file {self.properties['file']}.\n")
 
         file_h.close()
+        interval_tree = {chrom: intervals_to_index(chrom_intervals)
+                         for chrom, chrom_intervals in intervals.items()}
         return interval_tree, min_score, max_score, has_score
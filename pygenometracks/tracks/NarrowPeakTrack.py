@@ -93,6 +93,9 @@ file_type = {TRACK_TYPE}
         path = Path(verts, codes)
         return patches.PathPatch(path)
 
+    def fetch_data(self, chrom_region, start_region, end_region):
+        return self.get_scores(chrom_region, start_region, end_region, return_nans=False)
+
     def plot(self, ax, chrom_region, start_region, end_region):
         """
 
@@ -104,7 +107,7 @@ file_type = {TRACK_TYPE}
         Returns:
 
         """
-        score_list, pos_list = self.get_scores(chrom_region, start_region, end_region, return_nans=False)
+        score_list, pos_list = self.get_data(chrom_region, start_region, end_region)
         if pos_list == []:
             return
         self.patches = []
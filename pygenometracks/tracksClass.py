@@ -4,6 +4,8 @@ import logging
 import os
 from configparser import ConfigParser
 import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import matplotlib
 import matplotlib.pyplot as plt
@@ -13,7 +15,7 @@ import matplotlib.colors
 import matplotlib.gridspec
 import matplotlib.cm
 import mpl_toolkits.axisartist as axisartist
-from . utilities import file_to_intervaltree, change_chrom_names, MyBasePairFormatter, get_region
+from . utilities import file_to_intervaltree, change_chrom_names, MyBasePairFormatter, get_region, FileCache, DatasetRegistry, group_nearby_regions, BigWigPool
 from collections import OrderedDict
 from pygenometracks.tracks.GenomeTrack import GenomeTrack
 from pygenometracks.utilities import InputError
@@ -92,6 +94,16 @@ class VType(object):
                                  f"{default_value}.\n")
                 self.properties[prop] = default_value
 
+    def get_shared_data(self, key, loader):
+        """
+        Returns the dataset identified by key from the registry
+        of the PlotTracks (see GenomeTrack.get_shared_data).
+        """
+        registry = self.properties.get('dataset_registry')
+        if registry is None:
+            return loader()
+        return registry.get(key, loader)
+
     def process_color(self, param):
         """
         Put a valid color in self.properties[param]
@@ -154,8 +166,12 @@ type = {TYPE}
     def __init__(self, *args, **kwarg):
         super(VlineType, self).__init__(*args, **kwarg)
         # load the file as an interval tree
-        self.interval_tree, __, __ = file_to_intervaltree(self.properties['file'],
-                                                          self.properties['region'])
+        self.interval_tree, __, __ = \
+            self.get_shared_data(('file_to_intervaltree', self.properties['file'],
+                                  self.properties['region']),
+                                 lambda: file_to_intervaltree(self.properties['file'],
+                                                              self.properties['region'],
+                                                              file_cache=self.properties.get('file_cache')))
 
     def set_properties_defaults(self):
         super(VlineType, self).set_properties_defaults()
@@ -241,8 +257,12 @@ type = {TYPE}
     def __init__(self, *args, **kwarg):
         super(VhighlightType, self).__init__(*args, **kwarg)
         # load the file as an interval tree
-        self.interval_tree, __, __ = file_to_intervaltree(self.properties['file'],
-                                                          self.properties['region'])
+        self.interval_tree, __, __ = \
+            self.get_shared_data(('file_to_intervaltree', self.properties['file'],
+                                  self.properties['region']),
+                                 lambda: file_to_intervaltree(self.properties['file'],
+                                                              self.properties['region'],
+                                                              file_cache=self.properties.get('file_cache')))
 
     def set_properties_defaults(self):
         super(VhighlightType, self).set_properties_defaults()
@@ -305,13 +325,40 @@ class PlotTracks(object):
     def __init__(self, tracks_file, fig_width=DEFAULT_FIGURE_WIDTH,
                  fig_height=None, fontsize=None, dpi=None,
                  track_label_width=0.1,
-                 plot_regions=None, plot_width=None):
+                 plot_regions=None, plot_width=None,
+                 fetch_threads=1, cache_dir=None, cache_size=1000,
+                 lazy_loading=False, merge_distance=None,
+                 run_data=None):
         self.fig_width = fig_width
         self.fig_height = fig_height
         self.dpi = dpi
+        self.fetch_threads = fetch_threads
+        if cache_dir is not None:
+            self.file_cache = FileCache(cache_dir, cache_size)
+        else:
+            self.file_cache = None
+        # The bigwig files are opened once for all tracks
+        self.bigwig_pool = BigWigPool()
+        # The datasets computed for all the regions plotted
+        # are kept for the whole run (run_data are the
+        # datasets already computed, see compute_run_data)
+        self.run_registry = DatasetRegistry(run_data)
+        self.plot_regions = plot_regions
+        # In lazy loading mode, the tracks are initialized
+        # only with the group of nearby regions being plotted
+        self.lazy_loading = lazy_loading
+        self.load_groups = {}
+        if lazy_loading and plot_regions is not None:
+            for group in group_nearby_regions(plot_regions, merge_distance):
+                for region in group:
+                    self.load_groups[region] = group
+        self.loaded_group = None
+        # In lazy loading mode, the tracks are not released
+        # while they are used to read the data of another region
+        self.load_condition = threading.Condition()
+        self.active_fetches = 0
         self.type_list = None
         self.track_list = None
-        start = self.print_elapsed(None)
         self.available_tracks = self.get_available_tracks()
         self.available_types = self.get_available_types()
         self.parse_tracks(tracks_file, plot_regions=plot_regions)
@@ -335,25 +382,96 @@ class PlotTracks(object):
 
         font = {'size': fontsize}
         matplotlib.rc('font', **font)
+        self.track_obj_list = []
+        self.type_obj_list = []
+        if not self.lazy_loading:
+            self.init_tracks(plot_regions)
+
+    def init_tracks(self, plot_regions):
+        """
+        Creates the track and type objects
+        which load the data of plot_regions.
+        """
+        start = self.print_elapsed(None)
+        # The files used by several sections are loaded once
+        self.dataset_registry = DatasetRegistry()
         # initialize each track
         self.track_obj_list = []
         for idx, properties in enumerate(self.track_list):
             log.info(f"initialize {properties['section_name']}")
+            if self.lazy_loading:
+                # The tracks modify their properties
+                # and will be initialized again
+                properties = properties.copy()
             track_class = properties['track_class']
             properties['region'] = plot_regions.copy()
+            properties['file_cache'] = self.file_cache
+            properties['dataset_registry'] = self.dataset_registry
+            properties['bigwig_pool'] = self.bigwig_pool
+            # In lazy loading mode, the tracks need to know
+            # all the regions which will be plotted
+            properties['all_regions'] = self.plot_regions
+            properties['run_registry'] = self.run_registry
             self.track_obj_list.append(track_class(properties))
 
         # initialize each type
         self.type_obj_list = []
         for idx, properties in enumerate(self.type_list):
             log.info(f"initialize {properties['section_name']}")
+            if self.lazy_loading:
+                properties = properties.copy()
             track_class = properties['track_class']
             properties['region'] = plot_regions.copy()
+            properties['file_cache'] = self.file_cache
+            properties['dataset_registry'] = self.dataset_registry
             self.type_obj_list.append(track_class(properties))
 
         log.info("time initializing track(s):")
         self.print_elapsed(start)
 
+    def compute_run_data(self):
+        """
+        Computes the datasets kept for the whole run by the tracks
+        (see GenomeTrack.compute_run_data) and returns them.
+        Only the tracks which have such datasets are created.
+        """
+        for properties in self.track_list:
+            track_class = properties['track_class']
+            if track_class.compute_run_data is GenomeTrack.compute_run_data:
+                continue
+            log.info(f"computing the data of {properties['section_name']} for all regions")
+            properties = properties.copy()
+            properties['region'] = self.plot_regions.copy()
+            properties['file_cache'] = self.file_cache
+            properties['all_regions'] = self.plot_regions
+            properties['run_registry'] = self.run_registry
+            track_class(properties).compute_run_data()
+        return self.run_registry.datasets
+
+    def load_region(self, chrom, start, end):
+        """
+        In lazy loading mode, initializes the tracks with
+        the group of nearby regions containing this region only
+        and releases the data of the previously loaded group.
+        Returns True if the tracks were initialized.
+        """
+        group = self.load_groups.get((chrom, start, end), [(chrom, start, end)])
+        with self.load_condition:
+            if group == self.loaded_group:
+                return False
+            self.load_condition.wait_for(lambda: self.active_fetches == 0)
+            if self.loaded_group is not None:
+                log.info("releasing the data of "
+                         f"{self.loaded_group[0][0]}:{self.loaded_group[0][1]}-"
+                         f"{max([r[2] for r in self.loaded_group])}")
+                self.close_files()
+                self.track_obj_list = []
+                self.type_obj_list = []
+                self.dataset_registry = None
+            self.init_tracks(group)
+            self.loaded_group = group
+        return True
+
     @staticmethod
     def get_available_tracks():
         avail_tracks = {}
@@ -399,6 +517,10 @@ class PlotTracks(object):
         """
         track_height = []
         for i, track_dict in enumerate(self.track_list):
+            if self.lazy_loading and len(self.track_obj_list) == len(self.track_list):
+                # The tracks were initialized with a copy of
+                # the properties which contains the default values
+                track_dict = self.track_obj_list[i].properties
             if i == 0 and track_dict['overlay_previous'] != 'no':
                 log.warning("First track can not have the `overlay_previous` option.\n")
                 self.track_list[i]['overlay_previous'] = 'no'
@@ -470,8 +592,55 @@ class PlotTracks(object):
 
         return track_height
 
+    def prefetch_data(self, chrom, start, end):
+        """
+        Reads the data of all tracks for the region.
+        When fetch_threads is above 1, the tracks are read
+        concurrently, so the I/O of the different files overlap.
+        The data is stored in each track until it is plotted.
+        """
+        if not self.lazy_loading:
+            self.prefetch_tracks_data(self.track_obj_list, chrom, start, end)
+            return
+        with self.load_condition:
+            if (chrom, start, end) not in (self.loaded_group or []):
+                # The tracks of this region are not loaded yet
+                # The data will be read when the region is plotted
+                return
+            track_obj_list = self.track_obj_list
+            # The tracks must not be released while their data are read
+            self.active_fetches += 1
+        try:
+            self.prefetch_tracks_data(track_obj_list, chrom, start, end)
+        finally:
+            with self.load_condition:
+                self.active_fetches -= 1
+                self.load_condition.notify_all()
+
+    def prefetch_tracks_data(self, track_obj_list, chrom, start, end):
+        """
+        Reads the data of the tracks of track_obj_list for the region
+        (with fetch_threads threads).
+        """
+        if self.fetch_threads > 1 and len(track_obj_list) > 1:
+            with ThreadPoolExecutor(min(self.fetch_threads,
+                                        len(track_obj_list))) as executor:
+                futures = [executor.submit(track.prefetch_data, chrom, start, end)
+                           for track in track_obj_list]
+                # This will raise the errors if any:
+                for future in futures:
+                    future.result()
+        else:
+            for track in track_obj_list:
+                track.prefetch_data(chrom, start, end)
+
     def plot(self, file_name, chrom, start, end, title=None,
              h_align_titles='left', decreasing_x_axis=False):
+        if self.lazy_loading:
+            self.load_region(chrom, start, end)
+        # First phase: read all data
+        self.prefetch_data(chrom, start, end)
+        # Second phase: plot
         track_height = self.get_tracks_height(start_region=start,
                                               end_region=end)
 
@@ -747,6 +916,7 @@ class PlotTracks(object):
         """
         for track in self.track_obj_list:
             track.__del__()
+        self.bigwig_pool.close()
 
     @staticmethod
     def check_file_exists(track_dict, tracks_path, is_hic=False):
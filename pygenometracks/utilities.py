@@ -1,11 +1,19 @@
 import sys
 import os
+import ast
 import gzip
+import io
+import struct
+import zlib
+import hashlib
+import zipfile
 import numpy as np
-from tqdm import tqdm
-from intervaltree import IntervalTree, Interval
-import pybedtools
+import scipy.sparse
+import pyBigWig
+from collections import namedtuple, OrderedDict
+from itertools import repeat
 import tempfile
+import threading
 import warnings
 import logging
 from matplotlib.ticker import Formatter
@@ -52,147 +60,1442 @@ def opener(filename):
         return f
 
 
-def temp_file_from_intersect(file_name, plot_regions=None, around_region=0):
+def get_regions_by_chrom(plot_regions, around_region=0):
     """
-    intersect file_name with the plot_regions +/- around_region
+    Groups the plot_regions +/- around_region by chromosome
+    (with both version of chromosome name) and merge the overlapping ones.
+    :return: dictionary where the keys are the chromosome names (as bytes)
+             and the values are a tuple with the sorted starts and ends
+    """
+    regions = {}
+    for chrom, start, end in plot_regions:
+        for chrom_name in set([chrom, change_chrom_names(chrom)]):
+            regions.setdefault(chrom_name.encode(), []).append((max(0, start - around_region),
+                                                                end + around_region))
+    regions_by_chrom = {}
+    for chrom, chrom_regions in regions.items():
+        starts = []
+        ends = []
+        for start, end in sorted(chrom_regions):
+            if len(ends) > 0 and start <= ends[-1]:
+                ends[-1] = max(ends[-1], end)
+            else:
+                starts.append(start)
+                ends.append(end)
+        regions_by_chrom[chrom] = (np.array(starts), np.array(ends))
+    return regions_by_chrom
+
+
+def group_nearby_regions(plot_regions, max_gap=None):
+    """
+    Groups the plot_regions which can share the same data loading:
+    the regions of a chromosome sorted by position are put in the same
+    group while they are separated by at most max_gap bp
+    (all regions of a chromosome are in the same group if max_gap is None).
+    :return: list of groups (list of regions sorted by position),
+             the chromosomes are in the order of their first region
+    """
+    regions = {}
+    for region in plot_regions:
+        regions.setdefault(region[0], []).append(tuple(region))
+    groups = []
+    for chrom_regions in regions.values():
+        chrom_regions.sort(key=lambda r: (r[1], r[2]))
+        group = [chrom_regions[0]]
+        group_end = chrom_regions[0][2]
+        for region in chrom_regions[1:]:
+            if max_gap is not None and region[1] - group_end > max_gap:
+                groups.append(group)
+                group = [region]
+                group_end = region[2]
+            else:
+                group.append(region)
+                group_end = max(group_end, region[2])
+        groups.append(group)
+    return groups
+
+
+def open_intersected(file_name, plot_regions=None, around_region=0, gtf=False,
+                     chunk_size=2 ** 25):
+    """
+    Opens file_name keeping only the lines which overlap
+    the plot_regions +/- around_region. The file is read by chunks
+    and filtered in memory (it can be gzipped).
+    If a line can not be parsed, the whole file is used.
     :param file_name: string file name
     :param plot_regions:a list of tuple [(chrom1, start1, end1), (chrom2, start2, end2)]
                         with the region to restrict the data to.
     :param around_region: integer with the bp to extend to plot_regions
-    :return: temporary file with the intersection
-    """
-    file_to_open = file_name
-    # Check if we can restrict the interval tree to a region:
-    if plot_regions is not None:
-        # We use pybedtools to overlap:
-        original_file = pybedtools.BedTool(file_name)
-        # We extend the start and end:
-        plot_regions_ext = [(chrom, max(0, start - around_region), end + around_region) for chrom, start, end in plot_regions]
-        # We will overlap with both version of chromosome name:
-        plot_regions_as_bed = '\n'.join([f'{chrom}\t{start}\t{end}\n{change_chrom_names(chrom)}\t{start}\t{end}' for chrom, start, end in plot_regions_ext])
-        regions = pybedtools.BedTool(plot_regions_as_bed, from_string=True)
-        # Bedtools will put a warning because we are using inconsistent
-        # nomenclature (with and without chr)
-        temporary_file = tempfile.NamedTemporaryFile(delete=False)
-        sys.stderr = open(temporary_file.name, 'w')
+    :param gtf: whether file_name is a gtf (1-based coordinates in columns 4 and 5)
+    :param chunk_size: approximate number of bytes read and filtered at once
+    :return: binary file handle
+    """
+    if plot_regions is None:
+        return opener(file_name)
+    regions_by_chrom = get_regions_by_chrom(plot_regions, around_region)
+    start_field, end_field = (3, 4) if gtf else (1, 2)
+    file_h = opener(file_name)
+    kept_lines = []
+    while True:
+        lines = file_h.readlines(chunk_size)
+        if len(lines) == 0:
+            break
+        keep = np.zeros(len(lines), dtype=bool)
+        data_lines = []
+        for i, line in enumerate(lines):
+            if line.startswith((b'#', b'track', b'browser')):
+                keep[i] = True
+            elif line.strip() != b'':
+                data_lines.append(i)
+        data_lines = np.array(data_lines, dtype=np.int64)
         try:
-            file_to_open = original_file.intersect(regions, wa=True, u=True).fn
-        except pybedtools.helpers.BEDToolsError as e:
-            log.warning(f"BEDTools intersect raised: {e}"
-                        "\nWill not subset the file.")
-            file_to_open = file_name
-        except NotImplementedError:
-            log.warning("BEDTools is not installed pygenometracks"
-                        " will be slower.")
-            file_to_open = file_name
-        except Exception as e:
-            log.warning(f"BEDTools intersect raised: {e}"
-                        "\nWill not subset the file.")
-            file_to_open = file_name
-        sys.stderr.close()
-        sys.stderr = sys.__stderr__
-        with open(temporary_file.name, 'r') as f:
-            temp_std_error = f.readlines()
-        os.remove(temporary_file.name)
-        error_lines = [line for line in temp_std_error if 'error' in line.lower()]
-        if len(error_lines) > 0:
-            error_lines_printable = '\n'.join(error_lines)
-            log.warning("BEDTools intersect raised an error:\n"
-                        f"{error_lines_printable}\n"
-                        "Will not use BEDTools.\n")
-            file_to_open = file_name
-    return file_to_open
-
-
-def file_to_intervaltree(file_name, plot_regions=None):
-    """
-    converts a BED like file into a bx python interval tree
-    :param file_name: string file name
-    :param plot_regions:a list of tuple [(chrom1, start1, end1), (chrom2, start2, end2)]
-                        with the region to restrict the data to.
-    :return: interval tree dictionary. They key is the chromosome/contig name and the
-    value is an IntervalTree. Each of the intervals have as 'value' the fields[3:] if any.
+            fields = [lines[i].split(b'\t', end_field + 1) for i in data_lines]
+            chroms = np.array([line_fields[0] for line_fields in fields])
+            starts = np.array([int(line_fields[start_field]) for line_fields in fields],
+                              dtype=np.int64)
+            ends = np.array([int(line_fields[end_field]) for line_fields in fields],
+                            dtype=np.int64)
+        except (IndexError, ValueError) as e:
+            file_h.close()
+            log.warning(f"*Warning*\nThe file {file_name} could not be "
+                        f"intersected with the plotted regions: {e}"
+                        "\nWill not subset the file.\n")
+            return opener(file_name)
+        if gtf:
+            starts -= 1
+        # Intervals of length 0 are considered as 1 bp long
+        ends = np.maximum(ends, starts + 1)
+        for chrom, (region_starts, region_ends) in regions_by_chrom.items():
+            on_chrom = np.flatnonzero(chroms == chrom)
+            if len(on_chrom) == 0:
+                continue
+            # First region which ends after the start of each interval
+            region_index = np.searchsorted(region_ends, starts[on_chrom], side='right')
+            overlap = region_index < len(region_ends)
+            overlap[overlap] = region_starts[region_index[overlap]] < ends[on_chrom][overlap]
+            keep[data_lines[on_chrom[overlap]]] = True
+        kept_lines += [lines[i] for i in np.flatnonzero(keep)]
+    file_h.close()
+    return io.BytesIO(b''.join(kept_lines))
+
+
+class Interval(namedtuple('Interval', ['begin', 'end', 'data'])):
     """
-    file_to_open = temp_file_from_intersect(file_name, plot_regions, 0)
-    # iterate over a BED like file
-    # saving the data into an interval tree
-    # for quick retrieval
-    file_h = opener(file_to_open)
-    line_number = 0
-    valid_intervals = 0
-    interval_tree = {}
-    min_value = float('Inf')
-    max_value = -float('Inf')
+    An interval as returned by the queries of an IntervalIndex.
+    It has the same attributes as the intervaltree Interval
+    (begin, end, data). Intervals are sorted by begin and end only.
+    """
+    __slots__ = ()
 
-    for line in tqdm(file_h.readlines()):
-        line_number += 1
-        line = to_string(line)
-        if line.startswith('browser') or line.startswith('track') or line.startswith('#'):
-            continue
-        fields = line.strip().split('\t')
+    def __lt__(self, other):
+        return (self.begin, self.end) < (other.begin, other.end)
+
+
+class IntervalIndex(object):
+    """
+    A static index of the intervals of a single chromosome.
+    The starts and ends are stored in sorted numpy arrays and
+    the overlap queries use the cumulative maximum of the ends.
+
+    Usage is the same as for an intervaltree IntervalTree:
+    index[begin:end] returns the list of intervals which overlap
+    [begin, end) (sorted by begin) and iterating over the index
+    gives all intervals.
+    """
+
+    def __init__(self, starts, ends, data=None):
+        """
+        :param starts: list or array of start positions
+                       (integers or floats)
+        :param ends: list or array of end positions
+        :param data: list or array with the data associated to each
+                     interval (or None if there is no data)
+        """
+        starts = np.asarray(starts)
+        ends = np.asarray(ends)
+        # The positions are integers unless float positions are given
+        # (for example the middle of the links)
+        if len(starts) > 0 and np.result_type(starts, ends).kind == 'f':
+            dtype = np.float64
+        else:
+            dtype = np.int64
+        starts = starts.astype(dtype)
+        ends = ends.astype(dtype)
+        order = np.lexsort((ends, starts))
+        self.starts = starts[order]
+        self.ends = ends[order]
+        if data is None:
+            self.data = None
+        elif isinstance(data, np.ndarray):
+            self.data = data[order]
+        else:
+            self.data = [data[i] for i in order]
+        if len(self.ends) > 0:
+            self.max_ends = np.maximum.accumulate(self.ends)
+        else:
+            self.max_ends = self.ends
+
+    def __len__(self):
+        return len(self.starts)
+
+    def _get_interval(self, i):
+        if self.data is None:
+            data = None
+        else:
+            data = self.data[i]
+            if isinstance(data, np.ndarray):
+                data = data.tolist()
+        return Interval(self.starts[i].item(), self.ends[i].item(), data)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self._get_interval(i)
+
+    def overlap_indices(self, begin, end):
+        """
+        :return: the indices (in the sorted arrays) of the intervals
+                 overlapping [begin, end)
+        """
+        if begin >= end:
+            return np.array([], dtype=np.int64)
+        # Only intervals with a start before end can overlap
+        last = np.searchsorted(self.starts, end, side='left')
+        # The intervals before first all end before begin
+        first = np.searchsorted(self.max_ends[:last], begin, side='right')
+        candidates = np.arange(first, last)
+        return candidates[self.ends[first:last] > begin]
+
+    def overlap(self, begin, end):
+        return [self._get_interval(i) for i in self.overlap_indices(begin, end)]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self.overlap(index.start, index.stop)
+        return self.overlap(index, index + 1)
+
+
+def intervals_to_index(intervals):
+    """
+    Returns the IntervalIndex of intervals (list of tuples
+    (start, end, data)) with the content an intervaltree IntervalTree
+    would have: the identical intervals are kept once and the intervals
+    with the same start and end are sorted by data.
+    """
+    intervals = sorted(intervals)
+    intervals = [interval for i, interval in enumerate(intervals)
+                 if i == 0 or interval != intervals[i - 1]]
+    return IntervalIndex([interval[0] for interval in intervals],
+                         [interval[1] for interval in intervals],
+                         [interval[2] for interval in intervals])
+
+
+class FileCache(object):
+    """
+    Stores the parsed version of files as .npz archives in a directory
+    so that later runs do not need to parse them again.
+    An archive is identified by the absolute path, the size and the
+    modification time of the original file and by the parameters
+    used to parse it. When the directory gets bigger than max_size
+    (in MB), the least recently used archives are removed.
+    """
+
+    def __init__(self, cache_dir, max_size=1000):
+        self.cache_dir = cache_dir
+        self.max_size = max_size * 1e6
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def get_path(self, file_name, params):
+        stat = os.stat(file_name)
+        key = repr((os.path.abspath(file_name), stat.st_size,
+                    stat.st_mtime_ns, params))
+        return os.path.join(self.cache_dir,
+                            hashlib.sha1(key.encode()).hexdigest() + '.npz')
+
+    def load(self, file_name, params):
+        """
+        :return: a dictionary with the arrays stored for file_name
+                 and params or None if there is none.
+        """
+        path = self.get_path(file_name, params)
         try:
-            chrom, start, end = fields[0:3]
-        except Exception as detail:
-            msg = f"Error reading line: {line_number}\nError message: {detail}"
-            if len(fields) == 1:
-                if fields[0].startswith("{\\rtf"):
-                    raise InputError(f"The file {file_name} is a rtf file."
-                                     " Please save it as plain text.")
-                else:
-                    raise InputError(f"Only one field detected in {file_name}"
-                                     ", you may use"
-                                     " a bed-like delimited by space. This format "
-                                     "is not supported by pyGenomeTracks.")
-            raise InputError(msg)
+            with np.load(path) as npz:
+                arrays = {key: npz[key] for key in npz.files}
+        except (OSError, ValueError, zipfile.BadZipFile):
+            return None
+        try:
+            # Mark it as recently used
+            os.utime(path)
+        except OSError:
+            pass
+        log.debug(f"{file_name} loaded from the cache {path}")
+        return arrays
 
+    def save(self, file_name, params, arrays):
+        """
+        Stores the dictionary of arrays for file_name and params.
+        """
+        path = self.get_path(file_name, params)
         try:
-            start = int(start)
-        except ValueError as detail:
-            msg = f"Error reading line: {line_number}. The start field is not " \
-                  f"an integer.\nError message: {detail}"
-            raise InputError(msg)
+            # Write to a temporary file first so that other
+            # processes never read a partial archive
+            with tempfile.NamedTemporaryFile(dir=self.cache_dir, suffix='.tmp',
+                                             delete=False) as fh:
+                np.savez(fh, **arrays)
+            os.replace(fh.name, path)
+        except OSError as e:
+            log.warning(f"*Warning*\nCould not write {file_name} to the cache: {e}\n")
+            return
+        self.evict()
+
+    def evict(self):
+        """
+        Removes the least recently used archives until
+        the size of the cache is below max_size.
+        """
+        archives = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith('.npz'):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                archives.append((stat.st_mtime, stat.st_size, entry.path))
+        archives.sort()
+        total_size = sum(size for __, size, __ in archives)
+        # The most recent archive is always kept
+        for __, size, path in archives[:-1]:
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total_size -= size
+
+
+class DatasetRegistry(object):
+    """
+    Keeps the datasets loaded by the tracks of a PlotTracks so that
+    the sections using the same file with the same parameters parse
+    it only once. The datasets are shared between tracks and must
+    not be modified.
+    """
+
+    def __init__(self, datasets=None):
+        self.datasets = dict(datasets or {})
+        self.lock = threading.RLock()
+
+    @staticmethod
+    def to_hashable(key):
+        if isinstance(key, (list, tuple)):
+            return tuple(DatasetRegistry.to_hashable(k) for k in key)
+        return key
+
+    def get(self, key, loader):
+        """
+        :param key: the file name and the parameters used to load it
+                    (lists are allowed)
+        :param loader: function without argument which loads the dataset
+        :return: the dataset stored with key or the output of loader()
+        """
+        key = self.to_hashable(key)
+        with self.lock:
+            if key not in self.datasets:
+                self.datasets[key] = loader()
+            else:
+                log.debug(f"{key[:2]} was already loaded.")
+            return self.datasets[key]
+
+
+BIGWIG_MAGIC = 0x888FFC26
+BIGWIG_HEADER = 'IHHQQQHHQQIQ'
+BIGWIG_ZOOM_HEADER = 'IIQQ'
+BIGWIG_ZOOM_RECORD = [('chrom_id', 'u4'), ('start', 'u4'), ('end', 'u4'),
+                      ('valid_count', 'u4'), ('min_value', 'f4'),
+                      ('max_value', 'f4'), ('sum_data', 'f4'),
+                      ('sum_squares', 'f4')]
+BIGWIG_INDEX_LEAF = [('start_chrom', 'u4'), ('start_base', 'u4'),
+                     ('end_chrom', 'u4'), ('end_base', 'u4'),
+                     ('offset', 'u8'), ('size', 'u8')]
+BIGWIG_INDEX_NODE = BIGWIG_INDEX_LEAF[:-1]
+
+
+class BigWigReader(object):
+    """
+    A bigwig file opened once for all the tracks using it.
+    The chromosome sizes are read once and the last stats
+    computed are kept, so the sections plotting the same file
+    with the same parameters read it only once.
+    The pyBigWig handle is used by one thread at a time and
+    each process uses its own handle (see check_process).
+    For local files, the stats can also be computed from the records
+    of the coarsest zoom level which has at least 2 records per bin
+    (see zoom_level).
+    """
+
+    def __init__(self, file_name, max_stats=256):
+        self.file_name = file_name
+        self.max_stats = max_stats
+        self.lock = threading.RLock()
+        self.bw = None
+        self.pid = None
+        self.chrom_sizes = None
+        self.header = None
+        self.stats_cache = OrderedDict()
+        self.open()
+
+    def open(self):
+        with self.lock:
+            self.bw = pyBigWig.open(self.file_name)
+            self.pid = os.getpid()
+
+    def check_process(self):
+        """
+        Opens a new handle when the reader is used in a process forked
+        after the file was opened. The handle of the parent process
+        shares its file offset with the parent and reading it
+        from both processes returns corrupted data.
+        """
+        if self.pid == os.getpid():
+            return
+        # The lock may have been held by another thread of the parent
+        # when the process was forked
+        self.lock = threading.RLock()
+        if self.bw is not None:
+            self.bw.close()
+            self.open()
+        self.pid = os.getpid()
+
+    def chroms(self):
+        """
+        :return: dictionary with the size of each chromosome
+        """
+        self.check_process()
+        with self.lock:
+            if self.chrom_sizes is None:
+                self.chrom_sizes = self.bw.chroms()
+            return self.chrom_sizes
+
+    def read_header(self):
+        """
+        Reads the zoom levels and the chromosome ids of a local
+        bigwig file. Remote files have no zoom level.
+        """
+        header = {'zoom_levels': [], 'chrom_ids': {}}
+        if '://' in self.file_name:
+            return header
+        with open(self.file_name, 'rb') as fh:
+            data = fh.read(struct.calcsize('<' + BIGWIG_HEADER))
+            endian = '<' if struct.unpack('<I', data[:4])[0] == BIGWIG_MAGIC else '>'
+            fields = struct.unpack(endian + BIGWIG_HEADER, data)
+            n_levels, chrom_tree_offset, uncompress_buf_size = \
+                fields[2], fields[3], fields[10]
+            header['endian'] = endian
+            header['compressed'] = uncompress_buf_size > 0
+            for __ in range(n_levels):
+                reduction_level, __, __, index_offset = \
+                    struct.unpack(endian + BIGWIG_ZOOM_HEADER, fh.read(24))
+                header['zoom_levels'].append((reduction_level, index_offset))
+            # The chromosome ids are in a B+ tree
+            fh.seek(chrom_tree_offset)
+            key_size = struct.unpack(endian + 'IIIIQQ', fh.read(32))[2]
+            nodes = [fh.tell()]
+            while nodes:
+                fh.seek(nodes.pop())
+                is_leaf, __, count = struct.unpack(endian + 'BBH', fh.read(4))
+                for __ in range(count):
+                    key = fh.read(key_size).rstrip(b'\0').decode()
+                    if is_leaf:
+                        header['chrom_ids'][key] = \
+                            struct.unpack(endian + 'II', fh.read(8))[0]
+                    else:
+                        nodes.append(struct.unpack(endian + 'Q', fh.read(8))[0])
+        return header
+
+    def zoom_levels(self):
+        """
+        :return: the reduction levels (number of bases summarized
+        by each record) of the zoom levels of the file
+        """
+        with self.lock:
+            if self.header is None:
+                self.header = self.read_header()
+            return [level for level, __ in self.header['zoom_levels']]
+
+    def zoom_level(self, start, end, nBins):
+        """
+        :return: the coarsest zoom level with at least 2 records per bin
+        (the one pyBigWig uses) or None if the raw data must be used
+        """
+        bases_per_bin = (end - start) // nBins
+        levels = [level for level in self.zoom_levels()
+                  if level <= bases_per_bin // 2]
+        return max(levels) if len(levels) > 0 else None
+
+    def zoom_records(self, chrom, start, end, reduction_level):
+        """
+        :return: the records of the zoom level reduction_level
+        overlapping chrom:start-end (structured array with the fields
+        of BIGWIG_ZOOM_RECORD)
+        """
+        with self.lock:
+            self.zoom_levels()
+            header = self.header
+        endian = header['endian']
+        record_dtype = np.dtype(BIGWIG_ZOOM_RECORD).newbyteorder(endian)
+        leaf_dtype = np.dtype(BIGWIG_INDEX_LEAF).newbyteorder(endian)
+        node_dtype = np.dtype(BIGWIG_INDEX_NODE).newbyteorder(endian)
+        chrom_id = header['chrom_ids'].get(chrom)
+        if chrom_id is None:
+            return np.empty(0, dtype=record_dtype)
+        index_offset = dict(header['zoom_levels'])[reduction_level]
+        blocks = []
+        with open(self.file_name, 'rb') as fh:
+            # The blocks are found with the R tree of the zoom level
+            # which starts after a header of 48 bytes
+            nodes = [index_offset + 48]
+            while nodes:
+                fh.seek(nodes.pop())
+                is_leaf, __, count = struct.unpack(endian + 'BBH', fh.read(4))
+                item_dtype = leaf_dtype if is_leaf else node_dtype
+                items = np.frombuffer(fh.read(count * item_dtype.itemsize),
+                                      dtype=item_dtype)
+                overlap = ((items['start_chrom'] < chrom_id)
+                           | ((items['start_chrom'] == chrom_id)
+                              & (items['start_base'] < end))) \
+                    & ((items['end_chrom'] > chrom_id)
+                       | ((items['end_chrom'] == chrom_id)
+                          & (items['end_base'] > start)))
+                if is_leaf:
+                    blocks += [(int(item['offset']), int(item['size']))
+                               for item in items[overlap]]
+                else:
+                    nodes += [int(offset) for offset in items['offset'][overlap]]
+            records = []
+            for offset, size in sorted(blocks):
+                fh.seek(offset)
+                data = fh.read(size)
+                if header['compressed']:
+                    data = zlib.decompress(data)
+                records.append(np.frombuffer(data, dtype=record_dtype))
+        if len(records) == 0:
+            return np.empty(0, dtype=record_dtype)
+        records = np.concatenate(records)
+        return records[(records['chrom_id'] == chrom_id)
+                       & (records['start'] < end) & (records['end'] > start)]
+
+    def stats(self, chrom, start, end, nBins=1, type='mean',
+              use_zoom_levels=False):
+        """
+        Same as the pyBigWig stats but returns an array of floats
+        (which can be modified by the caller).
+        When use_zoom_levels is set and a zoom level can be used
+        (see zoom_level), the stats are computed from all the records
+        of the zoom level overlapping the region at once, instead of
+        one request per bin. The zoom level used (or the use of the
+        raw data) is reported in the debug log.
+        """
+        key = (chrom, start, end, nBins, type, use_zoom_levels)
+        self.check_process()
+        with self.lock:
+            if key in self.stats_cache:
+                self.stats_cache.move_to_end(key)
+            else:
+                reduction_level = None
+                if use_zoom_levels:
+                    reduction_level = self.zoom_level(start, end, nBins)
+                    if reduction_level is None:
+                        log.debug(f"No zoom level of {self.file_name} can be"
+                                  f" used for {chrom}:{start}-{end}"
+                                  ", the raw data is used.")
+                    else:
+                        log.debug(f"The zoom level of {self.file_name} with"
+                                  f" {reduction_level} bases per record is"
+                                  f" used for {chrom}:{start}-{end}.")
+                if reduction_level is not None:
+                    records = self.zoom_records(chrom, start, end,
+                                                reduction_level)
+                    self.stats_cache[key] = \
+                        summarize_zoom_records(records, start, end, nBins,
+                                               type)
+                else:
+                    # pyBigWig only knows std and mean
+                    bw_type = {'stdev': 'std', 'average': 'mean'}.get(type, type)
+                    self.stats_cache[key] = \
+                        np.array(self.bw.stats(chrom, start, end, nBins=nBins,
+                                               type=bw_type)).astype(float)
+                if len(self.stats_cache) > self.max_stats:
+                    self.stats_cache.popitem(last=False)
+            return self.stats_cache[key].copy()
+
+    def close(self):
+        self.check_process()
+        with self.lock:
+            if self.bw is not None:
+                self.bw.close()
+                self.bw = None
+
+
+class BigWigPool(object):
+    """
+    The BigWigReader of all bigwig files used by a PlotTracks
+    (one per file).
+    """
+
+    def __init__(self):
+        self.readers = {}
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+
+    def check_process(self):
+        """
+        Creates a new lock when the pool is used in a process forked
+        after it was created: the lock may have been held by another
+        thread of the parent when the process was forked.
+        The readers open their own handle (see BigWigReader.check_process).
+        """
+        if self.pid == os.getpid():
+            return
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+
+    def get(self, file_name):
+        """
+        :return: the BigWigReader of file_name (opened if needed)
+        """
+        key = file_name if '://' in file_name else os.path.abspath(file_name)
+        self.check_process()
+        with self.lock:
+            if key not in self.readers:
+                self.readers[key] = BigWigReader(file_name)
+            return self.readers[key]
+
+    def close(self):
+        self.check_process()
+        with self.lock:
+            for reader in self.readers.values():
+                reader.close()
+            self.readers = {}
 
+
+def intervaltree_to_arrays(interval_tree, min_value, max_value):
+    """
+    Converts the output of file_to_intervaltree to a dictionary
+    of arrays which can be stored by a FileCache.
+    """
+    arrays = {'chroms': np.array(list(interval_tree), dtype=str),
+              'min_max': np.array([min_value, max_value])}
+    for i, index in enumerate(interval_tree.values()):
+        arrays[f'starts_{i}'] = index.starts
+        arrays[f'ends_{i}'] = index.ends
+        if index.data is None:
+            continue
+        if isinstance(index.data, np.ndarray) and index.data.ndim == 2:
+            arrays[f'data_{i}'] = index.data
+        else:
+            # The number of fields is not the same on all lines
+            # They are stored as a single string
+            arrays[f'has_data_{i}'] = np.array([value is not None for value in index.data])
+            arrays[f'joined_data_{i}'] = np.array(['\t'.join(value) if value is not None else ''
+                                                   for value in index.data], dtype=str)
+    return arrays
+
+
+def intervaltree_from_arrays(arrays):
+    """
+    Does the opposite of intervaltree_to_arrays.
+    """
+    interval_tree = {}
+    for i, chrom in enumerate(arrays['chroms']):
+        if f'data_{i}' in arrays:
+            data = arrays[f'data_{i}']
+        elif f'joined_data_{i}' in arrays:
+            data = np.empty(len(arrays[f'joined_data_{i}']), dtype=object)
+            for j, (has_data, value) in enumerate(zip(arrays[f'has_data_{i}'],
+                                                      arrays[f'joined_data_{i}'])):
+                if has_data:
+                    data[j] = str(value).split('\t')
+        else:
+            data = None
+        interval_tree[str(chrom)] = IntervalIndex(arrays[f'starts_{i}'],
+                                                  arrays[f'ends_{i}'], data)
+    min_value, max_value = arrays['min_max']
+    return interval_tree, float(min_value), float(max_value)
+
+
+def interval_indices_to_arrays(interval_tree, *values):
+    """
+    Converts a dictionary of IntervalIndex whose data are tuples
+    (or namedtuples) of integers, floats, strings or lists
+    followed by other values (numbers, strings or booleans)
+    to a dictionary of arrays which can be stored by a FileCache.
+    Raises a ValueError if the data can not be stored as arrays.
+    """
+    arrays = {'chroms': np.array(list(interval_tree), dtype=str)}
+    for i, value in enumerate(values):
+        arrays[f'value_{i}'] = np.array(value)
+    records = []
+    for i, index in enumerate(interval_tree.values()):
+        arrays[f'starts_{i}'] = index.starts
+        arrays[f'ends_{i}'] = index.ends
+        records += list(index.data)
+    if len(records) == 0:
+        return arrays
+    if len(set(map(len, records))) != 1:
+        raise ValueError("The data do not have the same length.")
+    if hasattr(records[0], '_fields'):
+        arrays['typename'] = np.array(type(records[0]).__name__)
+        arrays['fields'] = np.array(records[0]._fields, dtype=str)
+    for j, column in enumerate(zip(*records)):
+        if all(type(value) is list for value in column):
+            arrays[f'lengths_{j}'] = np.array([len(value) for value in column],
+                                              dtype=np.int64)
+            column = [x for value in column for x in value]
+        if len(set(map(type, column))) > 1 or \
+           not all(type(value) in [int, float, str] for value in column[:1]):
+            raise ValueError(f"The field {j} can not be stored as an array.")
+        arrays[f'column_{j}'] = np.array(column)
+    return arrays
+
+
+def interval_indices_from_arrays(arrays):
+    """
+    Does the opposite of interval_indices_to_arrays.
+    :return: a tuple with the dictionary of IntervalIndex
+             followed by the other values
+    """
+    columns = []
+    while f'column_{len(columns)}' in arrays:
+        j = len(columns)
+        column = arrays[f'column_{j}'].tolist()
+        if f'lengths_{j}' in arrays:
+            ends = np.cumsum(arrays[f'lengths_{j}']).tolist()
+            starts = [0] + ends[:-1]
+            column = [column[start:end] for start, end in zip(starts, ends)]
+        columns.append(column)
+    if 'fields' in arrays:
+        record_type = namedtuple(str(arrays['typename']),
+                                 arrays['fields'].tolist())
+        records = list(map(record_type._make, zip(*columns)))
+    else:
+        records = list(map(list, zip(*columns)))
+    interval_tree = {}
+    first = 0
+    for i, chrom in enumerate(arrays['chroms']):
+        last = first + len(arrays[f'starts_{i}'])
+        interval_tree[str(chrom)] = IntervalIndex(arrays[f'starts_{i}'],
+                                                  arrays[f'ends_{i}'],
+                                                  records[first:last])
+        first = last
+    values = []
+    while f'value_{len(values)}' in arrays:
+        values.append(arrays[f'value_{len(values)}'].item())
+    return (interval_tree, *values)
+
+
+def check_bed_like_line(line, line_number, file_name):
+    """
+    Checks a single line of a BED like file and raise an
+    informative error if it is not valid.
+    :param line: string with the line (without the header lines)
+    :param line_number: the line number in the file
+    :param file_name: string file name
+    :return: chrom, start, end, fields
+    """
+    fields = line.strip().split('\t')
+    try:
+        chrom, start, end = fields[0:3]
+    except Exception as detail:
+        msg = f"Error reading line: {line_number}\nError message: {detail}"
+        if len(fields) == 1:
+            if fields[0].startswith("{\\rtf"):
+                raise InputError(f"The file {file_name} is a rtf file."
+                                 " Please save it as plain text.")
+            else:
+                raise InputError(f"Only one field detected in {file_name}"
+                                 ", you may use"
+                                 " a bed-like delimited by space. This format "
+                                 "is not supported by pyGenomeTracks.")
+        raise InputError(msg)
+
+    try:
+        start = int(start)
+    except ValueError as detail:
+        msg = f"Error reading line: {line_number}. The start field is not " \
+              f"an integer.\nError message: {detail}"
+        raise InputError(msg)
+
+    try:
+        end = int(end)
+    except ValueError as detail:
+        msg = f"Error reading line: {line_number}. The end field is not " \
+              f"an integer.\nError message: {detail}"
+        raise InputError(msg)
+
+    if end <= start:
+        raise InputError(f"Error reading line: {line_number} of {file_name}. "
+                         f"Start position larger or equal than end:\n{line}")
+
+    return chrom, start, end, fields
+
+
+def _column_to_int(column, line_numbers, field_name):
+    """
+    Converts a list of strings to an array of integers.
+    Raises an InputError with the line number (from line_numbers)
+    of the first string which is not an integer.
+    """
+    try:
+        return np.array(column, dtype=np.int64)
+    except (ValueError, OverflowError):
+        pass
+    for value, line_number in zip(column, line_numbers):
         try:
-            end = int(end)
-        except ValueError as detail:
-            msg = f"Error reading line: {line_number}. The end field is not " \
+            np.array(value, dtype=np.int64)
+        except (ValueError, OverflowError) as detail:
+            msg = f"Error reading line: {line_number}. The {field_name} field is not " \
                   f"an integer.\nError message: {detail}"
             raise InputError(msg)
 
-        if chrom not in interval_tree:
-            interval_tree[chrom] = IntervalTree()
 
-        value = None
+def _rows_to_arrays(rows):
+    """
+    Converts a list of fields (as lists of strings) to
+    chroms, starts, ends and values arrays.
+    """
+    chroms = np.array([row[0] for row in rows])
+    starts = np.array([int(row[1]) for row in rows], dtype=np.int64)
+    ends = np.array([int(row[2]) for row in rows], dtype=np.int64)
+    values = np.empty(len(rows), dtype=object)
+    for i, row in enumerate(rows):
+        if len(row) > 3:
+            values[i] = row[3:]
+    return chroms, starts, ends, values
 
-        if len(fields) > 3:
-            value = fields[3:]
-            try:
-                line_min = min(map(float, value))
-                if line_min < min_value:
-                    min_value = line_min
 
-                line_max = max(map(float, value))
-                if line_max > max_value:
-                    max_value = line_max
-            except ValueError:
-                pass
+def parse_bed_like_chunk(lines, first_line_number, file_name,
+                         skip_empty=False):
+    """
+    Parses a list of lines of a BED like file at once.
+    When all lines have the same number of fields, the fields are
+    put in a single 2D array and the start and end columns are
+    converted to integers in a vectorized step.
+    If something goes wrong, the lines are checked one by one
+    to report the line number of the first malformed line.
+    :param lines: list of strings (or bytes)
+    :param first_line_number: the line number of lines[0] in the file
+    :param file_name: string file name (used in error messages)
+    :param skip_empty: if True, the intervals with the same start and
+                       end are removed with a warning instead of
+                       raising an error
+    :return: chroms (array), starts (array), ends (array), values
+             values is None if there is no field after the end,
+             a 2D array of strings if all lines have the same number of
+             fields and an array of objects (None or list of strings)
+             otherwise.
+    """
+    # Decode all lines at once
+    if len(lines) > 0 and isinstance(lines[0], bytes):
+        lines = b''.join(lines).decode('utf-8').split('\n')[:len(lines)]
+    lines = list(map(str.strip, lines))
+    is_header = [line.startswith(('browser', 'track', '#')) for line in lines]
+    line_numbers = first_line_number + np.flatnonzero(np.logical_not(is_header))
+    if len(line_numbers) < len(lines):
+        lines = [lines[i] for i in line_numbers - first_line_number]
+    if len(lines) == 0:
+        return np.array([], dtype=str), np.array([], dtype=np.int64), \
+            np.array([], dtype=np.int64), None
+
+    num_fields = 1 + np.fromiter(map(str.count, lines, repeat('\t')),
+                                 dtype=np.int64, count=len(lines))
+    try:
+        if num_fields.min() < 3:
+            raise ValueError("Not enough fields.")
+        if num_fields.min() == num_fields.max():
+            n = num_fields[0]
+            fields = '\t'.join(lines).split('\t')
+            chroms = np.array(fields[0::n])
+            starts = _column_to_int(fields[1::n], line_numbers, 'start')
+            ends = _column_to_int(fields[2::n], line_numbers, 'end')
+            if n > 3:
+                values = np.array([fields[i::n] for i in range(3, n)]).T
+            else:
+                values = None
+        else:
+            rows = [line.split('\t') for line in lines]
+            chroms, starts, ends, values = _rows_to_arrays(rows)
+        empty = ends == starts
+        if skip_empty and np.any(empty):
+            log.warning(f"*Warning*\n{np.sum(empty)} intervals of {file_name}"
+                        " have the same start and end and are skipped. "
+                        f"The first one is:\n{lines[np.argmax(empty)]}\n")
+            keep = np.logical_not(empty)
+            chroms, starts, ends = chroms[keep], starts[keep], ends[keep]
+            if values is not None:
+                values = values[keep]
+            lines = [line for line, kept in zip(lines, keep) if kept]
+            line_numbers = line_numbers[keep]
+        if np.any(ends <= starts):
+            raise ValueError("Start position larger or equal than end.")
+    except ValueError:
+        # Check the lines one by one to raise an
+        # error with the line number of the invalid line:
+        rows = [check_bed_like_line(line, line_number, file_name)[3]
+                for line, line_number in zip(lines, line_numbers)]
+        chroms, starts, ends, values = _rows_to_arrays(rows)
+    return chroms, starts, ends, values
+
+
+def get_min_max_values(values):
+    """
+    Computes the minimum and maximum of the values of a BED like file
+    as returned by parse_bed_like_chunk. The lines where at least one
+    value is not a number are skipped.
+    :param values: None, 2D array of strings or array of objects
+    :return: min_value, max_value
+    """
+    min_value = float('Inf')
+    max_value = -float('Inf')
+    if values is None:
+        return min_value, max_value
+    if values.ndim == 2:
+        try:
+            float_values = values.astype(float)
+        except ValueError:
+            pass
+        else:
+            valid_rows = ~np.isnan(float_values).any(axis=1)
+            if valid_rows.any():
+                min_value = float_values[valid_rows].min()
+                max_value = float_values[valid_rows].max()
+            return min_value, max_value
+    for value in values:
+        if value is None:
+            continue
+        try:
+            line_min = min(map(float, value))
+            if line_min < min_value:
+                min_value = line_min
+
+            line_max = max(map(float, value))
+            if line_max > max_value:
+                max_value = line_max
+        except ValueError:
+            pass
+    return min_value, max_value
 
-        assert end > start, f"Start position larger or equal than end for line\n{line} "
 
-        interval_tree[chrom].add(Interval(start, end, value))
-        valid_intervals += 1
+def file_to_intervaltree(file_name, plot_regions=None, chunk_size=2 ** 25,
+                         file_cache=None):
+    """
+    converts a BED like file into a dictionary of interval indices
+    :param file_name: string file name
+    :param plot_regions:a list of tuple [(chrom1, start1, end1), (chrom2, start2, end2)]
+                        with the region to restrict the data to.
+    :param chunk_size: approximate number of bytes read and parsed at once
+    :param file_cache: a FileCache where the result is looked up and stored
+    :return: interval tree dictionary. They key is the chromosome/contig name and the
+    value is an IntervalIndex. Each of the intervals have as 'data' the fields[3:] if any.
+    """
+    if file_cache is not None:
+        cache_params = ('file_to_intervaltree', plot_regions)
+        arrays = file_cache.load(file_name, cache_params)
+        if arrays is not None:
+            return intervaltree_from_arrays(arrays)
+        interval_tree, min_value, max_value = \
+            file_to_intervaltree(file_name, plot_regions, chunk_size)
+        file_cache.save(file_name, cache_params,
+                        intervaltree_to_arrays(interval_tree, min_value, max_value))
+        return interval_tree, min_value, max_value
 
-    if valid_intervals == 0:
-        if file_to_open != file_name:
+    # iterate over a BED like file by chunks
+    # saving the data into an interval index
+    # for quick retrieval
+    file_h = open_intersected(file_name, plot_regions, 0)
+    line_number = 1
+    chunks = []
+    min_value = float('Inf')
+    max_value = -float('Inf')
+
+    while True:
+        lines = file_h.readlines(chunk_size)
+        if len(lines) == 0:
+            break
+        chunk = parse_bed_like_chunk(lines, line_number, file_name)
+        line_number += len(lines)
+        if len(chunk[0]) == 0:
+            continue
+        chunks.append(chunk)
+        chunk_min, chunk_max = get_min_max_values(chunk[3])
+        min_value = min(min_value, chunk_min)
+        max_value = max(max_value, chunk_max)
+    file_h.close()
+
+    if len(chunks) == 0:
+        if plot_regions is not None:
             suffix = " after intersection with the plotted region"
         else:
             suffix = ""
         log.warning(f"No valid intervals were found in file {file_name}{suffix}")
-    file_h.close()
+        return {}, min_value, max_value
+
+    chroms = np.concatenate([chunk[0] for chunk in chunks])
+    starts = np.concatenate([chunk[1] for chunk in chunks])
+    ends = np.concatenate([chunk[2] for chunk in chunks])
+    values = [chunk[3] for chunk in chunks]
+    if all(v is None for v in values):
+        values = None
+    elif all(v is not None and v.ndim == 2 for v in values) and \
+            len(set(v.shape[1] for v in values)) == 1:
+        values = np.concatenate(values)
+    else:
+        all_values = []
+        for chunk in chunks:
+            if chunk[3] is None:
+                all_values += [None] * len(chunk[0])
+            else:
+                all_values += chunk[3].tolist()
+        values = np.empty(len(all_values), dtype=object)
+        for i, value in enumerate(all_values):
+            values[i] = value
+
+    # Keep the chromosomes in the order they appear in the file:
+    unique_chroms, first_index, chrom_index = np.unique(chroms, return_index=True,
+                                                        return_inverse=True)
+    interval_tree = {}
+    for i in np.argsort(first_index):
+        chrom_rows = chrom_index == i
+        interval_tree[str(unique_chroms[i])] = \
+            IntervalIndex(starts[chrom_rows], ends[chrom_rows],
+                          None if values is None else values[chrom_rows])
 
     return interval_tree, min_value, max_value
 
 
+def bin_edges(start_region, end_region, number_of_bins):
+    """
+    :return: the number_of_bins + 1 edges of the bins used by
+    summarize_in_bins and summarize_zoom_records
+    """
+    return start_region + np.arange(number_of_bins + 1, dtype=np.int64) * \
+        (end_region - start_region) // number_of_bins
+
+
+def split_in_bins(starts, ends, edges):
+    """
+    Splits each interval starts-ends into pieces, one per bin it overlaps.
+    :return: the index of the interval of each piece, the bin of each
+    piece and the size of each piece
+    """
+    first_bin = np.searchsorted(edges[1:], starts, side='right')
+    last_bin = np.searchsorted(edges[:-1], ends, side='left') - 1
+    n_pieces = np.maximum(last_bin - first_bin + 1, 0)
+    interval_idx = np.repeat(np.arange(len(starts)), n_pieces)
+    bins = first_bin[interval_idx] + np.arange(len(interval_idx)) - \
+        np.repeat(np.cumsum(n_pieces) - n_pieces, n_pieces)
+    overlaps = (np.minimum(ends[interval_idx], edges[bins + 1])
+                - np.maximum(starts[interval_idx], edges[bins])).astype(float)
+    return interval_idx, bins, overlaps
+
+
+def summarize_in_bins(starts, ends, values, start_region, end_region,
+                      number_of_bins, summary_method='mean'):
+    """
+    Summarizes the values of the intervals starts-ends into number_of_bins
+    bins between start_region and end_region. The results are the same
+    as the stats of pyBigWig with exact=True:
+    - the bin i goes from start_region + i * (end_region - start_region) // number_of_bins
+    - mean, sum, coverage and stdev are weighted by the overlap of each
+    interval with the bin
+    - the bins without overlapping interval are nan
+    The intervals are expected to be sorted and not to overlap.
+    :param summary_method: mean/average/max/min/stdev/dev/coverage/cov/sum
+    :return: array with number_of_bins values
+    """
+    starts = np.asarray(starts, dtype=np.int64)
+    ends = np.asarray(ends, dtype=np.int64)
+    values = np.asarray(values, dtype=float)
+    edges = bin_edges(start_region, end_region, number_of_bins)
+    interval_idx, bins, overlaps = split_in_bins(starts, ends, edges)
+    piece_values = values[interval_idx]
+
+    empty_bins = np.bincount(bins, minlength=number_of_bins) == 0
+    covered = np.bincount(bins, weights=overlaps, minlength=number_of_bins)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        if summary_method in ['mean', 'average']:
+            scores = np.bincount(bins, weights=overlaps * piece_values,
+                                 minlength=number_of_bins) / covered
+        elif summary_method == 'sum':
+            scores = np.bincount(bins, weights=overlaps * piece_values,
+                                 minlength=number_of_bins)
+        elif summary_method in ['coverage', 'cov']:
+            scores = covered / np.diff(edges)
+        elif summary_method in ['stdev', 'dev']:
+            sums = np.bincount(bins, weights=overlaps * piece_values,
+                               minlength=number_of_bins)
+            squares = np.bincount(bins, weights=overlaps * piece_values ** 2,
+                                  minlength=number_of_bins)
+            variances = (squares - sums ** 2 / covered) / \
+                np.where(covered > 1, covered - 1, 1)
+            scores = np.sqrt(np.maximum(variances, 0))
+        elif summary_method in ['max', 'min']:
+            if summary_method == 'max':
+                scores = np.full(number_of_bins, -np.inf)
+                np.fmax.at(scores, bins, piece_values)
+            else:
+                scores = np.full(number_of_bins, np.inf)
+                np.fmin.at(scores, bins, piece_values)
+            scores[np.isinf(scores)] = np.nan
+            # Like pyBigWig, a bin is nan when its first interval is nan
+            first_piece = np.full(number_of_bins, len(bins))
+            np.minimum.at(first_piece, bins, np.arange(len(bins)))
+            first_value = np.append(piece_values, 0)[first_piece]
+            scores[np.isnan(first_value)] = np.nan
+        else:
+            raise InputError(f"The summary method {summary_method} "
+                             "is not supported.")
+    scores[empty_bins] = np.nan
+    return scores
+
+
+def summarize_zoom_records(records, start_region, end_region,
+                           number_of_bins, summary_method='mean'):
+    """
+    Summarizes the records of a zoom level of a bigwig file
+    (see BigWigReader.zoom_records) into number_of_bins bins between
+    start_region and end_region, with the bins of summarize_in_bins.
+    Like in pyBigWig, a record contributes to a bin proportionally to
+    the fraction of the record overlapping the bin.
+    :param summary_method: mean/average/max/min/stdev/dev/coverage/cov/sum
+    :return: array with number_of_bins values
+    """
+    edges = bin_edges(start_region, end_region, number_of_bins)
+    starts = records['start'].astype(np.int64)
+    ends = records['end'].astype(np.int64)
+    record_idx, bins, overlaps = split_in_bins(starts, ends, edges)
+    fractions = overlaps / (ends - starts)[record_idx]
+
+    def sum_in_bins(field):
+        # astype is needed when there is no record
+        return np.bincount(bins, minlength=number_of_bins,
+                           weights=fractions * records[field][record_idx]).astype(float)
+
+    covered = sum_in_bins('valid_count')
+    with np.errstate(invalid='ignore', divide='ignore'):
+        if summary_method in ['mean', 'average']:
+            scores = sum_in_bins('sum_data') / covered
+        elif summary_method == 'sum':
+            scores = sum_in_bins('sum_data')
+        elif summary_method in ['coverage', 'cov']:
+            scores = covered / np.diff(edges)
+        elif summary_method in ['stdev', 'dev']:
+            sums = sum_in_bins('sum_data')
+            variances = (sum_in_bins('sum_squares') - sums ** 2 / covered) / \
+                np.where(covered > 1, covered - 1, 1)
+            scores = np.sqrt(np.maximum(variances, 0))
+        elif summary_method in ['max', 'min']:
+            if summary_method == 'max':
+                scores = np.full(number_of_bins, -np.inf)
+                np.fmax.at(scores, bins, records['max_value'][record_idx])
+            else:
+                scores = np.full(number_of_bins, np.inf)
+                np.fmin.at(scores, bins, records['min_value'][record_idx])
+        else:
+            raise InputError(f"The summary method {summary_method} "
+                             "is not supported.")
+    scores[covered == 0] = np.nan
+    return scores
+
+
+def interpolate_on(new_x, x_values, scores):
+    """
+    Linear interpolation of the scores at x_values (sorted)
+    on new_x. The new_x outside of the range of x_values are nan.
+    """
+    if len(x_values) == 0:
+        return np.full(len(new_x), np.nan)
+    return np.interp(new_x, x_values, scores, left=np.nan, right=np.nan)
+
+
+def sparse_upper_band(matrix, number_of_diagonals):
+    """
+    Keeps only the pixels of a square sparse matrix which are in the first
+    number_of_diagonals diagonals of the upper triangle
+    (0 <= column - row < number_of_diagonals) and are not 0.
+    The pixels are filtered in a single pass on the indices,
+    without intermediate copies of the matrix.
+    :return: a CSR matrix with sorted indices
+    """
+    matrix = scipy.sparse.csr_matrix(matrix)
+    matrix.sum_duplicates()
+    # offsets of the pixels from the main diagonal (column - row)
+    offsets = np.repeat(np.arange(matrix.shape[0], dtype=matrix.indices.dtype),
+                        np.diff(matrix.indptr))
+    rows = offsets.copy()
+    np.subtract(matrix.indices, offsets, out=offsets)
+    keep = offsets >= 0
+    keep &= offsets < number_of_diagonals
+    keep &= matrix.data != 0
+    del offsets
+    indptr = np.zeros(matrix.shape[0] + 1, dtype=matrix.indptr.dtype)
+    np.cumsum(np.bincount(rows[keep], minlength=matrix.shape[0]), out=indptr[1:])
+    return scipy.sparse.csr_matrix((matrix.data[keep], matrix.indices[keep], indptr),
+                                   shape=matrix.shape)
+
+
+def fill_main_diagonal(matrix, value):
+    """
+    Adds value to the main diagonal of an upper triangular CSR matrix
+    with sorted indices (see sparse_upper_band). When the main diagonal
+    has no pixel, the pixels are inserted at the start of each row.
+    :return: a CSR matrix
+    """
+    n = matrix.shape[0]
+    if matrix.diagonal().any() or matrix.shape[0] != matrix.shape[1]:
+        return matrix + scipy.sparse.dia_matrix(([value] * n, [0]), shape=matrix.shape)
+    # Remove the pixels of the main diagonal with 0
+    if not matrix.has_sorted_indices:
+        matrix.sort_indices()
+    matrix.eliminate_zeros()
+    diagonal_positions = matrix.indptr[:-1] + np.arange(n)
+    data = np.empty(len(matrix.data) + n, dtype=np.result_type(matrix.data, value))
+    indices = np.empty(len(matrix.data) + n, dtype=matrix.indices.dtype)
+    others = np.ones(len(data), dtype=bool)
+    others[diagonal_positions] = False
+    data[diagonal_positions] = value
+    indices[diagonal_positions] = np.arange(n)
+    data[others] = matrix.data
+    indices[others] = matrix.indices
+    return scipy.sparse.csr_matrix((data, indices, matrix.indptr + np.arange(n + 1)),
+                                   shape=matrix.shape)
+
+
+def sparse_band_values(matrix, number_of_diagonals):
+    """
+    Returns the pixels stored in the first number_of_diagonals diagonals
+    of the upper triangle of a square sparse matrix.
+    :return: the rows, the offsets (column - row) and the values of the pixels
+    """
+    matrix = scipy.sparse.coo_matrix(matrix)
+    matrix.sum_duplicates()
+    offsets = matrix.col - matrix.row
+    in_band = (offsets >= 0) & (offsets < number_of_diagonals)
+    return matrix.row[in_band], offsets[in_band], matrix.data[in_band]
+
+
+def sparse_to_band(matrix, number_of_diagonals):
+    """
+    Extracts the first number_of_diagonals diagonals of the upper
+    triangle of a square sparse matrix without making it dense.
+    :return: array band of shape (n, number_of_diagonals) with
+    band[i, d] = matrix[i, i + d] (0 when i + d is outside of the matrix)
+    """
+    rows, offsets, values = sparse_band_values(matrix, number_of_diagonals)
+    band = np.zeros((matrix.shape[0], number_of_diagonals))
+    band[rows, offsets] = values
+    return band
+
+
+def band_diagonal(band, offset, outside_value=0):
+    """
+    :return: the diagonal offset of the matrix stored in band
+    (see sparse_to_band), the diagonals after the band have the
+    value outside_value
+    """
+    n, number_of_diagonals = band.shape
+    if offset < number_of_diagonals:
+        return band[:max(0, n - offset), offset]
+    return np.full(max(0, n - offset), outside_value, dtype=band.dtype)
+
+
+class DiagonalStats(object):
+    """
+    Summary of some diagonals of the upper triangle of square sparse
+    matrices from which their percentiles can be computed without
+    the dense diagonals. The matrices are added one by one
+    (for example one per chromosome). For each diagonal, the sorted
+    non-zero values and the number of zeros are kept.
+    """
+
+    def __init__(self, offsets):
+        self.values = {offset: [] for offset in offsets}
+        self.zeros = {offset: 0 for offset in offsets}
+
+    def add(self, matrix, first_row=0):
+        """
+        Adds the diagonals of matrix from its row first_row
+        (the rows before were added with a previous matrix).
+        """
+        matrix = scipy.sparse.coo_matrix(matrix)
+        matrix.sum_duplicates()
+        offsets = matrix.col - matrix.row
+        in_rows = matrix.row >= first_row
+        for offset in self.values:
+            values = matrix.data[in_rows & (offsets == offset) & (matrix.data != 0)]
+            self.values[offset].append(np.sort(values))
+            self.zeros[offset] += max(0, matrix.shape[0] - offset - first_row) - len(values)
+
+    def percentile(self, offset, q):
+        """
+        :return: the q-th percentile of the values of the diagonal offset
+        of all the matrices added (like np.percentile) or None if there is
+        no value.
+        """
+        if len(self.values[offset]) != 1:
+            # The values of the different matrices are merged once
+            self.values[offset] = [np.sort(np.concatenate(self.values[offset]))]
+        values = self.values[offset][0]
+        zeros = self.zeros[offset]
+        total = len(values) + zeros
+        if total == 0:
+            return None
+        number_of_negatives = np.searchsorted(values, 0)
+
+        def value_at(i):
+            if i < number_of_negatives:
+                return values[i]
+            if i < number_of_negatives + zeros:
+                return 0
+            return values[i - zeros]
+
+        position = q / 100 * (total - 1)
+        low = int(np.floor(position))
+        high = min(low + 1, total - 1)
+        return value_at(low) + (value_at(high) - value_at(low)) * (position - low)
+
+
+def _expand_args(args):
+    # max((file, second_file)) is the same as max(file, second_file)
+    values = [v for arg in args
+              for v in (arg if isinstance(arg, tuple) else (arg,))]
+    if len(values) == 0:
+        raise ValueError("expected at least 1 argument")
+    return values
+
+
+def _fold_args(args, keep_new):
+    """
+    Python max/min on arrays: the first value is kept
+    unless the next one is strictly larger/smaller
+    (so nan are only kept when they come first).
+    """
+    values = _expand_args(args)
+    result = values[0]
+    for value in values[1:]:
+        result = np.where(keep_new(value, result), value, result)
+    return result
+
+
+OPERATION_FUNCTIONS = {'log': np.log, 'log1p': np.log1p,
+                       'log2': np.log2, 'log10': np.log10,
+                       'exp': np.exp, 'sqrt': np.sqrt, 'abs': np.abs,
+                       'max': lambda *args: _fold_args(args, np.greater),
+                       'min': lambda *args: _fold_args(args, np.less),
+                       'sum': lambda *args: sum(_expand_args(args))}
+OPERATION_VARIABLES = ['file', 'second_file']
+OPERATION_NODES = (ast.Expression, ast.BinOp, ast.UnaryOp, ast.Call,
+                   ast.Name, ast.Load, ast.Constant, ast.Tuple,
+                   ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv,
+                   ast.Pow, ast.USub, ast.UAdd)
+
+
+def _divide(numerator, denominator):
+    """
+    Division of the operations. As when the operation was computed
+    on python floats, dividing by zero raises a ZeroDivisionError.
+    """
+    if np.any(np.asarray(denominator) == 0):
+        raise ZeroDivisionError("float division by zero")
+    return np.true_divide(numerator, denominator)
+
+
+def _floor_divide(numerator, denominator):
+    """
+    Same as _divide for the floor division.
+    """
+    if np.any(np.asarray(denominator) == 0):
+        raise ZeroDivisionError("float floor division by zero")
+    return np.floor_divide(numerator, denominator)
+
+
+# The divisions are replaced by these functions in the compiled operations
+OPERATION_DIVISIONS = {ast.Div: _divide, ast.FloorDiv: _floor_divide}
+
+
+class _DivisionTransformer(ast.NodeTransformer):
+    """
+    Replaces the divisions of an operation by calls
+    to the functions of OPERATION_DIVISIONS.
+    """
+
+    def visit_BinOp(self, node):
+        self.generic_visit(node)
+        if type(node.op) not in OPERATION_DIVISIONS:
+            return node
+        function = OPERATION_DIVISIONS[type(node.op)]
+        return ast.copy_location(ast.Call(func=ast.Name(id=function.__name__,
+                                                        ctx=ast.Load()),
+                                          args=[node.left, node.right],
+                                          keywords=[]),
+                                 node)
+
+
+def compile_operation(operation):
+    """
+    Parses an operation between file and second_file once
+    and checks it only uses numbers, arithmetic (+, -, *, /, //, **)
+    and the functions of OPERATION_FUNCTIONS.
+    :return: a function which computes the operation on arrays:
+             compiled_operation(file, second_file=None)
+    """
+    try:
+        tree = ast.parse(operation.strip(), mode='eval')
+    except SyntaxError as e:
+        raise InputError(f"operation: {operation} could not be computed: "
+                         f"{e.msg}.")
+    for node in ast.walk(tree):
+        forbidden = None
+        if not isinstance(node, OPERATION_NODES):
+            forbidden = type(node).__name__
+        elif isinstance(node, ast.Constant):
+            if isinstance(node.value, bool) or \
+                    not isinstance(node.value, (int, float)):
+                forbidden = repr(node.value)
+            else:
+                # Computations on python integers could be endless (9 ** 9 ** 9)
+                node.value = float(node.value)
+        elif isinstance(node, ast.Call):
+            if not isinstance(node.func, ast.Name):
+                forbidden = type(node.func).__name__
+            elif node.func.id not in OPERATION_FUNCTIONS:
+                forbidden = node.func.id
+            elif len(node.keywords) > 0:
+                forbidden = ','.join(k.arg for k in node.keywords)
+        elif isinstance(node, ast.Name) and \
+                node.id not in OPERATION_VARIABLES + list(OPERATION_FUNCTIONS):
+            forbidden = node.id
+        if forbidden is not None:
+            raise InputError(f"operation: {operation} uses signs which are "
+                             f"not allowed: {forbidden}. Only numbers, "
+                             f"{', '.join(OPERATION_VARIABLES)}, +, -, *, /, "
+                             "//, ** and the functions "
+                             f"{', '.join(OPERATION_FUNCTIONS)} can be used.")
+    tree = ast.fix_missing_locations(_DivisionTransformer().visit(tree))
+    code = compile(tree, '<operation>', 'eval')
+
+    def compiled_operation(file, second_file=None):
+        variables = dict(OPERATION_FUNCTIONS)
+        for function in OPERATION_DIVISIONS.values():
+            variables[function.__name__] = function
+        variables['file'] = np.asarray(file, dtype=float)
+        if second_file is not None:
+            variables['second_file'] = np.asarray(second_file, dtype=float)
+        result = eval(code, {'__builtins__': {}}, variables)
+        # The operation may not use the files (operation = 1)
+        return np.broadcast_to(result, variables['file'].shape).astype(float)
+    return compiled_operation
+
+
 def plot_coverage(ax, x_values, score_list, plot_type, size, color,
                   negative_color, alpha, grid):
     if grid:
@@ -329,7 +1632,8 @@ def count_lines(file_h, asBed=False):
                line.startswith("browser") or line.strip() == '':
                 continue
         n += 1
-    file_h.close()
+    # Rewind so the file can be read again
+    file_h.seek(0)
     return n
 
 
@@ -23,7 +23,6 @@ done
 TRAVIS_PYTHON_VERSION=3.11
 conda create -n pgt_test_${TRAVIS_PYTHON_VERSION} --yes -c bioconda -c conda-forge python=$TRAVIS_PYTHON_VERSION
 conda activate pgt_test_${TRAVIS_PYTHON_VERSION}
-conda install --yes -c conda-forge -c bioconda bedtools
 pip install -r requirements_CI.txt
 python setup.py install
 py.test pygenometracks --doctest-modules